@@ -0,0 +1 @@
+""" Benchmark and stand-in tooling for the Kaminario Flocker driver """
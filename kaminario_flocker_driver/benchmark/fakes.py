@@ -0,0 +1,739 @@
+""" In-memory stand-ins for a K2 array and for the host iSCSI layer.
+
+``FakeK2Array`` answers the K2 RESTful API requests issued by krest, so the
+real ``KrestExtendedEndPoint`` request path (retries, locking) is exercised.
+``FakeK2StorageCenterApi`` is a ``K2StorageCenterApi`` whose host commands
+(iscsiadm, multipath, scsi_id, ...) are answered from the array mappings
+instead of being spawned, and which counts every command it is asked to run.
+"""
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+from collections import defaultdict
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from kaminario_flocker_driver.utils.k2_api_client import K2StorageCenterApi, \
+    KrestExtendedEndPoint
+from kaminario_flocker_driver.utils.resilience import check_deadline
+from kaminario_flocker_driver.utils.call_trace import record_command
+from kaminario_flocker_driver.constants import RETRIES, \
+    ISCSI_SESSION_FIELDS, MULTIPATH_CONF
+
+API_PREFIX = "/api/v2"
+FAKE_TARGET_IQN = "iqn.2009-01.com.kaminario:storage.k2.54615"
+FAKE_NET_IPS = ("10.11.57.2", "10.11.57.3")
+
+# Negotiated values of a session logged in with the open-iscsi defaults
+DEFAULT_SESSION_VALUES = {
+    "node.session.timeo.replacement_timeout": "120",
+    "node.session.iscsi.FirstBurstLength": "65536",
+    "node.session.iscsi.MaxBurstLength": "262144",
+    "node.conn[0].iscsi.MaxRecvDataSegmentLength": "262144",
+    "node.conn[0].iscsi.HeaderDigest": "None",
+    "node.conn[0].iscsi.DataDigest": "None",
+}
+
+# Device section multipathd has built in for K2 LUNs
+BUILTIN_MULTIPATH_CONFIG = """devices {
+\tdevice {
+\t\tvendor "KMNRIO"
+\t\tproduct "K2"
+\t\tpath_grouping_policy "multibus"
+\t}
+}
+"""
+
+# Fields looked up by equality often enough to be worth an index
+INDEXED_FIELDS = ("name", "scsi_sn", "iqn", "volume", "host", "volume_group")
+
+
+class FakeResponse(object):
+    """Minimal ``requests.Response`` look-alike returned by ``FakeSession``"""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = json.dumps(body) if body is not None else ""
+        self.text = self.content
+        self.headers = {"content-type": "application/json"}
+
+    def json(self):
+        """Decode the response body."""
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """Raise ``HTTPError`` for 4xx/5xx responses, like requests does."""
+        if self.status_code >= 400:
+            raise HTTPError("{} Client Error: {}".format(self.status_code,
+                                                          self.text),
+                            response=self)
+
+
+class FakeArrayError(Exception):
+    """Raised inside ``FakeK2Array`` to answer with a K2 error message."""
+
+    def __init__(self, error_msg, status_code=400):
+        super(FakeArrayError, self).__init__(error_msg)
+        self.error_msg = error_msg
+        self.status_code = status_code
+
+
+class FakeK2Array(object):
+    """In-memory K2 array speaking the subset of the RESTful API the
+    driver uses.
+
+    :param net_ips: iSCSI portal addresses reported by ``system/net_ips``.
+    :param latency: Seconds of simulated round trip added to every request.
+    :param busy_rate: Probability of answering a request with
+        ``MC_ERR_BUSY``.
+    :param capacity_kib: Total capacity reported by ``system/capacity``.
+    :param serial_prefix: Start of the volume serial numbers, distinct per
+        array like the array serial in a real K2 scsi_sn.
+
+    Setting ``available`` to False makes every request fail with a
+    connection error, as an unreachable array would. ``stats/volumes``
+    reports the counters set in ``volume_counters`` (volume id to a dict
+    of ``iops_avg``, ``throughput_avg`` and ``latency_avg``), zero for
+    other volumes.
+    """
+    RESOURCES = ("volume_groups", "volumes", "hosts", "host_iqns",
+                 "mappings", "system/net_ips", "system/capacity",
+                 "stats/volumes")
+
+    def __init__(self, net_ips=FAKE_NET_IPS, latency=0.0, busy_rate=0.0,
+                 capacity_kib=1024 ** 4, seed=None, serial_prefix=u"20024f4"):
+        self.lock = threading.Lock()
+        self.serial_prefix = serial_prefix
+        self.latency = latency
+        self.busy_rate = busy_rate
+        self.available = True
+        self.capacity_kib = capacity_kib
+        self.random = random.Random(seed)
+        self.objects = dict((res, {}) for res in self.RESOURCES)
+        self.indexes = dict((res, defaultdict(lambda: defaultdict(set)))
+                            for res in self.RESOURCES)
+        self.next_id = 1
+        self.request_count = 0
+        self.request_counts = defaultdict(int)
+        self.volume_counters = {}
+        for ip in net_ips:
+            self._insert("system/net_ips", {"ip_address": ip})
+
+    # Bookkeeping helpers
+
+    @staticmethod
+    def ref(resource, obj_id):
+        """Build the krest reference of an object."""
+        return "/{}/{}".format(resource, obj_id)
+
+    @staticmethod
+    def _index_key(value):
+        if isinstance(value, dict) and "ref" in value:
+            return value["ref"]
+        return u"{}".format(value)
+
+    def _insert(self, resource, fields):
+        obj = dict(fields)
+        obj["id"] = self.next_id
+        self.next_id += 1
+        self.objects[resource][obj["id"]] = obj
+        for field in INDEXED_FIELDS:
+            if field in obj:
+                self.indexes[resource][field][
+                    self._index_key(obj[field])].add(obj["id"])
+        return obj
+
+    def _remove(self, resource, obj_id):
+        obj = self.objects[resource].pop(obj_id)
+        for field in INDEXED_FIELDS:
+            if field in obj:
+                self.indexes[resource][field][
+                    self._index_key(obj[field])].discard(obj_id)
+        return obj
+
+    def _lookup(self, resource, field, value):
+        ids = self.indexes[resource][field].get(self._index_key(value), ())
+        return [self.objects[resource][i] for i in sorted(ids)]
+
+    def _deref(self, ref):
+        resource, _, obj_id = ref["ref"].lstrip("/").rpartition("/")
+        return self.objects[resource].get(int(obj_id))
+
+    def _field(self, obj, dotted):
+        value = obj
+        for name in dotted.split("."):
+            if isinstance(value, dict) and "ref" in value and \
+                    name not in value:
+                value = self._deref(value) or {}
+            value = value.get(name) if isinstance(value, dict) else None
+        return value
+
+    # Query handling
+
+    def _matches(self, obj, key, value):
+        if key.endswith(".ref__m_eq"):
+            ref = self._field(obj, key[:-len(".ref__m_eq")])
+            return ref is not None and ref["ref"] in value.split(",")
+        if key.endswith(".ref"):
+            ref = self._field(obj, key[:-len(".ref")])
+            return ref is not None and ref["ref"] == value
+        if key.endswith("__m_eq"):
+            return u"{}".format(self._field(obj, key[:-len("__m_eq")])) in \
+                value.split(",")
+        if key.endswith("__contains"):
+            return value in u"{}".format(
+                self._field(obj, key[:-len("__contains")]) or "")
+        return u"{}".format(self._field(obj, key)) == value
+
+    def _candidates(self, resource, query):
+        """Narrow the scan using an index when the query allows it."""
+        for key, value in query:
+            field = key[:-len(".ref")] if key.endswith(".ref") else key
+            if field in INDEXED_FIELDS:
+                return self._lookup(resource, field, value)
+        return [self.objects[resource][i]
+                for i in sorted(self.objects[resource])]
+
+    def search(self, resource, query):
+        """Answer a search request.
+
+        :param resource: Resource type, e.g. ``volumes``.
+        :param query: List of ``(key, value)`` query string pairs.
+        :returns: A K2 search result document.
+        """
+        options = dict((k, v) for k, v in query if k.startswith("__"))
+        filters = [(k, v) for k, v in query if not k.startswith("__")]
+        hits = [obj for obj in self._candidates(resource, filters)
+                if all(self._matches(obj, k, v) for k, v in filters)]
+        total = len(hits)
+        offset = int(options.get("__offset", 0))
+        limit = int(options.get("__limit", total or 1))
+        hits = hits[offset:offset + limit]
+        if "__fields" in options:
+            fields = set(options["__fields"].split(",")) | set(["id"])
+            hits = [dict((k, v) for k, v in obj.items() if k in fields)
+                    for obj in hits]
+        return {"hits": [dict(obj) for obj in hits], "total": total,
+                "limit": limit, "offset": offset}
+
+    def _check_unique(self, resource, field, value):
+        if self._lookup(resource, field, value):
+            raise FakeArrayError("MC_ERR_NAME_EXISTS")
+
+    def _next_lun(self, host_ref):
+        used = set(m["lun"] for m in self._lookup("mappings", "host",
+                                                  {"ref": host_ref}))
+        lun = 1
+        while lun in used:
+            lun += 1
+        return lun
+
+    def create(self, resource, data):
+        """Answer a POST (object creation) request."""
+        fields = dict(data)
+        if resource in ("volume_groups", "volumes", "hosts"):
+            self._check_unique(resource, "name", fields.get("name"))
+        if resource == "volumes":
+            if not fields.get("volume_group") or \
+                    self._deref(fields["volume_group"]) is None:
+                raise FakeArrayError("MC_ERR_VG_NOT_FOUND")
+            if self.used_kib() + int(fields.get("size", 0)) > \
+                    self.capacity_kib:
+                raise FakeArrayError("MC_ERR_NO_SPACE")
+            obj = self._insert(resource, fields)
+            obj["scsi_sn"] = u"{}{:09x}".format(self.serial_prefix, obj["id"])
+            self.indexes[resource]["scsi_sn"][obj["scsi_sn"]].add(obj["id"])
+            return obj
+        if resource == "host_iqns":
+            self._check_unique(resource, "iqn", fields.get("iqn"))
+        if resource == "mappings":
+            if self._lookup("mappings", "volume", fields["volume"]):
+                raise FakeArrayError("MC_ERR_VOLUME_ALREADY_MAPPED")
+            fields["lun"] = self._next_lun(fields["host"]["ref"])
+        return self._insert(resource, fields)
+
+    def update(self, resource, obj_id, data):
+        """Answer a PATCH request."""
+        obj = self.objects[resource].get(obj_id)
+        if obj is None:
+            raise FakeArrayError("MC_ERR_NOT_FOUND", 404)
+        self._remove(resource, obj_id)
+        obj.update(data)
+        self.objects[resource][obj_id] = obj
+        for field in INDEXED_FIELDS:
+            if field in obj:
+                self.indexes[resource][field][
+                    self._index_key(obj[field])].add(obj_id)
+        return obj
+
+    def delete(self, resource, obj_id):
+        """Answer a DELETE request, refusing to orphan dependants."""
+        obj = self.objects[resource].get(obj_id)
+        if obj is None:
+            raise FakeArrayError("MC_ERR_NOT_FOUND", 404)
+        ref = {"ref": self.ref(resource, obj_id)}
+        if resource == "volume_groups" and \
+                self._lookup("volumes", "volume_group", ref):
+            raise FakeArrayError("MC_ERR_VG_NOT_EMPTY")
+        if resource == "volumes" and self._lookup("mappings", "volume", ref):
+            raise FakeArrayError("MC_ERR_VOLUME_MAPPED")
+        if resource == "hosts" and self._lookup("mappings", "host", ref):
+            raise FakeArrayError("MC_ERR_HOST_HAS_MAPPINGS")
+        if resource == "hosts":
+            for host_iqn in self._lookup("host_iqns", "host", ref):
+                self._remove("host_iqns", host_iqn["id"])
+        self._remove(resource, obj_id)
+
+    def used_kib(self):
+        """Total provisioned size of all volumes."""
+        return sum(int(v.get("size", 0))
+                   for v in self.objects["volumes"].values())
+
+    def _stats_document(self, query):
+        filters = [(k, v) for k, v in query if not k.startswith("__")]
+        hits = []
+        for volume_id in sorted(self.objects["volumes"]):
+            stat = {"id": volume_id,
+                    "volume": {"ref": self.ref("volumes", volume_id)},
+                    "iops_avg": 0, "throughput_avg": 0, "latency_avg": 0}
+            stat.update(self.volume_counters.get(volume_id, {}))
+            if all(self._matches(stat, k, v) for k, v in filters):
+                hits.append(stat)
+        return {"hits": hits, "total": len(hits), "limit": len(hits) or 1,
+                "offset": 0}
+
+    def _system_document(self, resource, query):
+        if resource == "stats/volumes":
+            return self._stats_document(query)
+        if resource == "system/capacity":
+            used = self.used_kib()
+            return {"hits": [{"id": 1, "total": self.capacity_kib,
+                              "free": self.capacity_kib - used,
+                              "provisioned": used}],
+                    "total": 1, "limit": 1, "offset": 0}
+        return None
+
+    def handle(self, method, url, data=None):
+        """Dispatch one HTTP request.
+
+        :returns: A ``(status_code, body)`` tuple.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urlparse.urlparse(url)
+        path = parsed.path[len(API_PREFIX):].strip("/")
+        query = urlparse.parse_qsl(parsed.query, keep_blank_values=True)
+        with self.lock:
+            self.request_count += 1
+            self.request_counts[method] += 1
+            if self.busy_rate and self.random.random() < self.busy_rate:
+                return 400, {"error_msg": "MC_ERR_BUSY"}
+            if not path:
+                return 200, {"resources": dict(
+                    (res, {"url": "/{}".format(res)})
+                    for res in self.RESOURCES)}
+            resource, obj_id = path, None
+            if path not in self.objects:
+                resource, _, obj_id = path.rpartition("/")
+                obj_id = int(obj_id)
+            try:
+                if method == "GET" and obj_id is None:
+                    return 200, (self._system_document(resource, query) or
+                                 self.search(resource, query))
+                if method == "GET":
+                    obj = self.objects[resource].get(obj_id)
+                    if obj is None:
+                        raise FakeArrayError("MC_ERR_NOT_FOUND", 404)
+                    return 200, dict(obj)
+                body = json.loads(data) if data else {}
+                if method == "POST":
+                    return 201, dict(self.create(resource, body))
+                if method == "PATCH":
+                    return 200, dict(self.update(resource, obj_id, body))
+                if method == "DELETE":
+                    self.delete(resource, obj_id)
+                    return 204, None
+            except FakeArrayError as err:
+                return err.status_code, {"error_msg": err.error_msg}
+        return 405, {"error_msg": "MC_ERR_METHOD_NOT_ALLOWED"}
+
+    # Helpers used by the fake host layer
+
+    def visible_luns(self, iqn):
+        """Volumes mapped to the host owning ``iqn``.
+
+        :returns: A dict of scsi_sn to LUN number.
+        """
+        with self.lock:
+            result = {}
+            for host_iqn in self._lookup("host_iqns", "iqn", iqn):
+                if not host_iqn.get("host"):
+                    continue
+                for mapping in self._lookup("mappings", "host",
+                                            host_iqn["host"]):
+                    volume = self._deref(mapping["volume"])
+                    if volume:
+                        result[volume["scsi_sn"]] = mapping["lun"]
+            return result
+
+    def register_host(self, name, iqn, host_type=u"Linux"):
+        """Pre-provision a host with its initiator, as an administrator
+        would before the first attach."""
+        with self.lock:
+            host = self._insert("hosts", {"name": name, "type": host_type})
+            self._insert("host_iqns", {
+                "iqn": iqn, "host": {"ref": self.ref("hosts", host["id"])}})
+            return host
+
+
+class FakeSession(object):
+    """``requests.Session`` replacement routing requests to a
+    ``FakeK2Array``."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def request(self, method, url, data=None, timeout=None, **kwargs):
+        """Issue a request against the fake array."""
+        if not self.array.available:
+            raise ConnectionError("Fake K2 array is down")
+        if timeout is not None and self.array.latency > timeout:
+            time.sleep(timeout)
+            raise Timeout("Fake K2 array did not answer in {}s".format(
+                timeout))
+        status, body = self.array.handle(method, url, data)
+        return FakeResponse(status, body)
+
+
+class FakeKrestEndPoint(KrestExtendedEndPoint):
+    """``KrestExtendedEndPoint`` talking to a ``FakeK2Array``."""
+
+    def __init__(self, array, *args, **kwargs):
+        self._fake_session = FakeSession(array)
+        super(FakeKrestEndPoint, self).__init__(*args, **kwargs)
+
+    @property
+    def session(self):
+        """The fake session; krest's own session assignment is ignored."""
+        return self._fake_session
+
+    @session.setter
+    def session(self, value):
+        pass
+
+
+class FakeK2StorageCenterApi(K2StorageCenterApi):
+    """``K2StorageCenterApi`` backed by a ``FakeK2Array`` and a simulated
+    host iSCSI/multipath layer.
+
+    :param array: The ``FakeK2Array`` to talk to.
+    :param iqn: Initiator name of the simulated node.
+    :param paths_per_lun: Number of ``sd`` paths each mapped LUN shows up
+        with.
+    :param command_latency: Seconds each simulated command takes.
+    :param visible_arrays: Every ``FakeK2Array`` the node sees LUNs of,
+        just ``array`` by default.
+    :param schedulers: The I/O schedulers the simulated kernel offers.
+    :param keep_stale_devices: Whether the devices of unmapped LUNs stay
+        until removed through sysfs, as on a node whose rescan missed the
+        unmapping, instead of vanishing with the mapping.
+    """
+    DEVICE_REGEX = re.compile(r'/dev/(sd[a-z]+)')
+    SLAVES_REGEX = re.compile(r'/sys/block/(dm-\d+)/slaves$')
+    DELETE_REGEX = re.compile(r'/sys/block/(sd[a-z]+)/device/delete$')
+
+    def __init__(self, array, iqn=u"iqn.1994-05.com.redhat:fake-node",
+                 paths_per_lun=2, command_latency=0.0, retries=RETRIES,
+                 visible_arrays=None,
+                 schedulers=("none", "mq-deadline", "kyber"),
+                 keep_stale_devices=False):
+        super(FakeK2StorageCenterApi, self).__init__(
+            "fake-k2", "admin", "admin", False, retries)
+        self.array = array
+        self.visible_arrays = visible_arrays or [array]
+        self.iqn = iqn
+        self.paths_per_lun = paths_per_lun
+        self.command_latency = command_latency
+        self.counter_lock = threading.Lock()
+        self.command_count = 0
+        self.command_counts = defaultdict(int)
+        self.device_lock = threading.Lock()
+        self.lun_devices = {}  # scsi_sn -> list of sd names
+        self.device_serials = {}  # sd name -> scsi_sn
+        self.mpath_names = {}  # scsi_sn -> multipath map name
+        self.dm_names = {}  # scsi_sn -> dm device name
+        self.flushed = set()
+        self.next_device = 0
+        self.next_dm = 0
+        self.schedulers = schedulers
+        self.keep_stale_devices = keep_stale_devices
+        self.sysfs = {}  # sysfs attribute path -> value written
+        self.node_records = {}  # (target iqn, portal) -> node settings
+        self.sessions = []  # dicts of sid, target, portal and settings
+        self.next_sid = 1
+        self.files = {}  # path -> content
+
+    def _new_endpoint(self, **kwargs):
+        """Connect to the fake array instead of a real K2."""
+        return FakeKrestEndPoint(self.array, self.host, self.username,
+                                 self.password, **kwargs)
+
+    @staticmethod
+    def _device_name(number):
+        name = ""
+        number += 1
+        while number:
+            number, rem = divmod(number - 1, 26)
+            name = chr(ord('a') + rem) + name
+        return "sd" + name
+
+    def _refresh_devices(self):
+        """Allocate device names for newly visible LUNs."""
+        visible = {}
+        for array in self.visible_arrays:
+            visible.update(array.visible_luns(self.iqn))
+        with self.device_lock:
+            for scsi_sn in visible:
+                if scsi_sn in self.lun_devices:
+                    continue
+                names = []
+                for _ in range(self.paths_per_lun):
+                    name = self._device_name(self.next_device)
+                    self.next_device += 1
+                    self.device_serials[name] = scsi_sn
+                    names.append(name)
+                self.lun_devices[scsi_sn] = names
+                self.mpath_names[scsi_sn] = "mpath{}".format(
+                    names[0][2:])
+                self.dm_names[scsi_sn] = "dm-{}".format(self.next_dm)
+                self.next_dm += 1
+            for scsi_sn in list(self.lun_devices):
+                if scsi_sn not in visible and not self.keep_stale_devices:
+                    for name in self.lun_devices.pop(scsi_sn):
+                        self.device_serials.pop(name, None)
+                    self.mpath_names.pop(scsi_sn, None)
+                    self.dm_names.pop(scsi_sn, None)
+                    self.flushed.discard(scsi_sn)
+        return visible
+
+    def add_path(self, scsi_sn):
+        """Show a mapped LUN through one more ``sd`` path, as a new
+        session would."""
+        self._refresh_devices()
+        with self.device_lock:
+            name = self._device_name(self.next_device)
+            self.next_device += 1
+            self.device_serials[name] = scsi_sn
+            self.lun_devices[scsi_sn].append(name)
+        return name
+
+    def _mpath_serial(self, name):
+        for scsi_sn, mpath in self.mpath_names.items():
+            if mpath == name:
+                return scsi_sn
+        return None
+
+    def _path_exists(self, path):
+        self._refresh_devices()
+        name = path.rpartition("/")[2]
+        with self.device_lock:
+            if path.startswith("/dev/mapper/"):
+                scsi_sn = self._mpath_serial(name)
+                return scsi_sn is not None and scsi_sn not in self.flushed
+            return name in self.device_serials
+
+    def _realpath(self, path):
+        if path.startswith("/dev/mapper/"):
+            with self.device_lock:
+                scsi_sn = self._mpath_serial(path.rpartition("/")[2])
+                if scsi_sn is not None:
+                    return "/dev/{}".format(self.dm_names[scsi_sn])
+        return path
+
+    def _list_dir(self, path):
+        if path == "/sys/class/iscsi_host":
+            # One SCSI host per iSCSI session
+            with self.device_lock:
+                return ["host{}".format(session["sid"] + 1)
+                        for session in self.sessions]
+        match = self.SLAVES_REGEX.match(path)
+        with self.device_lock:
+            for scsi_sn, name in self.dm_names.items():
+                if match and match.group(1) == name:
+                    return list(self.lun_devices[scsi_sn])
+        return []
+
+    def _write_sysfs(self, path, value):
+        if path.endswith("/scheduler") and value not in self.schedulers:
+            return False
+        match = self.DELETE_REGEX.match(path)
+        if match:
+            with self.device_lock:
+                scsi_sn = self.device_serials.pop(match.group(1), None)
+                if scsi_sn is None:
+                    return False
+                self.lun_devices[scsi_sn].remove(match.group(1))
+                if not self.lun_devices[scsi_sn]:
+                    del self.lun_devices[scsi_sn]
+                    self.mpath_names.pop(scsi_sn, None)
+                    self.dm_names.pop(scsi_sn, None)
+                    self.flushed.discard(scsi_sn)
+        self.sysfs[path] = value
+        return True
+
+    def _list_devices(self):
+        self._refresh_devices()
+        with self.device_lock:
+            return ["null", "zero", "mapper"] + sorted(self.device_serials)
+
+    def _new_session(self, target, portal):
+        settings = dict(DEFAULT_SESSION_VALUES)
+        settings.update((name, value.split(",")[0]) for name, value in
+                        self.node_records[(target, portal)].items())
+        self.sessions.append({"sid": self.next_sid, "target": target,
+                              "portal": portal, "settings": settings})
+        self.next_sid += 1
+
+    def _iscsiadm(self, args):
+        """Simulate the iscsiadm node and session modes."""
+        options = dict(zip(args[::2], args[1::2]))
+        if args[:2] == ["-m", "node"] and "-o" in options:
+            record = self.node_records.get((options["-T"], options["-p"]))
+            if record is None:
+                return "", 21
+            record[options["-n"]] = options["-v"]
+            return "", 0
+        if args[:2] == ["-m", "node"]:
+            target = options["-T"]
+            nodes = [node for node in sorted(self.node_records)
+                     if node[0] == target]
+            if "-u" in args:
+                self.sessions = [session for session in self.sessions
+                                 if session["target"] != target]
+                return "", 0
+            logged_in = False
+            for node in nodes:
+                if any((s["target"], s["portal"]) == node
+                       for s in self.sessions):
+                    continue
+                for _ in range(int(self.node_records[node].get(
+                        "node.session.nr_sessions", 1))):
+                    self._new_session(*node)
+                logged_in = True
+            return "", 0 if logged_in else 15
+        if args[:2] == ["-m", "session"] and "--op" in options:
+            sid = int(options["-r"])
+            for session in list(self.sessions):
+                if session["sid"] == sid:
+                    self._new_session(session["target"], session["portal"])
+                    return "", 0
+            return "", 21
+        if args[:4] == ["-m", "session", "-P", "2"]:
+            lines = []
+            for target in sorted(set(s["target"] for s in self.sessions)):
+                lines.append("Target: {} (non-flash)".format(target))
+                for session in self.sessions:
+                    if session["target"] != target:
+                        continue
+                    lines.append("\tCurrent Portal: {},1".format(
+                        session["portal"]))
+                    lines.append("\t\tSID: {}".format(session["sid"]))
+                    for name, field in sorted(ISCSI_SESSION_FIELDS.items()):
+                        lines.append("\t\t{}: {}".format(
+                            field, session["settings"][name]))
+            return "\n".join(lines) + "\n", 0 if lines else 21
+        return "", 0
+
+    def _read_file(self, path):
+        return self.files.get(path, "")
+
+    def _write_file(self, path, content):
+        self.files[path] = content
+
+    def _execute(self, cmd):
+        """Produce the output a real node would give for ``cmd``."""
+        if cmd == "multipathd show config":
+            # Built in entries first, multipath.conf ones override them
+            return BUILTIN_MULTIPATH_CONFIG + self.files.get(
+                MULTIPATH_CONF, ""), 0
+        if cmd.startswith("cat /etc/iscsi/initiatorname.iscsi"):
+            return "InitiatorName={}\n".format(self.iqn), 0
+        if cmd.startswith("iscsiadm -m discovery"):
+            ip = cmd.split()[-1]
+            self.node_records.setdefault(
+                (FAKE_TARGET_IQN, "{}:3260".format(ip)), {})
+            return "{}:3260,1 {}\n".format(ip, FAKE_TARGET_IQN), 0
+        if cmd.startswith("iscsiadm -m node") or \
+                cmd.startswith("iscsiadm -m session") and "-P" in cmd or \
+                cmd.startswith("iscsiadm -m session") and "--op" in cmd:
+            with self.device_lock:
+                return self._iscsiadm(cmd.split()[1:])
+        if cmd.startswith("/lib/udev/scsi_id"):
+            match = self.DEVICE_REGEX.search(cmd)
+            with self.device_lock:
+                scsi_sn = self.device_serials.get(match.group(1)) \
+                    if match else None
+            if scsi_sn is None:
+                return "", 1
+            return "SKMNRIO K2      {}\n".format(scsi_sn), 0
+        if cmd == "multipath -ll":
+            lines = []
+            with self.device_lock:
+                for scsi_sn, name in sorted(self.mpath_names.items()):
+                    if scsi_sn in self.flushed:
+                        continue
+                    lines.append("{} (2{}) {} KMNRIO ,k2".format(
+                        name, scsi_sn, self.dm_names[scsi_sn]))
+                    lines.append("size=1.0G features='0' hwhandler='0' "
+                                 "wp=rw")
+                    lines.append("`-+- policy='queue-length 0' prio=1 "
+                                 "status=active")
+                    for index, dev in enumerate(self.lun_devices[scsi_sn]):
+                        lines.append("  |- {}:0:0:1 {} 8:{} active ready "
+                                     "running".format(index + 2, dev,
+                                                      index * 16))
+            return "\n".join(lines) + "\n", 0
+        if cmd.startswith("multipath -l "):
+            match = self.DEVICE_REGEX.search(cmd)
+            with self.device_lock:
+                scsi_sn = self.device_serials.get(match.group(1)) \
+                    if match else self._mpath_serial(cmd.split()[-1])
+                if scsi_sn is None or scsi_sn in self.flushed:
+                    return "", 0
+                return "{} (2{}) dm-{} KMNRIO ,k2\n".format(
+                    self.mpath_names[scsi_sn], scsi_sn,
+                    self.lun_devices[scsi_sn][0][2:]), 0
+        if cmd.startswith("multipath -f "):
+            with self.device_lock:
+                scsi_sn = self._mpath_serial(cmd.split()[-1])
+                if scsi_sn is not None:
+                    self.flushed.add(scsi_sn)
+            return "", 0
+        if cmd == "multipath":
+            self._refresh_devices()
+            with self.device_lock:
+                self.flushed.clear()
+            return "", 0
+        return "", 0
+
+    def _run_command(self, cmd):
+        """Answer ``cmd`` from the simulated node, counting the spawn."""
+        check_deadline('running {}'.format(cmd))
+        with self.counter_lock:
+            self.command_count += 1
+            self.command_counts[cmd.split()[0]] += 1
+        start = time.time()
+        if self.command_latency:
+            time.sleep(self.command_latency)
+        output, status = self._execute(cmd)
+        record_command(cmd, time.time() - start, status)
+        return output, status
+
+    def rescan_iscsi(self):
+        """Rescan without the settle delays; the fake LUNs appear as soon
+        as they are mapped."""
+        self._rescan_iscsi_session()
+        self._run_scsi_bus()
+        self._run_multipath()
+        return None
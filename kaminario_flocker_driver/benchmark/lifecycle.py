@@ -0,0 +1,369 @@
+""" End-to-end lifecycle benchmark for ``K2BlockDeviceAPI``.
+
+Drives create -> attach -> get_device_path -> list -> detach -> destroy
+against ``FakeK2Array`` and the fake host layer at configurable scales and
+concurrency levels, and reports per operation latency percentiles, REST calls
+and subprocess spawns. Results are emitted as JSON so runs from different
+commits can be compared with ``--baseline``.
+
+Example::
+
+    python -m kaminario_flocker_driver.benchmark.lifecycle \\
+        --scales 10,100,1000 --concurrency 1,8 --output bench.json
+"""
+import argparse
+import json
+import logging
+import math
+import platform
+import Queue
+import subprocess
+import sys
+import threading
+import time
+from uuid import uuid4
+from kaminario_flocker_driver.benchmark.fakes import FakeK2Array, \
+    FakeK2StorageCenterApi
+from kaminario_flocker_driver.k2_blockdevice_api import K2BlockDeviceAPI
+
+LOG = logging.getLogger(__name__)
+
+GIB = 1024 ** 3
+OPERATIONS = ("warm_up", "create_volume", "attach_volume", "get_device_path",
+              "list_volumes", "detach_volume", "destroy_volume")
+# Metrics compared against a baseline run; higher is worse for all of them
+COMPARED_METRICS = ("p50_ms", "p99_ms", "rest_calls_per_op",
+                    "subprocess_spawns_per_op")
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of ``samples``.
+
+    :param samples: A list of numbers.
+    :param pct: The percentile, between 0 and 100.
+    :return: The percentile value, or 0.0 for no samples.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+def build_node(array, paths_per_lun=2, extra_arrays=(), register_host=True):
+    """Build the fake host layer of this node, registered on ``array``
+    and on every extra array.
+
+    :param register_host: Whether the host of the node is pre-provisioned
+        on the arrays, otherwise the driver creates it.
+    :return: A ``FakeK2StorageCenterApi``.
+    """
+    arrays = [array] + list(extra_arrays)
+    api_client = FakeK2StorageCenterApi(array, paths_per_lun=paths_per_lun,
+                                        visible_arrays=arrays)
+    if register_host:
+        for each in arrays:
+            each.register_host(unicode(platform.uname()[1]), api_client.iqn)
+    return api_client
+
+
+def build_arrays(count, **array_options):
+    """Build ``count`` fake arrays with distinct volume serial numbers."""
+    return [FakeK2Array(serial_prefix=u"20024f{:x}".format(4 + index),
+                        **array_options) for index in range(count)]
+
+
+def array_config(api_client, extra_arrays):
+    """Driver settings using the node's array plus ``extra_arrays``."""
+    if not extra_arrays:
+        return {"api_client": api_client}
+    arrays = [{"name": u"k2-0", "api_client": api_client}]
+    for index, array in enumerate(extra_arrays):
+        arrays.append({"name": u"k2-{}".format(index + 1),
+                       "api_client": FakeK2StorageCenterApi(array)})
+    return {"arrays": arrays}
+
+
+def build_driver(array=None, paths_per_lun=2, extra_arrays=(),
+                 register_host=True, **driver_config):
+    """Build a driver wired to fake arrays and a fake host layer.
+
+    :param array: The ``FakeK2Array`` to use, a new one when omitted.
+    :param paths_per_lun: Number of SCSI paths per mapped LUN.
+    :param extra_arrays: More ``FakeK2Array``s for the driver to place
+        volumes on.
+    :param register_host: Whether the node's host is pre-provisioned.
+    :param driver_config: Extra ``agent.yml`` style driver settings.
+    :return: ``(driver, api_client, array)``
+    """
+    array = array or FakeK2Array()
+    api_client = build_node(array, paths_per_lun, extra_arrays,
+                            register_host)
+    config = {"is_dedup": "False", "state_db": ":memory:"}
+    config.update(array_config(api_client, extra_arrays))
+    config.update(driver_config)
+    driver = K2BlockDeviceAPI(cluster_id=uuid4(), **config)
+    return driver, api_client, array
+
+
+def join_rescans():
+    """Wait for the background rescans started by attach/detach."""
+    for thread in threading.enumerate():
+        if thread.name.endswith("_rescan"):
+            thread.join()
+
+
+def run_phase(operation, items, func, concurrency, api_client, arrays):
+    """Run ``func`` for every item with ``concurrency`` worker threads.
+
+    :param arrays: The ``FakeK2Array``s whose REST calls are counted.
+    :return: ``(stats, results)``, the latency and call count statistics
+        of the phase and a dict of item to return value.
+    """
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+    latencies = []
+    errors = []
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                result = func(item)
+                error = None
+            except Exception as e:
+                result, error = None, e
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if error is not None:
+                    errors.append("{}: {}".format(type(error).__name__,
+                                                  error))
+                else:
+                    results[item] = result
+
+    rest_before = sum(array.request_count for array in arrays)
+    cmd_before = api_client.command_count
+    threads = [threading.Thread(target=worker,
+                                name="bench_{}_{}".format(operation, i))
+               for i in range(max(1, concurrency))]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    join_rescans()
+    wall = time.time() - start
+    count = len(latencies) or 1
+    latencies_ms = [l * 1000.0 for l in latencies]
+    stats = {
+        "count": len(latencies),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "wall_s": round(wall, 4),
+        "ops_per_s": round(len(latencies) / wall, 2) if wall else 0.0,
+        "mean_ms": round(sum(latencies_ms) / count, 4),
+        "p50_ms": round(percentile(latencies_ms, 50), 4),
+        "p99_ms": round(percentile(latencies_ms, 99), 4),
+        "max_ms": round(max(latencies_ms or [0.0]), 4),
+        "rest_calls_per_op": round(
+            (sum(array.request_count for array in arrays) - rest_before) /
+            float(count), 3),
+        "subprocess_spawns_per_op": round(
+            (api_client.command_count - cmd_before) / float(count), 3),
+    }
+    return stats, results
+
+
+def run_benchmark(scale, concurrency, attached=None, list_repeats=5,
+                  paths_per_lun=2, array_latency=0.0, busy_rate=0.0,
+                  driver_config=None, arrays=1):
+    """Run one full lifecycle at the given scale and concurrency.
+
+    :param scale: Number of volumes created and destroyed.
+    :param concurrency: Number of concurrent callers.
+    :param attached: Number of those volumes taken through attach,
+        get_device_path and detach; all of them when ``None``.
+    :param list_repeats: Number of ``list_volumes`` calls measured.
+    :param arrays: Number of arrays the volumes are spread over.
+    :return: A dict keyed by operation name with the phase statistics.
+    """
+    fake_arrays = build_arrays(max(1, arrays), latency=array_latency,
+                               busy_rate=busy_rate, seed=0)
+    api_client = build_node(fake_arrays[0], paths_per_lun, fake_arrays[1:])
+    config = {"is_dedup": "False", "state_db": ":memory:"}
+    config.update(array_config(api_client, fake_arrays[1:]))
+    config.update(driver_config or {})
+    drivers = []
+    operations = {}
+
+    def start_driver(_):
+        driver = K2BlockDeviceAPI(cluster_id=uuid4(), **config)
+        driver.ready.wait()
+        drivers.append(driver)
+
+    # Driver start up until its background warm-up reports ready
+    operations["warm_up"], _ = run_phase(
+        "warm_up", [None], start_driver, 1, api_client, fake_arrays)
+    driver = drivers[0]
+    attach_to = driver.compute_instance_id()
+    attached = scale if attached is None else min(attached, scale)
+
+    dataset_ids = [uuid4() for _ in range(scale)]
+    operations["create_volume"], volumes = run_phase(
+        "create_volume", dataset_ids,
+        lambda dataset_id: driver.create_volume(dataset_id, GIB),
+        concurrency, api_client, fake_arrays)
+    blockdevice_ids = [volumes[d].blockdevice_id for d in dataset_ids
+                       if d in volumes]
+    to_attach = blockdevice_ids[:attached]
+
+    operations["attach_volume"], _ = run_phase(
+        "attach_volume", to_attach,
+        lambda blockdevice_id: driver.attach_volume(blockdevice_id,
+                                                    attach_to),
+        concurrency, api_client, fake_arrays)
+    operations["get_device_path"], _ = run_phase(
+        "get_device_path", to_attach, driver.get_device_path,
+        concurrency, api_client, fake_arrays)
+    operations["list_volumes"], _ = run_phase(
+        "list_volumes", range(list_repeats),
+        lambda _: driver.list_volumes(), concurrency, api_client, fake_arrays)
+    operations["detach_volume"], _ = run_phase(
+        "detach_volume", to_attach, driver.detach_volume,
+        concurrency, api_client, fake_arrays)
+    operations["destroy_volume"], _ = run_phase(
+        "destroy_volume", blockdevice_ids, driver.destroy_volume,
+        concurrency, api_client, fake_arrays)
+    return operations
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=open("/dev/null", "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """Compare a run against a baseline run.
+
+    :param results: The current benchmark document.
+    :param baseline: A previous benchmark document.
+    :param max_regression: Allowed relative increase, in percent.
+    :return: A list of human readable regression descriptions.
+    """
+    def keyed(document):
+        return dict(((run["scale"], run["concurrency"]), run["operations"])
+                    for run in document["runs"])
+
+    regressions = []
+    old_runs = keyed(baseline)
+    for key, operations in sorted(keyed(results).items()):
+        if key not in old_runs:
+            continue
+        for operation, stats in sorted(operations.items()):
+            old = old_runs[key].get(operation)
+            if not old:
+                continue
+            for metric in COMPARED_METRICS:
+                before, after = old.get(metric, 0), stats.get(metric, 0)
+                limit = before * (1 + max_regression / 100.0)
+                if after > limit and after - before > 1e-3:
+                    regressions.append(
+                        "scale={} concurrency={} {} {}: {} -> {}".format(
+                            key[0], key[1], operation, metric, before,
+                            after))
+    return regressions
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=_int_list, default=[10, 100],
+                        help="Comma separated volume counts (10..10000)")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8],
+                        help="Comma separated concurrency levels")
+    parser.add_argument("--attached", type=int, default=200,
+                        help="Volumes taken through attach/detach per run")
+    parser.add_argument("--list-repeats", type=int, default=5)
+    parser.add_argument("--paths-per-lun", type=int, default=2)
+    parser.add_argument("--array-latency-ms", type=float, default=0.0,
+                        help="Simulated REST round trip time")
+    parser.add_argument("--busy-rate", type=float, default=0.0,
+                        help="Probability of MC_ERR_BUSY answers")
+    parser.add_argument("--arrays", type=int, default=1,
+                        help="Number of arrays the volumes are spread over")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--baseline", help="Previous JSON results to compare")
+    parser.add_argument("--max-regression", type=float, default=20.0,
+                        help="Allowed increase over baseline, in percent")
+    args = parser.parse_args(argv)
+
+    document = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "attached": args.attached,
+            "paths_per_lun": args.paths_per_lun,
+            "array_latency_ms": args.array_latency_ms,
+            "busy_rate": args.busy_rate,
+            "arrays": args.arrays,
+        },
+        "runs": [],
+    }
+    for scale in args.scales:
+        for concurrency in args.concurrency:
+            operations = run_benchmark(
+                scale, concurrency, attached=args.attached,
+                list_repeats=args.list_repeats,
+                paths_per_lun=args.paths_per_lun,
+                array_latency=args.array_latency_ms / 1000.0,
+                busy_rate=args.busy_rate, arrays=args.arrays)
+            document["runs"].append({"scale": scale,
+                                     "concurrency": concurrency,
+                                     "operations": operations})
+            for operation in OPERATIONS:
+                stats = operations[operation]
+                sys.stderr.write(
+                    "scale={:<6} conc={:<3} {:<16} p50={:>9.3f}ms "
+                    "p99={:>9.3f}ms rest/op={:<7} spawn/op={:<7} "
+                    "errors={}\n".format(
+                        scale, concurrency, operation, stats["p50_ms"],
+                        stats["p99_ms"], stats["rest_calls_per_op"],
+                        stats["subprocess_spawns_per_op"], stats["errors"]))
+
+    output = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as result_file:
+            result_file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(document, json.load(baseline_file),
+                                  args.max_regression)
+        for regression in regressions:
+            sys.stderr.write("REGRESSION {}\n".format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
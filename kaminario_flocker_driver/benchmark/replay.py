@@ -0,0 +1,378 @@
+""" Replay of captured ``K2BlockDeviceAPI`` operation traces.
+
+Reads the structured operation traces a driver with ``trace_operations``
+writes to the Eliot log and runs the same operations against
+``FakeK2Array`` and the fake host layer. Every operation starts at its
+original offset from the first one, in a thread of its own, so the
+original timing and concurrency are kept. It also waits for the earlier
+operations on its volumes that had finished when it started, as
+convergence only moves on once they are done. The fake array and host
+commands answer with the median latency seen in the traces unless told
+otherwise. The report compares the original and replayed latencies and
+call counts per operation, and a replay can be compared with the one of
+another commit with ``--baseline``.
+
+Volumes used before being created in the traces are created, and attached
+when first used by a detach or ``get_device_path``, before the replay
+starts.
+
+Example::
+
+    python -m kaminario_flocker_driver.benchmark.replay \\
+        /var/log/flocker/flocker-dataset-agent.log --output replay.json
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from uuid import UUID
+from kaminario_flocker_driver.benchmark.lifecycle import GIB, \
+    build_driver, join_rescans, percentile
+from kaminario_flocker_driver.benchmark.fakes import FakeK2Array
+from kaminario_flocker_driver.constants import TRACE_MESSAGE_TYPE
+
+LOG = logging.getLogger(__name__)
+
+# The kind of every positional argument of the replayed operations
+OPERATION_ARGUMENTS = {
+    "create_volume": ("dataset", "value"),
+    "create_volume_with_profile": ("dataset", "value", "value"),
+    "create_volumes": ("datasets",),
+    "attach_volume": ("blockdevice", "node"),
+    "attach_volumes": ("blockdevices", "node"),
+    "move_volume": ("blockdevice", "node"),
+    "get_device_path": ("blockdevice",),
+    "detach_volume": ("blockdevice",),
+    "detach_volumes": ("blockdevices",),
+    "destroy_volume": ("blockdevice",),
+    "destroy_volumes": ("blockdevices",),
+    "resize_volume": ("blockdevice", "value"),
+    "list_volumes": (),
+}
+# Operations that need the volume attached to this node
+ATTACHED_OPERATIONS = ("get_device_path", "detach_volume", "detach_volumes")
+# Metrics compared against a baseline replay; higher is worse for all
+COMPARED_METRICS = ("p50_ms", "p99_ms", "rest_calls_per_op",
+                    "commands_per_op")
+# secs, how long an operation waits for the earlier ones on its volumes
+DEPENDENCY_WAIT = 60
+
+
+def load_traces(paths):
+    """Read the operation traces from Eliot log files.
+
+    :param paths: Log files, one JSON message per line; other messages
+        and lines are skipped.
+    :return: The traces of replayable operations, in start order.
+    """
+    traces = []
+    for path in paths:
+        with open(path) as log_file:
+            for line in log_file:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(message, dict) and \
+                        message.get("message_type") == TRACE_MESSAGE_TYPE \
+                        and message.get("operation") in OPERATION_ARGUMENTS:
+                    traces.append(message)
+    return sorted(traces, key=lambda trace: trace["started"])
+
+
+def summarize(traces):
+    """Latency and call count statistics of operation traces.
+
+    :return: A dict with the ``wall_s`` from the first start to the last
+        end and, under ``operations``, the statistics per operation.
+    """
+    by_operation = {}
+    for trace in traces:
+        by_operation.setdefault(trace["operation"], []).append(trace)
+    operations = {}
+    for operation, each in by_operation.items():
+        count = float(len(each))
+        latencies_ms = [trace["duration"] * 1000.0 for trace in each]
+        operations[operation] = {
+            "count": len(each),
+            "errors": sum(1 for trace in each if trace.get("error")),
+            "p50_ms": round(percentile(latencies_ms, 50), 4),
+            "p99_ms": round(percentile(latencies_ms, 99), 4),
+            "max_ms": round(max(latencies_ms), 4),
+            "rest_calls_per_op": round(
+                sum(len(trace["requests"]) for trace in each) / count, 3),
+            "commands_per_op": round(
+                sum(len(trace["commands"]) for trace in each) / count, 3),
+        }
+    wall = max(trace["started"] + trace["duration"] for trace in traces) - \
+        min(trace["started"] for trace in traces) if traces else 0.0
+    return {"wall_s": round(wall, 4), "operations": operations}
+
+
+def median_latency(traces, kind):
+    """Median duration, in seconds, of the ``requests`` or ``commands`` of
+    the traces."""
+    return percentile([record["duration"] for trace in traces
+                       for record in trace[kind]], 50)
+
+
+class Replayer(object):
+    """Runs captured operations against a driver on fakes.
+
+    :param driver: A ``K2BlockDeviceAPI`` on the fake array.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.node = driver.compute_instance_id()
+        # original blockdevice id -> blockdevice id of the replay
+        self.ids = {}
+        self.lock = threading.Lock()
+        # per trace, set once replayed, and the traces to wait for
+        self.done = []
+        self.after = []
+
+    @staticmethod
+    def _blockdevice_ids(trace):
+        kinds = OPERATION_ARGUMENTS[trace["operation"]]
+        for kind, value in zip(kinds, trace["arguments"] or []):
+            if kind == "blockdevice":
+                yield value
+            elif kind == "blockdevices":
+                for each in value:
+                    yield each
+
+    @staticmethod
+    def _flatten(result):
+        if isinstance(result, list):
+            return result
+        return [result]
+
+    def _created_ids(self, trace):
+        if not trace["operation"].startswith("create_volume"):
+            return []
+        return [blockdevice_id for blockdevice_id in
+                self._flatten(trace["result"]) if blockdevice_id]
+
+    def prepare(self, traces):
+        """Create, and attach, the volumes used before their creation and
+        find the operations each one waits for."""
+        users = {}
+        for index, trace in enumerate(traces):
+            used = list(self._blockdevice_ids(trace))
+            for blockdevice_id in used:
+                if blockdevice_id in users or blockdevice_id in self.ids:
+                    continue
+                volume = self.driver.create_volume(UUID(int=len(self.ids)),
+                                                   GIB)
+                if trace["operation"] in ATTACHED_OPERATIONS:
+                    self.driver.attach_volume(volume.blockdevice_id,
+                                              self.node)
+                self.ids[blockdevice_id] = volume.blockdevice_id
+            used.extend(self._created_ids(trace))
+            self.after.append(set(
+                earlier for blockdevice_id in used
+                for earlier in users.get(blockdevice_id, ())
+                if traces[earlier]["started"] +
+                traces[earlier]["duration"] <= trace["started"]))
+            for blockdevice_id in used:
+                users.setdefault(blockdevice_id, []).append(index)
+            self.done.append(threading.Event())
+        join_rescans()
+
+    def _replay_id(self, blockdevice_id):
+        with self.lock:
+            return self.ids.get(blockdevice_id, blockdevice_id)
+
+    def _argument(self, kind, value):
+        if kind == "dataset":
+            return UUID(value)
+        if kind == "datasets":
+            return [(UUID(dataset_id), size) for dataset_id, size in value]
+        if kind == "blockdevice":
+            return self._replay_id(value)
+        if kind == "blockdevices":
+            return [self._replay_id(each) for each in value]
+        if kind == "node":
+            return self.node
+        return value
+
+    def run(self, index, trace):
+        """Run the operation of one trace, once those it waits for are
+        done.
+
+        Keyword arguments are not replayed: the host a volume is moved
+        from is not part of the replay.
+
+        :param index: The position of the trace given to ``prepare``.
+        """
+        try:
+            for earlier in self.after[index]:
+                self.done[earlier].wait(DEPENDENCY_WAIT)
+            kinds = OPERATION_ARGUMENTS[trace["operation"]]
+            arguments = [self._argument(kind, value) for kind, value in
+                         zip(kinds, trace["arguments"] or [])]
+            result = getattr(self.driver, trace["operation"])(*arguments)
+            with self.lock:
+                for original, volume in zip(self._flatten(trace["result"]),
+                                            self._flatten(result)):
+                    if original in self._created_ids(trace) and \
+                            getattr(volume, "blockdevice_id", None):
+                        self.ids[original] = volume.blockdevice_id
+            return result
+        finally:
+            self.done[index].set()
+
+
+def replay(traces, speed=1.0, array_latency=None, command_latency=None,
+           driver_config=None):
+    """Replay traces against a fresh fake array and host layer.
+
+    :param traces: The traces, as returned by ``load_traces``.
+    :param speed: Factor the original pace is sped up by.
+    :param array_latency: Seconds each REST request takes, the median of
+        the traces by default.
+    :param command_latency: Seconds each host command takes, the median of
+        the traces by default.
+    :param driver_config: Extra ``agent.yml`` style driver settings.
+    :return: The traces of the replayed operations.
+    """
+    if array_latency is None:
+        array_latency = median_latency(traces, "requests")
+    if command_latency is None:
+        command_latency = median_latency(traces, "commands")
+    config = {"warm_up": "False", "trace_requests": "True"}
+    config.update(driver_config or {})
+    driver, api_client, _ = build_driver(
+        FakeK2Array(latency=array_latency, seed=0), **config)
+    api_client.command_latency = command_latency
+    replayer = Replayer(driver)
+    replayer.prepare(traces)
+
+    replayed = []
+    driver.tracer.reset()
+    driver.tracer.sink = replayed.append
+    threads = []
+    first = traces[0]["started"] if traces else 0.0
+    start = time.time()
+    for index, trace in enumerate(traces):
+        delay = (trace["started"] - first) / speed - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=_run_logged,
+                                  args=(replayer, index, trace),
+                                  name="replay_{}_{}".format(
+                                      trace["operation"], index))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    join_rescans()
+    return [trace for trace in replayed
+            if trace["operation"] in OPERATION_ARGUMENTS]
+
+
+def _run_logged(replayer, index, trace):
+    try:
+        replayer.run(index, trace)
+    except Exception as e:
+        LOG.info('Replayed %s failed: %s', trace["operation"], e)
+
+
+def compare(results, baseline, max_regression):
+    """Compare a replay against a baseline replay of the same traces.
+
+    :param results: The current replay document.
+    :param baseline: A previous replay document.
+    :param max_regression: Allowed relative increase, in percent.
+    :return: A list of human readable regression descriptions.
+    """
+    regressions = []
+    before, after = baseline["replayed"], results["replayed"]
+    pairs = [("wall_s", before["wall_s"], after["wall_s"])]
+    for operation, stats in sorted(after["operations"].items()):
+        old = before["operations"].get(operation)
+        if old:
+            pairs.extend(("{} {}".format(operation, metric),
+                          old.get(metric, 0), stats.get(metric, 0))
+                         for metric in COMPARED_METRICS)
+    for name, old, new in pairs:
+        if new > old * (1 + max_regression / 100.0) and new - old > 1e-3:
+            regressions.append("{}: {} -> {}".format(name, old, new))
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("logs", nargs="+",
+                        help="Eliot log files holding operation traces")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay this many times faster than captured")
+    parser.add_argument("--array-latency-ms", type=float,
+                        help="Simulated REST round trip time (default: "
+                             "median of the traces)")
+    parser.add_argument("--command-latency-ms", type=float,
+                        help="Simulated host command time (default: "
+                             "median of the traces)")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--baseline", help="Previous JSON results to compare")
+    parser.add_argument("--max-regression", type=float, default=20.0,
+                        help="Allowed increase over baseline, in percent")
+    args = parser.parse_args(argv)
+
+    traces = load_traces(args.logs)
+    if not traces:
+        sys.stderr.write("No operation traces found\n")
+        return 1
+    array_latency = args.array_latency_ms / 1000.0 \
+        if args.array_latency_ms is not None else None
+    command_latency = args.command_latency_ms / 1000.0 \
+        if args.command_latency_ms is not None else None
+    replayed = replay(traces, args.speed, array_latency, command_latency)
+    document = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "logs": args.logs,
+            "traces": len(traces),
+            "speed": args.speed,
+            "array_latency_ms": args.array_latency_ms,
+            "command_latency_ms": args.command_latency_ms,
+        },
+        "original": summarize(traces),
+        "replayed": summarize(replayed),
+    }
+    for operation, stats in sorted(
+            document["replayed"]["operations"].items()):
+        original = document["original"]["operations"].get(operation, {})
+        sys.stderr.write(
+            "{:<26} count={:<5} p50={:>9.3f}ms (was {:>9.3f}ms) "
+            "rest/op={:<7} (was {:<7}) errors={}\n".format(
+                operation, stats["count"], stats["p50_ms"],
+                original.get("p50_ms", 0.0), stats["rest_calls_per_op"],
+                original.get("rest_calls_per_op", 0.0), stats["errors"]))
+    sys.stderr.write("wall {:.3f}s (was {:.3f}s)\n".format(
+        document["replayed"]["wall_s"], document["original"]["wall_s"]))
+
+    output = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as result_file:
+            result_file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(document, json.load(baseline_file),
+                                  args.max_regression)
+        for regression in regressions:
+            sys.stderr.write("REGRESSION {}\n".format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
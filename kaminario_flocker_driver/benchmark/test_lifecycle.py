@@ -0,0 +1,48 @@
+""" This Unit Test code for the lifecycle benchmark """
+
+import unittest
+from kaminario_flocker_driver.benchmark import lifecycle
+
+
+class LifecycleBenchmarkTest(unittest.TestCase):
+    """Tests for `lifecycle.py`."""
+
+    def test_percentile(self):
+        """Is nearest-rank percentile computed correctly?"""
+        samples = range(1, 101)
+        self.assertEqual(lifecycle.percentile(samples, 50), 50)
+        self.assertEqual(lifecycle.percentile(samples, 99), 99)
+        self.assertEqual(lifecycle.percentile([], 99), 0.0)
+
+    def test_run_benchmark_small_scale(self):
+        """Does a small lifecycle run complete without errors?"""
+        operations = lifecycle.run_benchmark(scale=5, concurrency=2,
+                                             attached=3, list_repeats=2)
+        self.assertEqual(sorted(operations), sorted(lifecycle.OPERATIONS))
+        for operation, stats in operations.items():
+            self.assertEqual(stats["errors"], 0,
+                             "{} failed: {}".format(
+                                 operation, stats["error_samples"]))
+        self.assertEqual(operations["create_volume"]["count"], 5)
+        self.assertEqual(operations["attach_volume"]["count"], 3)
+        self.assertGreater(operations["attach_volume"]["rest_calls_per_op"],
+                           0)
+        self.assertGreater(
+            operations["get_device_path"]["subprocess_spawns_per_op"], 0)
+
+    def test_compare_flags_regressions(self):
+        """Are metric increases above the threshold reported?"""
+        stats = dict((metric, 1.0) for metric in lifecycle.COMPARED_METRICS)
+        worse = dict(stats, rest_calls_per_op=3.0)
+        baseline = {"runs": [{"scale": 10, "concurrency": 1,
+                              "operations": {"attach_volume": stats}}]}
+        current = {"runs": [{"scale": 10, "concurrency": 1,
+                             "operations": {"attach_volume": worse}}]}
+        self.assertEqual(lifecycle.compare(baseline, baseline, 20.0), [])
+        regressions = lifecycle.compare(current, baseline, 20.0)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("rest_calls_per_op", regressions[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
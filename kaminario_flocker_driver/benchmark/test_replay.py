@@ -0,0 +1,84 @@
+""" This Unit Test code for the trace replay """
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from uuid import uuid4
+from kaminario_flocker_driver.benchmark import replay
+from kaminario_flocker_driver.benchmark.fakes import FakeK2Array
+from kaminario_flocker_driver.benchmark.lifecycle import GIB, \
+    build_driver, join_rescans
+from kaminario_flocker_driver.constants import TRACE_MESSAGE_TYPE
+
+
+class TraceReplayTest(unittest.TestCase):
+    """Tests for `replay.py`."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, "agent.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _capture(self):
+        """Run a small workload on a tracing driver, with a volume created
+        before the capture started, and log its traces."""
+        driver, _, _ = build_driver(FakeK2Array(seed=0), warm_up="False",
+                                    trace_operations="True")
+        existing = driver.create_volume(uuid4(), GIB).blockdevice_id
+        driver.attach_volume(existing, driver.compute_instance_id())
+        join_rescans()
+        messages = []
+        driver.tracer.sink = lambda trace: messages.append(
+            dict(trace, message_type=TRACE_MESSAGE_TYPE))
+        volume = driver.create_volume(uuid4(), GIB)
+        driver.attach_volume(volume.blockdevice_id,
+                             driver.compute_instance_id())
+        driver.get_device_path(volume.blockdevice_id)
+        driver.detach_volumes([volume.blockdevice_id, existing])
+        driver.destroy_volume(volume.blockdevice_id)
+        join_rescans()
+        with open(self.log, "w") as log_file:
+            log_file.write("not json\n")
+            log_file.write(json.dumps({"message_type": "other"}) + "\n")
+            for message in messages:
+                log_file.write(json.dumps(message) + "\n")
+        return messages
+
+    def test_traces_captured(self):
+        """Are arguments, result and host commands in the traces?"""
+        messages = self._capture()
+        self.assertEqual([m["operation"] for m in messages],
+                         ["create_volume", "attach_volume",
+                          "get_device_path", "detach_volumes",
+                          "destroy_volume"])
+        created = messages[0]
+        self.assertEqual(created["arguments"][1], GIB)
+        self.assertEqual(messages[1]["arguments"][0], created["result"])
+        self.assertTrue(messages[1]["requests"])
+        self.assertTrue(messages[3]["commands"])
+        self.assertIsNone(messages[4]["error"])
+        self.assertEqual(len(replay.load_traces([self.log])), 5)
+
+    def test_replay(self):
+        """Does a replay run every operation again without error?"""
+        self._capture()
+        traces = replay.load_traces([self.log])
+        replayed = replay.replay(traces, speed=10.0)
+        original = replay.summarize(traces)["operations"]
+        summary = replay.summarize(replayed)["operations"]
+        self.assertEqual(sorted(summary), sorted(original))
+        for operation, stats in summary.items():
+            self.assertEqual(stats["errors"], 0, operation)
+            self.assertEqual(stats["count"], original[operation]["count"])
+        self.assertEqual(
+            replay.compare({"replayed": replay.summarize(replayed)},
+                           {"replayed": replay.summarize(replayed)}, 20.0),
+            [])
+
+
+if __name__ == '__main__':
+    unittest.main()
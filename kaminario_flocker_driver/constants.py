@@ -14,3 +14,115 @@ VG_PREFIX = "K2FVG"  # Character limit for VG prefix is: 5 chars
 VOL_PREFIX = "K2F"  # Volume name prefix
 LEN_OF_DATASET_ID = 36  # Length of dataset id
 RETRIES = 5  # Retries count to add delay in krest calls to "Too many request"
+BUSY_MIN_DELAY = 1  # secs, first back off after a K2 "busy" answer
+BUSY_MAX_DELAY = 8  # secs, upper bound of the busy back off
+BULK_CONCURRENCY = 4  # Concurrent K2 connections used by bulk operations
+BULK_SEARCH_CHUNK = 100  # Volumes looked up per search in bulk operations
+PORTAL_REFRESH_INTERVAL = 300  # secs, between re-logins to K2 portals
+# Local record of the volumes attached to this node
+STATE_DB_PATH = "/var/lib/flocker/kaminario_flocker_driver.db"
+OPERATION_TIMEOUT = 300  # secs, deadline of one driver operation
+REQUEST_TIMEOUT = 60  # secs, upper bound of one K2 REST call
+COMMAND_TIMEOUT = 120  # secs, upper bound of one host command
+CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive K2 failures opening the circuit
+CIRCUIT_RESET_TIMEOUT = 30  # secs, before retrying an unavailable K2
+CAPACITY_REFRESH_INTERVAL = 30  # secs, between K2 free capacity lookups
+# secs, K2 round trip counting as one unit of load in volume placement
+PLACEMENT_LATENCY_UNIT = 0.05
+# Most K2 requests one warmed up operation may make against one array,
+# with the default settings, checked when tracing requests (warm_up
+# includes the connection time discovery of the API)
+REST_CALL_BUDGETS = {"warm_up": 4, "create_volume": 2, "attach_volume": 3,
+                     "get_device_path": 2, "list_volumes": 3,
+                     "detach_volume": 4, "destroy_volume": 3,
+                     "collect_stats": 2}
+# agent.yml options tuning the open-iscsi node records of the K2 targets,
+# with the node record parameter each one sets before login
+ISCSI_NODE_SETTINGS = (
+    ("iscsi_sessions_per_portal", "node.session.nr_sessions"),
+    ("iscsi_queue_depth", "node.session.queue_depth"),
+    ("iscsi_cmds_max", "node.session.cmds_max"),
+    ("iscsi_replacement_timeout", "node.session.timeo.replacement_timeout"),
+    ("iscsi_first_burst_length", "node.session.iscsi.FirstBurstLength"),
+    ("iscsi_max_burst_length", "node.session.iscsi.MaxBurstLength"),
+    ("iscsi_max_recv_data_segment_length",
+     "node.conn[0].iscsi.MaxRecvDataSegmentLength"),
+    ("iscsi_header_digest", "node.conn[0].iscsi.HeaderDigest"),
+    ("iscsi_data_digest", "node.conn[0].iscsi.DataDigest"),
+)
+# Node record parameters shown for live sessions by
+# "iscsiadm -m session -P 2", with the field showing them
+ISCSI_SESSION_FIELDS = {
+    "node.session.timeo.replacement_timeout": "Recovery Timeout",
+    "node.session.iscsi.FirstBurstLength": "FirstBurstLength",
+    "node.session.iscsi.MaxBurstLength": "MaxBurstLength",
+    "node.conn[0].iscsi.MaxRecvDataSegmentLength":
+        "MaxRecvDataSegmentLength",
+    "node.conn[0].iscsi.HeaderDigest": "HeaderDigest",
+    "node.conn[0].iscsi.DataDigest": "DataDigest",
+}
+MULTIPATH_CONF = "/etc/multipath.conf"
+# Recommended multipath.conf device settings for K2 LUNs
+MULTIPATH_K2_SETTINGS = (
+    ("path_grouping_policy", "multibus"),
+    ("path_selector", "queue-length 0"),
+    ("path_checker", "tur"),
+    ("failback", "immediate"),
+    ("no_path_retry", "fail"),
+    ("fast_io_fail_tmo", "2"),
+    ("dev_loss_tmo", "3"),
+)
+# agent.yml options overriding a recommended K2 multipath setting
+MULTIPATH_OPTIONS = (
+    ("multipath_path_selector", "path_selector"),
+    ("multipath_no_path_retry", "no_path_retry"),
+    ("multipath_fast_io_fail_tmo", "fast_io_fail_tmo"),
+)
+# Block queue settings (/sys/block/<dev>/queue/<attribute>) applied to the
+# multipath device of an attached K2 volume and to each of its paths
+QUEUE_PROFILES = {
+    "oltp": (("scheduler", "none"), ("nr_requests", "256"),
+             ("read_ahead_kb", "0"), ("max_sectors_kb", "256")),
+    "balanced": (("scheduler", "none"), ("nr_requests", "256"),
+                 ("read_ahead_kb", "128"), ("max_sectors_kb", "512")),
+    "analytics": (("scheduler", "mq-deadline"), ("nr_requests", "1024"),
+                  ("read_ahead_kb", "4096"), ("max_sectors_kb", "1024")),
+}
+QUEUE_PROFILE = "off"  # Profile of volumes created without one
+# Flocker's mandatory storage profiles, by the queue profile serving them
+PROFILE_ALIASES = {"gold": "oltp", "silver": "balanced",
+                   "bronze": "analytics"}
+# Queue attributes a profile may set
+QUEUE_ATTRIBUTES = ("scheduler", "nr_requests", "read_ahead_kb",
+                    "max_sectors_kb", "rq_affinity", "nomerges",
+                    "add_random")
+# Legacy (single queue) kernel names of the blk-mq schedulers
+SCHEDULER_FALLBACKS = {"none": "noop", "mq-deadline": "deadline"}
+STATS_INTERVAL = 60  # secs, between K2 volume statistics collections
+METRICS_ADDRESS = "127.0.0.1"  # the metrics are only served locally
+# K2 volume statistics (stats/volumes) exported per dataset, with the
+# gauge each one feeds and the factor converting it to the gauge's unit
+VOLUME_STATS_FIELDS = (
+    ("iops_avg", "kaminario_volume_iops", 1,
+     "Average I/O operations per second of the volume on the K2"),
+    ("throughput_avg", "kaminario_volume_throughput_bytes", 1024,
+     "Average throughput of the volume on the K2, in bytes per second"),
+    ("latency_avg", "kaminario_volume_latency_seconds", 1e-6,
+     "Average I/O latency of the volume on the K2"),
+)
+VOLUMES_PER_GROUP = 1  # Volumes per volume group, 1 for one per dataset
+# Operation profiles, one sub directory per operation type
+PROFILE_DIR = "/var/lib/flocker/kaminario_flocker_driver_profiles"
+# Operations are profiled while this file exists
+PROFILE_FLAG_FILE = "/var/lib/flocker/kaminario_flocker_driver.profile"
+PROFILE_SAMPLE_RATE = 0.1  # Fraction of the operations profiled
+PROFILE_RING_SIZE = 20  # Profiles kept per operation type
+GC_INTERVAL = 0  # secs, between orphan collections, 0 to collect on demand
+GC_MAX_DELETIONS = 10  # Orphans removed per collection, the rest wait
+# Order orphans are removed in: multipath maps before their paths
+GC_KINDS = ("multipath", "device", "volume_group", "host")
+# secs, with destroy_host, a host is deleted once it had no volumes mapped
+# for this long
+HOST_GRACE_PERIOD = 300
+# Eliot message type of the structured operation traces
+TRACE_MESSAGE_TYPE = "flocker:node:agents:blockdevice:k2storagecenter:trace"
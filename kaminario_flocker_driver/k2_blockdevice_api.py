@@ -1,8 +1,12 @@
 """ This is k2_blockdevice_api docstring """
+import functools
 import logging
 import platform
 import uuid
 import threading
+import time
+import Queue
+from collections import namedtuple
 import bitmath
 from flocker.node.agents import blockdevice
 from zope.interface import implementer
@@ -10,11 +14,31 @@ from twisted.python import filepath
 from kaminario_flocker_driver.utils.k2_api_client import K2StorageCenterApi, \
     StorageDriverAPIException, InvalidDataException, ImproperConfigurationError
 from kaminario_flocker_driver.constants import UNLIMITED_QUOTA, \
-    VG_PREFIX, VOL_PREFIX, LEN_OF_DATASET_ID, RETRIES
+    VG_PREFIX, VOL_PREFIX, RETRIES, BULK_CONCURRENCY, \
+    BULK_SEARCH_CHUNK, PORTAL_REFRESH_INTERVAL, STATE_DB_PATH, \
+    OPERATION_TIMEOUT, REQUEST_TIMEOUT, COMMAND_TIMEOUT, \
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, ISCSI_NODE_SETTINGS, \
+    MULTIPATH_K2_SETTINGS, MULTIPATH_OPTIONS, QUEUE_PROFILES, QUEUE_PROFILE, \
+    PROFILE_ALIASES, QUEUE_ATTRIBUTES, STATS_INTERVAL, VOLUME_STATS_FIELDS, \
+    VOLUMES_PER_GROUP, PROFILE_DIR, PROFILE_FLAG_FILE, PROFILE_SAMPLE_RATE, \
+    PROFILE_RING_SIZE, GC_INTERVAL, GC_MAX_DELETIONS, GC_KINDS, \
+    HOST_GRACE_PERIOD, ITERATION_LIMIT, TRACE_MESSAGE_TYPE, METRICS_ADDRESS
+from kaminario_flocker_driver.utils.state_store import open_state_store
+from kaminario_flocker_driver.utils.array_router import ArrayRouter, K2Array
+from kaminario_flocker_driver.utils.resilience import deadline_scope
+from kaminario_flocker_driver.utils.call_trace import CallTracer, \
+    current_trace, trace_scope
+from kaminario_flocker_driver.utils.metrics import MetricsRegistry, \
+    serve_metrics
+from kaminario_flocker_driver.utils.profiling import OperationProfiler
 import eliot
 
 LOG = logging.getLogger(__name__)
 
+# Outcome of one dataset in a bulk operation, ``error`` is None on success
+BulkVolumeResult = namedtuple(
+    'BulkVolumeResult', ['dataset_id', 'blockdevice_id', 'volume', 'error'])
+
 
 class K2BlockDriverLogHandler(logging.Handler):
     """Python log handler to route to Eliot logging."""
@@ -31,6 +55,49 @@ class K2BlockDriverLogHandler(logging.Handler):
             message=msg).write()
 
 
+def write_trace(trace):
+    """Write a finished operation trace to the Eliot log.
+
+    :param trace: The ``OperationTrace.to_dict()`` of the operation.
+    """
+    eliot.Message.new(message_type=TRACE_MESSAGE_TYPE, **trace).write()
+
+
+def driver_operation(name, journal=False, bounded=True):
+    """Run a driver method as one operation.
+
+    The method runs under the driver's ``operation_timeout`` deadline,
+    which bounds its K2 requests and host commands, and its K2 requests
+    and host commands are traced, along with its arguments and result,
+    when the driver traces requests; a sample of the
+    operations is profiled while profiling is on. With ``journal`` the
+    ``(self, blockdevice_id, ...)`` method is also recorded in the local
+    state store for as long as it runs.
+
+    :param name: Name of the operation.
+    :param journal: Whether to journal the operation.
+    :param bounded: Whether the operation as a whole has a deadline; bulk
+        operations bound every dataset instead.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            timeout = self.operation_timeout if bounded else None
+            outer = current_trace()
+            with trace_scope(name, self.tracer, args, kwargs) as trace, \
+                    deadline_scope(timeout), self.profiler.profile(name):
+                if not journal:
+                    result = func(self, *args, **kwargs)
+                else:
+                    with self.state.operation(name, args[0]):
+                        result = func(self, *args, **kwargs)
+                if trace is not None and trace is not outer:
+                    trace.set_result(result)
+                return result
+        return wrapper
+    return decorator
+
+
 def instantiate_driver_instance(cluster_id, **config):
     """Instantiate a new K2 Block device driver instance.
 
@@ -47,7 +114,8 @@ def instantiate_driver_instance(cluster_id, **config):
     return K2BlockDeviceAPI(**config)
 
 
-@implementer(blockdevice.IBlockDeviceAPI)
+@implementer(blockdevice.IBlockDeviceAPI,
+             blockdevice.IProfiledBlockDeviceAPI)
 class K2BlockDeviceAPI(object):
     """Block device driver for Kaminario (K2) Storage device.
     A "IBlockDeviceAPI" for interacting with Storage Center
@@ -56,22 +124,107 @@ class K2BlockDeviceAPI(object):
     def __init__(self, **kwargs):
         """Initialize new instance of the driver.
 
-        :param config: The driver configuration settings
-        such as host, port, username, password.
+        The agent.yml options are described in README.md.
+
         :param cluster_id: The cluster ID is running.
+        :param api_client: A ``K2StorageCenterApi`` to use instead of one
+         built from the connection settings (used by the benchmark suite).
         :param is_dedup: The flag to be set for dedup activation.
-        :param destroy_host: The flag to set for destroying host if none of the
-         volume is mapped
+        :param destroy_host: The flag to remove this node's unused host.
+        :param host_grace_period: Seconds before an unused host is removed.
+        :param warm_up: The flag to prepare the driver in the background.
+        :param state_db: Path of the local state store, empty to disable.
+        :param operation_timeout: Deadline in seconds of one operation.
+        :param request_timeout: Upper bound in seconds of one K2 request.
+        :param command_timeout: Upper bound in seconds of one host command.
+        :param circuit_failure_threshold: Failures before failing fast.
+        :param circuit_reset_timeout: Seconds of failing fast.
+        :param cluster_scoped_listing: The flag to list this cluster only.
+        :param iscsi_*: open-iscsi settings of the K2 targets.
+        :param multipath_policy: ``check``, ``apply`` or ``off``.
+        :param multipath_*: Settings of the K2 multipath.conf section.
+        :param queue_profile: Block queue profile of volumes without one.
+        :param queue_profiles: Extra block queue profiles.
+        :param volumes_per_group: Volumes sharing a volume group.
+        :param metrics_port: TCP port serving the driver metrics.
+        :param metrics_address: Address the metrics are served on.
+        :param metrics_textfile: node_exporter textfile of the metrics.
+        :param stats_interval: Seconds between K2 statistics collections.
+        :param gc_interval: Seconds between orphan collections.
+        :param gc_dry_run: The flag to only report the orphans found.
+        :param gc_max_deletions: Orphans removed per collection.
+        :param trace_requests: The flag to record the K2 requests.
+        :param trace_operations: The flag to log operation traces.
+        :param profile_operations: The flag to profile from the start.
+        :param profile_sample_rate: Fraction of the operations profiled.
+        :param profile_dir: Directory of the profiles.
+        :param profile_ring_size: Profiles kept per operation type.
+        :param profile_flag_file: Profiling is on while this file exists.
+        :param arrays: A list of K2 arrays, each with its own settings.
         """
         self.cluster_id = kwargs.get('cluster_id')
         self.instance_name = None
-        self.api_client = K2StorageCenterApi(kwargs['storage_host'],
-                                             kwargs['username'],
-                                             kwargs['password'],
-                                             kwargs.get('is_ssl', False),
-                                             kwargs.get('retries', RETRIES))
-        # Created single instance of krest
-        self.krest = self.api_client.connect_to_api()
+        # State recorded before this is left over from a previous run
+        self.started = time.time()
+        self.bulk_concurrency = int(kwargs.get('bulk_concurrency',
+                                               BULK_CONCURRENCY))
+        self.arrays = ArrayRouter([self._build_array(settings)
+                                   for settings in self._array_settings(
+                                       kwargs)])
+        # Host side utilities (iSCSI, multipath) go through the primary
+        # array client
+        self.api_client = self.arrays.primary.api_client
+        self._initiator_iqn = None
+        self.ready = threading.Event()
+        self.warm_up_error = None
+        trace_operations = self.api_client.is_true(
+            kwargs.get('trace_operations', False))
+        self.tracer = CallTracer(
+            sink=write_trace if trace_operations else None) \
+            if trace_operations or self.api_client.is_true(
+                kwargs.get('trace_requests', False)) else None
+        self.state = open_state_store(kwargs.get('state_db', STATE_DB_PATH))
+        self.profiler = OperationProfiler(
+            kwargs.get('profile_dir', PROFILE_DIR),
+            float(kwargs.get('profile_sample_rate', PROFILE_SAMPLE_RATE)),
+            int(kwargs.get('profile_ring_size', PROFILE_RING_SIZE)),
+            self.api_client.is_true(kwargs.get('profile_operations',
+                                               False)),
+            kwargs.get('profile_flag_file', PROFILE_FLAG_FILE))
+        self.profiler.install_signal()
+        self.operation_timeout = float(kwargs.get('operation_timeout',
+                                                  OPERATION_TIMEOUT))
+        self.api_client.command_timeout = float(
+            kwargs.get('command_timeout', COMMAND_TIMEOUT))
+        self.api_client.iscsi_node_settings = tuple(
+            (parameter, kwargs[option])
+            for option, parameter in ISCSI_NODE_SETTINGS
+            if kwargs.get(option) not in (None, ''))
+        self.iscsi_mismatches = []
+        self.multipath_policy = kwargs.get('multipath_policy', 'check')
+        if self.multipath_policy not in ('check', 'apply', 'off'):
+            raise ImproperConfigurationError(
+                "'multipath_policy' attribute in agent.yml file must be "
+                "check, apply or off.")
+        overrides = dict((setting, kwargs[option])
+                         for option, setting in MULTIPATH_OPTIONS
+                         if kwargs.get(option) not in (None, ''))
+        self.multipath_settings = [(setting, overrides.get(setting, value))
+                                   for setting, value in MULTIPATH_K2_SETTINGS]
+        self.multipath_drift = None
+        self._multipath_lock = threading.Lock()
+        self.queue_profiles = self._queue_profiles(
+            kwargs.get('queue_profiles'))
+        self.queue_profile = kwargs.get('queue_profile', QUEUE_PROFILE)
+        if self.queue_profile != 'off' and \
+                self._profile_settings(self.queue_profile) is None:
+            raise ImproperConfigurationError(
+                "'queue_profile' attribute in agent.yml file must be off or "
+                "one of {}.".format(", ".join(sorted(self.queue_profiles))))
+        # blockdevice_id -> queue settings, device path and the kernel
+        # devices already tuned, of the volumes attached to this node
+        self._queue_tuning = {}
+        self._queue_lock = threading.Lock()
         self.is_dedup = kwargs.get("is_dedup")
         if self.is_dedup:
             self.is_dedup = self.api_client.is_true(
@@ -80,10 +233,571 @@ class K2BlockDeviceAPI(object):
             raise ImproperConfigurationError(
                 "'is_dedup' attribute is not set in agent.yml file.")
 
+        # Driver-created volume groups and volumes carry this tag in their
+        # description
+        self.cluster_tag = self.api_client.encode_tag(
+            cluster=self.cluster_id)
+        self.cluster_scoped_listing = self.api_client.is_true(
+            kwargs.get('cluster_scoped_listing', False))
+        self.volumes_per_group = int(kwargs.get('volumes_per_group',
+                                                VOLUMES_PER_GROUP))
+        if self.volumes_per_group < 1:
+            raise ImproperConfigurationError(
+                "'volumes_per_group' attribute in agent.yml file must be "
+                "at least 1.")
+        # (array name, pack) -> shared volume group being filled and its
+        # number of volumes
+        self._groups = {}
+        self._group_lock = threading.Lock()
+
         self.destroy_host = kwargs.get('destroy_host', False)
         if self.destroy_host:
             self.destroy_host = self.api_client.is_true(
                 self.destroy_host)
+        self.host_grace_period = float(kwargs.get('host_grace_period',
+                                                  HOST_GRACE_PERIOD))
+
+        # K2 statistics of the cluster's volumes, by dataset id
+        self.volume_stats = {}
+        self.metrics = MetricsRegistry()
+        for _, name, _, help_text in VOLUME_STATS_FIELDS:
+            self.metrics.describe(name, help_text)
+        self.metrics_textfile = kwargs.get('metrics_textfile')
+        self.metrics_server = None
+        if kwargs.get('metrics_port') not in (None, ''):
+            self.metrics_server = serve_metrics(
+                self.metrics, int(kwargs['metrics_port']),
+                kwargs.get('metrics_address', METRICS_ADDRESS))
+        self.stats_interval = float(kwargs.get('stats_interval',
+                                               STATS_INTERVAL))
+        if (self.metrics_server or self.metrics_textfile) and \
+                self.stats_interval > 0:
+            stats_thread = threading.Thread(target=self._collect_stats_loop)
+            stats_thread.name = 'k2_stats'
+            stats_thread.daemon = True
+            stats_thread.start()
+
+        self.gc_interval = float(kwargs.get('gc_interval', GC_INTERVAL))
+        self.gc_dry_run = self.api_client.is_true(kwargs.get('gc_dry_run',
+                                                             False))
+        self.gc_max_deletions = int(kwargs.get('gc_max_deletions',
+                                               GC_MAX_DELETIONS))
+        # Orphans found by the last collection, removed if found again
+        self._gc_candidates = set()
+        self._gc_lock = threading.Lock()
+        self.gc_report = None
+        if self.gc_interval > 0:
+            gc_thread = threading.Thread(target=self._collect_garbage_loop)
+            gc_thread.name = 'k2_gc'
+            gc_thread.daemon = True
+            gc_thread.start()
+
+        if self.api_client.is_true(kwargs.get('warm_up', True)):
+            warm_up_thread = threading.Thread(target=self.warm_up)
+            warm_up_thread.name = 'k2_warm_up'
+            warm_up_thread.daemon = True
+            warm_up_thread.start()
+        else:
+            try:
+                self.reconcile()
+            except Exception as e:
+                LOG.exception('Unable to reconcile the local state: %s', e)
+            self.ready.set()
+
+    @staticmethod
+    def _array_settings(config):
+        """Settings of every configured array, top level settings
+        filling in what an array does not set."""
+        arrays = config.get('arrays')
+        if not arrays:
+            return [config]
+        if not isinstance(arrays, (list, tuple)):
+            raise ImproperConfigurationError(
+                "'arrays' attribute in agent.yml file must be a list.")
+        defaults = dict((key, value) for key, value in config.items()
+                        if key not in ('arrays', 'api_client', 'name'))
+        settings = []
+        for array in arrays:
+            merged = dict(defaults)
+            merged.update(array)
+            settings.append(merged)
+        return settings
+
+    @staticmethod
+    def _queue_profiles(profiles):
+        """The built in block queue profiles, with those of agent.yml.
+
+        :param profiles: A dict of profile name to a dict of queue
+            attribute to value, or None.
+        :return: A dict of profile name to a tuple of ``(attribute,
+            value)``, scheduler first as changing it resets nr_requests.
+        """
+        result = dict(QUEUE_PROFILES)
+        for name, settings in (profiles or {}).items():
+            unknown = set(settings) - set(QUEUE_ATTRIBUTES)
+            if unknown:
+                raise ImproperConfigurationError(
+                    "Unknown queue attributes {} in profile {}.".format(
+                        ", ".join(sorted(unknown)), name))
+            result[name] = tuple(
+                (attribute, str(settings[attribute]))
+                for attribute in QUEUE_ATTRIBUTES if attribute in settings)
+        return result
+
+    def _build_array(self, settings):
+        """Create the ``K2Array`` of one array's settings."""
+        api_client = settings.get('api_client')
+        if api_client is None:
+            try:
+                api_client = K2StorageCenterApi(settings['storage_host'],
+                                                settings['username'],
+                                                settings['password'],
+                                                settings.get('is_ssl', False),
+                                                settings.get('retries',
+                                                             RETRIES))
+            except KeyError as e:
+                raise ImproperConfigurationError(
+                    "{} attribute is not set for K2 array in agent.yml "
+                    "file.".format(e))
+        api_client.request_timeout = float(
+            settings.get('request_timeout', REQUEST_TIMEOUT))
+        api_client.breaker.failure_threshold = int(
+            settings.get('circuit_failure_threshold',
+                         CIRCUIT_FAILURE_THRESHOLD))
+        api_client.breaker.reset_timeout = float(
+            settings.get('circuit_reset_timeout', CIRCUIT_RESET_TIMEOUT))
+        name = settings.get('name') or api_client.host
+        return K2Array(name, api_client, self.bulk_concurrency)
+
+    @property
+    def krest(self):
+        """The K2 API connection of the primary array, opened on first
+        use."""
+        return self.arrays.primary.krest
+
+    @property
+    def initiator_iqn(self):
+        """The iSCSI initiator name of this node."""
+        if self._initiator_iqn is None:
+            self._initiator_iqn = self.api_client.get_initiator_name()
+        return self._initiator_iqn
+
+    def warm_up(self):
+        """Prepare the driver for its first operation.
+
+        Connects to the arrays, resolves the K2 host of this node and logs
+        in to all the array portals, so the first attach does not pay for
+        it. ``ready`` is set once done, even if a step failed; failures
+        are kept in ``warm_up_error`` and retried by the operations.
+        """
+        start = time.time()
+        try:
+            with trace_scope('warm_up', self.tracer), \
+                    deadline_scope(self.operation_timeout):
+                self._check_multipath()
+                for array in self.arrays:
+                    self._resolve_host(self.compute_instance_id(),
+                                       create=False, array=array)
+                    self._login_portals(array)
+                self.reconcile()
+            LOG.info('K2 driver warmed up in %.2fs', time.time() - start)
+        except Exception as e:
+            self.warm_up_error = e
+            LOG.exception('K2 driver warm-up failed: %s', e)
+        finally:
+            self.ready.set()
+
+    def is_ready(self):
+        """Whether the background warm-up has completed."""
+        return self.ready.is_set()
+
+    def _check_multipath(self):
+        """Compare, once, the multipath policy of K2 LUNs on this node with
+        the recommended one, applying it if configured to.
+
+        The differences found are kept in ``multipath_drift``.
+        """
+        with self._multipath_lock:
+            if self.multipath_policy == 'off' or \
+                    self.multipath_drift is not None:
+                return
+            drift = self.api_client.multipath_drift(self.multipath_settings)
+            for difference in drift:
+                LOG.warning('K2 multipath policy drift: %s', difference)
+            if drift and self.multipath_policy == 'apply':
+                self.api_client.apply_multipath_policy(
+                    self.multipath_settings)
+                drift = self.api_client.multipath_drift(
+                    self.multipath_settings)
+            self.multipath_drift = drift
+
+    def collect_stats(self):
+        """Collect the K2 performance counters of this cluster's volumes.
+
+        Per array, the tagged volumes are listed and their counters read
+        with one batched ``stats/volumes`` search, then the metrics are
+        updated, keyed by dataset id.
+
+        :return: A dict of dataset id to a dict of gauge name to value.
+        """
+        stats = {}
+        samples = dict((name, []) for _, name, _, _ in VOLUME_STATS_FIELDS)
+        with trace_scope('collect_stats', self.tracer):
+            for array in self.arrays:
+                volumes = list(array.krest.search(
+                    "volumes", description__contains=self.cluster_tag))
+                counters = array.api_client.volume_stats(array.krest,
+                                                         volumes)
+                for volume in volumes:
+                    dataset_id = self.api_client.dataset_id_of(volume.name)
+                    if dataset_id is None or volume.id not in counters:
+                        continue
+                    labels = {"dataset_id": dataset_id,
+                              "blockdevice_id": volume.scsi_sn,
+                              "array": array.name}
+                    values = stats[dataset_id] = {}
+                    for field, name, scale, _ in VOLUME_STATS_FIELDS:
+                        values[name] = counters[volume.id][field] * scale
+                        samples[name].append((labels, values[name]))
+        for name, metric_samples in samples.items():
+            self.metrics.replace(name, metric_samples)
+        self.volume_stats = stats
+        if self.metrics_textfile:
+            self.metrics.write_textfile(self.metrics_textfile)
+        return stats
+
+    def _collect_stats_loop(self):
+        """Collect the volume statistics every ``stats_interval``."""
+        self.ready.wait()
+        while True:
+            try:
+                self.collect_stats()
+            except Exception as e:
+                LOG.warning('Unable to collect K2 volume statistics: %s', e)
+            time.sleep(self.stats_interval)
+
+    def collect_garbage(self, dry_run=None):
+        """Remove the driver-owned objects left behind by failed or
+        interrupted operations.
+
+        Orphans are this cluster's volume groups without volumes and this
+        node's host when it has no mappings and either no iqn (a failed
+        registration) or ``destroy_host`` is set, on every array, and the
+        ``sd`` paths and multipath maps of K2 LUNs no longer mapped to
+        this node. An orphan is only removed when found again by the next
+        collection, so the objects of operations in flight are left
+        alone, and at most ``gc_max_deletions`` are removed per
+        collection. Nothing is removed from a place that failed to list.
+
+        :param dry_run: Only report the orphans, ``gc_dry_run`` by default.
+        :return: A dict of the orphans ``removed`` (or that would be, on a
+            dry run), the new ``candidates`` waiting for the next
+            collection, the number ``deferred`` by the rate limit and the
+            ``errors``; also kept in ``gc_report``.
+        """
+        dry_run = self.gc_dry_run if dry_run is None else dry_run
+        orphans = {}
+        errors = []
+        with trace_scope('collect_garbage', self.tracer):
+            try:
+                orphans.update(self._orphaned_devices())
+            except Exception as e:
+                errors.append(u"{}: {}".format(self.compute_instance_id(),
+                                               e))
+            for array in self.arrays:
+                try:
+                    orphans.update(self._orphaned_array_objects(array))
+                except Exception as e:
+                    errors.append(u"{}: {}".format(array.name, e))
+            with self._gc_lock:
+                confirmed = sorted(
+                    (key for key in orphans if key in self._gc_candidates),
+                    key=lambda key: (GC_KINDS.index(key[0]), key))
+                candidates = sorted(set(orphans) - self._gc_candidates)
+                self._gc_candidates = set(orphans)
+                removed = []
+                for key in confirmed[:self.gc_max_deletions]:
+                    if not dry_run:
+                        try:
+                            orphans[key]()
+                        except Exception as e:
+                            errors.append(u"{} {}/{}: {}".format(
+                                key[0], key[1], key[2], e))
+                            continue
+                        self._gc_candidates.discard(key)
+                    removed.append(key)
+        report = {
+            "dry_run": dry_run,
+            "removed": [u"{} {}/{}".format(*key) for key in removed],
+            "candidates": [u"{} {}/{}".format(*key) for key in candidates],
+            "deferred": max(0, len(confirmed) - self.gc_max_deletions),
+            "errors": errors}
+        LOG.info('Garbage collection %s %d orphans, %d deferred, %d new '
+                 'candidates, %d errors',
+                 'found' if dry_run else 'removed', len(removed),
+                 report["deferred"], len(candidates), len(errors))
+        self.gc_report = report
+        return report
+
+    def _orphaned_devices(self):
+        """K2 ``sd`` paths and multipath maps of LUNs not mapped to this
+        node.
+
+        The devices are listed before the mappings: a device present
+        before the mappings are read belongs to a mapping made before,
+        so an attach in flight cannot be mistaken for an orphan. Volumes
+        with a journaled operation running are left alone as well.
+
+        :return: A dict of ``(kind, node, name)`` to a callable removing
+            the orphan.
+        """
+        devices = self.api_client.k2_devices()
+        maps = self.api_client.k2_multipath_maps()
+        mapped = set(blockdevice_id for _, _, blockdevice_id in
+                     self.state.pending_operations())
+        for array in self.arrays:
+            host = self._resolve_host(self.compute_instance_id(),
+                                      create=False, array=array)
+            if host is None:
+                continue
+            volume_ids = [unicode(self.api_client.ref_id(mapping, "volume"))
+                          for mapping in array.krest.search("mappings",
+                                                            host=host)]
+            for start in range(0, len(volume_ids), BULK_SEARCH_CHUNK):
+                mapped.update(volume.scsi_sn for volume in array.krest.search(
+                    "volumes", id=volume_ids[start:start + BULK_SEARCH_CHUNK],
+                    **{"__fields": "scsi_sn"}))
+        stale = set(name for name, ident in devices.items()
+                    if not any(scsi_sn in ident for scsi_sn in mapped))
+        node = self.compute_instance_id()
+        orphans = {}
+        for name, paths in maps.items():
+            if set(paths) <= stale:
+                orphans[("multipath", node, name)] = \
+                    lambda name=name: self.api_client.remove_multipath(
+                        u"/dev/mapper/{}".format(name))
+        for name in stale:
+            orphans[("device", node, name)] = \
+                lambda name=name: self._remove_scsi_device(name)
+        return orphans
+
+    def _remove_scsi_device(self, name):
+        """Remove a stale SCSI device of this node."""
+        if not self.api_client.remove_scsi_device(name):
+            raise StorageDriverAPIException(
+                'Unable to remove SCSI device {}'.format(name))
+
+    def _orphaned_array_objects(self, array):
+        """This cluster's empty volume groups and this node's unusable
+        host on an array.
+
+        :return: A dict of ``(kind, array name, name)`` to a callable
+            removing the orphan.
+        """
+        orphans = {}
+        cluster = self.api_client.decode_tag(self.cluster_tag).get("cluster")
+        groups = [group for group in array.krest.search(
+            "volume_groups", description__contains=self.cluster_tag)
+            if group.name.startswith(VG_PREFIX) and
+            self.api_client.decode_tag(group.description).get("cluster") ==
+            cluster] if cluster else []
+        used = set()
+        for start in range(0, len(groups), BULK_SEARCH_CHUNK):
+            used.update(
+                self.api_client.ref_id(volume, "volume_group")
+                for volume in array.krest.search(
+                    "volumes",
+                    volume_group=groups[start:start + BULK_SEARCH_CHUNK],
+                    **{"__fields": "volume_group"}))
+        for group in groups:
+            if group.id not in used:
+                orphans[("volume_group", array.name, group.name)] = \
+                    lambda group=group: self._remove_volume_group(array,
+                                                                  group)
+
+        hosts = array.krest.search("hosts", name=self.compute_instance_id())
+        if hosts.total > 0:
+            host = hosts.hits[0]
+            unused = array.krest.search("mappings", host=host,
+                                        **{"__limit": 1}).total == 0
+            registered = array.krest.search("host_iqns", host=host,
+                                            **{"__limit": 1}).total > 0
+            idle = array.host_idle_since
+            retiring = idle is not None and \
+                time.time() - idle < self.host_grace_period
+            if unused and not array.host_users and not retiring and \
+                    (not registered or self.destroy_host):
+                orphans[("host", array.name, host.name)] = \
+                    lambda: self._remove_host(array, host)
+        return orphans
+
+    def _remove_volume_group(self, array, group):
+        """Delete an orphaned volume group, dropping it from the shared
+        group cache."""
+        array.krest.delete(group)
+        pack = self.api_client.decode_tag(group.description).get("pack")
+        if pack is not None:
+            self._forget_volume_group(array, pack, group)
+
+    def _remove_host(self, array, host):
+        """Delete this node's orphaned host, dropping the cached one."""
+        with array.host_lock:
+            if array.host_users:
+                raise StorageDriverAPIException(
+                    'Host {} is being mapped'.format(host.name))
+            host.delete()
+            if array.host is not None and array.host.id == host.id:
+                array.host = None
+                array.host_users = None
+                array.host_idle_since = None
+                self._cancel_retire(array)
+
+    def _collect_garbage_loop(self):
+        """Collect the orphans every ``gc_interval``."""
+        self.ready.wait()
+        while True:
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                LOG.warning('Unable to collect orphaned objects: %s', e)
+            time.sleep(self.gc_interval)
+
+    def call_report(self):
+        """K2 requests made per operation, see ``CallTracer.report``.
+
+        :return: The report, or None unless ``trace_requests`` is set.
+        """
+        return self.tracer.report() if self.tracer is not None else None
+
+    def _mapped_to_node(self, blockdevice_id):
+        """Look a volume's mapping up on the array.
+
+        :return: ``(array, mapping)``, the mapping krest object being None
+            unless the volume is mapped to this node's host.
+        """
+        array, volume = self.arrays.find_volume(blockdevice_id)
+        if volume is None:
+            return None, None
+        mapped = array.krest.search("mappings", volume=volume)
+        host = self._resolve_host(self.compute_instance_id(), create=False,
+                                  array=array)
+        if mapped.total == 0 or host is None:
+            return array, None
+        mapped_host = self.api_client.rgetattr(mapped.hits[0], "host", None)
+        return array, mapped.hits[0] if mapped_host == host else None
+
+    def reconcile(self):
+        """Bring the local state store in line with the arrays.
+
+        Run on start up, possibly while the first operations are served,
+        so only state left by a previous run of the driver is looked at.
+        Attachments whose mapping is gone (the volume was moved or
+        detached while the driver was down) have their multipath device
+        removed and are forgotten, using a single search of this node's
+        mappings per array. Operations interrupted by a crash are resumed:
+        an attach or move whose mapping exists gets its rescan, a detach
+        whose mapping still exists is completed.
+        """
+        attachments = self.state.attachments(before=self.started)
+        pending = self.state.pending_operations(before=self.started)
+        if not attachments and not pending:
+            return
+        LOG.info('Reconciling %d attachments and %d interrupted operations',
+                 len(attachments), len(pending))
+        mapping_ids = {}
+        for array in set(self.arrays.get(attachment['array'])
+                         for attachment in attachments):
+            host = self._resolve_host(self.compute_instance_id(),
+                                      create=False, array=array)
+            mapping_ids[array.name] = set()
+            if host is not None:
+                mapping_ids[array.name] = set(
+                    mapping.id for mapping in
+                    array.krest.search("mappings", host=host).hits)
+        for attachment in attachments:
+            blockdevice_id = attachment['blockdevice_id']
+            array = self.arrays.get(attachment['array'])
+            if attachment['mapping_id'] in mapping_ids[array.name]:
+                self.arrays.remember(blockdevice_id, array)
+                continue
+            # a live detach may have removed it since, or an attach
+            # recorded it again
+            if self.state.attachment(blockdevice_id) is None or \
+                    self._in_use(blockdevice_id):
+                continue
+            LOG.info('Volume %s is no longer mapped to this node',
+                     blockdevice_id)
+            self.api_client.remove_multipath(attachment['device_path'])
+            self.state.remove_attachment(blockdevice_id)
+
+        for entry_id, operation, blockdevice_id in pending:
+            try:
+                if self._in_use(blockdevice_id):
+                    LOG.info('Dropping interrupted %s of %s, superseded by '
+                             'a new operation', operation, blockdevice_id)
+                    continue
+                array, mapping = self._mapped_to_node(blockdevice_id)
+                if mapping is None:
+                    LOG.info('Dropping interrupted %s of %s', operation,
+                             blockdevice_id)
+                elif operation in ('attach_volume', 'move_volume'):
+                    LOG.info('Resuming interrupted attach of %s',
+                             blockdevice_id)
+                    self._record_attachment(array, blockdevice_id, mapping)
+                    self._watch_queues(
+                        blockdevice_id,
+                        self.api_client.rgetattr(mapping, "volume", None))
+                    self._iscsi_rescan('resume_attach', self._tune_queues)
+                elif operation == 'detach_volume':
+                    LOG.info('Resuming interrupted detach of %s',
+                             blockdevice_id)
+                    self.detach_volume(blockdevice_id)
+            except Exception as e:
+                LOG.exception('Unable to resume %s of %s: %s', operation,
+                              blockdevice_id, e)
+            finally:
+                self.state.finish(entry_id)
+
+    def _in_use(self, blockdevice_id):
+        """Whether this run of the driver has touched a volume: it has a
+        journaled operation in flight or recorded its attachment again."""
+        attachment = self.state.attachment(blockdevice_id)
+        if attachment is not None and attachment['updated'] >= self.started:
+            return True
+        old = set(entry_id for entry_id, _, _ in
+                  self.state.pending_operations(before=self.started))
+        return any(entry_id not in old and bid == blockdevice_id
+                   for entry_id, _, bid in self.state.pending_operations())
+
+    def _record_attachment(self, array, blockdevice_id, mapping):
+        """Record a mapping to this node in the local state store."""
+        volume = self.api_client.rgetattr(mapping, "volume", None)
+        host = self.api_client.rgetattr(mapping, "host", None)
+        dataset_id = self._return_to_block_device_volume(volume).dataset_id \
+            if volume is not None else None
+        self.state.record_attachment(
+            blockdevice_id, dataset_id=dataset_id,
+            host=self.api_client.rgetattr(host, "name", None),
+            mapping_id=mapping.id,
+            lun=self.api_client.rgetattr(mapping, "lun", None),
+            array=array.name)
+
+    def _device_paths(self, blockdevice_id):
+        """Local device paths of a volume attached to this node.
+
+        The path recorded in the local state store is used as long as it
+        still belongs to the volume, otherwise the devices are scanned.
+
+        :return: A list of paths, multipath device first.
+        """
+        attachment = self.state.attachment(blockdevice_id)
+        if attachment and self.api_client.device_matches(
+                attachment['device_path'], blockdevice_id):
+            return [attachment['device_path']]
+        paths = self.api_client.find_paths(blockdevice_id)
+        if paths and attachment:
+            self.state.set_device_path(blockdevice_id, paths[0])
+        return paths
 
     def _return_to_block_device_volume(self, volume, attached_to=None):
         """Converts K2 API volume to a `BlockDeviceVolume`.
@@ -93,24 +807,102 @@ class K2BlockDeviceAPI(object):
         K2 API returns SCSI Serial number(Page 0x80)(scsi_sn) as
         unique identification of volume.
         """
-        dataset_id = uuid.UUID('{00000000-0000-0000-0000-000000000000}')
-        try:
-            # volume name has a prefix and dataset_id
-            # Assumption: dataset id is of 36 chars.
-            dataset_id = uuid.UUID("{0}".
-                                   format(volume.name)[-LEN_OF_DATASET_ID:])
-        except ValueError:
-            pass
+        # volume name has a prefix and dataset_id
+        dataset_id = self.api_client.dataset_id_of(volume.name) or \
+            uuid.UUID('{00000000-0000-0000-0000-000000000000}')
         ret_val = blockdevice.BlockDeviceVolume(
             blockdevice_id=volume.scsi_sn,
-            size=int(self.api_client.kib_to_bytes(volume.size)),
+            size=self.api_client.kib_to_bytes(volume.size),
             attached_to=attached_to,
             dataset_id=dataset_id)
         return ret_val
 
-    def _iscsi_rescan(self, process):
-        """Performs a SCSI rescan on this host."""
-        rescan_thread = threading.Thread(target=self.api_client.rescan_iscsi)
+    def _queue_settings(self, volume):
+        """Block queue settings of a volume, from the profile in its tag.
+
+        :return: A tuple of ``(attribute, value)``, or None to leave the
+            queues of the volume alone.
+        """
+        tag = self.api_client.decode_tag(
+            self.api_client.rgetattr(volume, "description", None))
+        return self._profile_settings(tag.get("profile", self.queue_profile))
+
+    def _profile_settings(self, name):
+        """Queue settings of a profile, or of the queue profile serving a
+        Flocker profile not defined by that name; None if unknown."""
+        settings = self.queue_profiles.get(name)
+        if settings is None and name in PROFILE_ALIASES:
+            settings = self.queue_profiles.get(PROFILE_ALIASES[name])
+        return settings
+
+    def _watch_queues(self, blockdevice_id, volume, path=None):
+        """Have the block queues of an attached volume tuned by
+        ``_tune_queues``.
+
+        :param path: The device path of the volume, when known.
+        """
+        settings = self._queue_settings(volume)
+        with self._queue_lock:
+            entry = self._queue_tuning.get(blockdevice_id)
+            if settings is None:
+                self._queue_tuning.pop(blockdevice_id, None)
+                return
+            if entry is None or entry['settings'] != settings:
+                entry = self._queue_tuning[blockdevice_id] = {
+                    'settings': settings, 'path': None, 'tuned': set()}
+            if path is not None:
+                entry['path'] = path
+
+    def _tune_queues(self, blockdevice_ids=None):
+        """Apply the queue profile of attached volumes to their multipath
+        device and its paths.
+
+        Devices already tuned are skipped, so each call only writes to the
+        paths that appeared since the previous one.
+
+        :param blockdevice_ids: The volumes to tune, all watched volumes
+            by default.
+        """
+        with self._queue_lock:
+            for blockdevice_id, entry in self._queue_tuning.items():
+                if blockdevice_ids is not None and \
+                        blockdevice_id not in blockdevice_ids:
+                    continue
+                if entry['path'] is None:
+                    paths = self._device_paths(blockdevice_id)
+                    entry['path'] = paths[0] if paths else None
+                names = self.api_client.block_devices(entry['path'])
+                if not names:
+                    entry['path'] = None
+                    continue
+                for name in names:
+                    if name in entry['tuned']:
+                        continue
+                    refused = self.api_client.tune_block_queue(
+                        name, entry['settings'])
+                    if refused:
+                        LOG.warning('Queue settings %s refused by %s of %s',
+                                    refused, name, blockdevice_id)
+                    entry['tuned'].add(name)
+                    LOG.info('Tuned block queue of %s (%s)', name,
+                             blockdevice_id)
+
+    def _iscsi_rescan(self, process, after=None, scan=None):
+        """Performs a SCSI rescan on this host.
+
+        :param after: Called once the rescan is done.
+        :param scan: Called instead of a full rescan, to scan for some
+            devices only.
+        """
+        def rescan():
+            (scan or self.api_client.rescan_iscsi)()
+            if after is not None:
+                try:
+                    after()
+                except Exception as e:
+                    LOG.exception('Error after %s rescan: %s', process, e)
+
+        rescan_thread = threading.Thread(target=rescan)
         rescan_thread.name = '{0}_rescan'.format(process)
         rescan_thread.daemon = True
         rescan_thread.start()
@@ -139,13 +931,16 @@ class K2BlockDeviceAPI(object):
             self.instance_name = unicode(platform.uname()[1])
         return self.instance_name
 
-    def _create_new_host(self, attach_to):
+    def _create_new_host(self, attach_to, array=None):
         """Create a new host on K2 array
 
         :param attach_to: It is a hostname of node which is returned
             by "compute_instance_id" method.
+        :param array: The ``K2Array`` to create the host on, the primary
+            one by default.
         :return: new host
         """
+        array = array or self.arrays.primary
         # Currently host groups not supported.
         # Standalone host creation supported only
         # TODO: This is for host group creation
@@ -158,11 +953,184 @@ class K2BlockDeviceAPI(object):
         # host = self.krest.new("hosts", name=attach_to,
         #                 type=self.api_client.get_host_type,
         #                 host_group=hg).save()
-        host = self.krest.new("hosts", name=attach_to,
-                              type=self.api_client.host_type).save()
+        try:
+            host = array.krest.new("hosts", name=attach_to,
+                                   type=self.api_client.host_type).save()
+        except Exception:
+            # Another agent of this node may have created it meanwhile
+            existing = array.krest.search("hosts", name=attach_to)
+            if existing.total == 0:
+                raise
+            LOG.info("Host %s was created concurrently", attach_to)
+            return existing.hits[0]
         LOG.info("Created new host %s", host)
         return host
 
+    def _resolve_host(self, attach_to, create=True, array=None):
+        """Find, or create, the K2 host of this node.
+
+        The host is looked up through this node's iqn(iSCSI Qualified Name)
+        once per array and then cached. Concurrent callers wait for the
+        first one and share its host, so a burst of first attaches
+        creates a single host.
+
+        :param attach_to: It is a hostname of node which is returned
+            by "compute_instance_id" method.
+        :param create: Whether to create the host when none exists.
+        :param array: The ``K2Array`` to look on, the primary one by
+            default.
+        :return: The host krest object, or None if not found and not
+            created.
+        """
+        array = array or self.arrays.primary
+        with array.host_lock:
+            if array.host is not None:
+                return array.host
+            # Check for host which is associate with iqn
+            host_iqns = array.krest.search("host_iqns",
+                                           iqn=self.initiator_iqn)
+            host = self.api_client.rgetattr(host_iqns.hits[0], "host",
+                                            None) \
+                if host_iqns.total > 0 else None
+
+            # if iqn is not associate with any host
+            if not host:
+                if not create:
+                    return None
+                # searching instance or node host which is return
+                # by compute_instance_id method.
+                host = array.krest.search("hosts", name=attach_to)
+                if host.total > 0:
+                    raise InvalidDataException(
+                        'Present host is not mapped with iqn')
+                else:
+                    host = self._create_new_host(attach_to, array)
+                    if host_iqns.total > 0:
+                        self._map_host_with_iqn(host_iqns.hits[0], host)
+                    else:
+                        array.krest.new("host_iqns", iqn=self.initiator_iqn,
+                                        host=host).save()
+                        LOG.info("Added iqn %s to host %s",
+                                 self.initiator_iqn, attach_to)
+            array.host = host
+            return host
+
+    def _login_portals(self, array=None):
+        """Make sure this node is logged in to every portal of an array.
+
+        The portal list is looked up again, and all portals logged in to
+        again, every ``PORTAL_REFRESH_INTERVAL`` seconds. With iSCSI
+        settings configured, the live sessions are then checked against
+        them and any mismatch kept in ``iscsi_mismatches``.
+
+        :param array: The ``K2Array``, the primary one by default.
+        """
+        array = array or self.arrays.primary
+        with array.portal_lock:
+            now = time.time()
+            if array.portals_refreshed is not None and \
+                    now - array.portals_refreshed < PORTAL_REFRESH_INTERVAL:
+                return
+            portals = set()
+            ips = array.krest.search("system/net_ips")
+            for ip in ips.hits:
+                ip_address = self.api_client.rgetattr(ip, 'ip_address', None)
+                self.api_client.iscsi_login(ip_address, 3260)
+                portals.add(ip_address)
+            array.portals = portals
+            array.portals_refreshed = now
+            if self.api_client.iscsi_node_settings:
+                self.iscsi_mismatches = \
+                    self.api_client.verify_iscsi_sessions()
+        # New sessions bring new paths to the attached volumes
+        self._tune_queues()
+
+    def _claim_host(self, attach_to, array, users=1):
+        """Resolve this node's host for new mappings.
+
+        With ``destroy_host`` the host counts ``users`` more users, each
+        until its ``_release_host``, so it is not retired while the
+        mappings are made; the mappings it already has are counted on
+        first use.
+
+        :return: The host krest object.
+        """
+        while True:
+            host = self._resolve_host(attach_to, array=array)
+            if not self.destroy_host:
+                return host
+            with array.host_lock:
+                # Retired between the lookup and now, look it up again
+                if array.host is not host:
+                    continue
+                if array.host_users is None:
+                    array.host_users = array.krest.search(
+                        "mappings", host=host, **{"__limit": 1}).total
+                array.host_users += users
+                array.host_idle_since = None
+                self._cancel_retire(array)
+                return host
+
+    def _release_host(self, array, host):
+        """Count one user of this node's host less, a mapping removed or
+        an attach that failed, with ``destroy_host``.
+
+        A host left without users is retired once idle for
+        ``host_grace_period``.
+        """
+        if not self.destroy_host:
+            return
+        with array.host_lock:
+            if array.host_users is None:
+                array.host_users = array.krest.search(
+                    "mappings", host=host, **{"__limit": 1}).total
+            else:
+                array.host_users = max(0, array.host_users - 1)
+            if array.host_users > 0:
+                return
+            array.host_idle_since = time.time()
+            self._cancel_retire(array)
+            timer = array.host_retire = threading.Timer(
+                self.host_grace_period, self._retire_host, [array])
+        LOG.info('Host %s is idle, deleting it in %ss unless used', host.name,
+                 self.host_grace_period)
+        timer.name = 'k2_host_retire'
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def _cancel_retire(array):
+        """Cancel the pending deletion of this node's idle host, with
+        ``host_lock`` held."""
+        if array.host_retire is not None:
+            array.host_retire.cancel()
+            array.host_retire = None
+
+    def _retire_host(self, array):
+        """Delete this node's host if it is still idle after the grace
+        period and the array confirms it has no mappings."""
+        try:
+            with array.host_lock:
+                host = array.host
+                if host is None or array.host_idle_since is None or \
+                        time.time() - array.host_idle_since < \
+                        self.host_grace_period:
+                    return
+                mappings = array.krest.search("mappings", host=host,
+                                              **{"__limit": 1}).total
+                if mappings > 0:
+                    array.host_users = mappings
+                    array.host_idle_since = None
+                    return
+                host.delete()
+                array.host = None
+                array.host_users = None
+                array.host_idle_since = None
+                self._cancel_retire(array)
+            LOG.info('Deleted idle host %s', host.name)
+        except Exception as e:
+            LOG.warning('Unable to delete idle host of %s: %s', array.name, e)
+
     @staticmethod
     def _map_host_with_iqn(iqn_obj, host):
         """ Save or map the host with iqn.
@@ -177,46 +1145,282 @@ class K2BlockDeviceAPI(object):
         LOG.info("Saved iqn with host server")
         return host_iqns
 
-    def create_volume(self, dataset_id, size):
-        """Create a new volume on the K2 array.
+    def _run_bulk(self, func, items):
+        """Run ``func(krest, item, array)`` for every item, keeping up to
+        ``bulk_concurrency`` requests in flight.
 
+        Every item is processed through a connection of its own array's
+        pool.
+
+        :param func: Callable taking a krest end point, an item and the
+            ``K2Array`` of the item.
+        :param items: The ``(array, item)`` pairs to process.
+        :return: A list of ``(result, exception)`` in the order of items.
+        """
+        work = Queue.Queue()
+        for index, (array, item) in enumerate(items):
+            work.put((index, array, item))
+        results = [None] * len(items)
+        trace = current_trace()
+
+        def worker():
+            with trace_scope(trace):
+                process()
+
+        def process():
+            while True:
+                try:
+                    index, array, item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    krest = array.bulk_pool.acquire()
+                except Exception as e:
+                    results[index] = (None, e)
+                    continue
+                try:
+                    with deadline_scope(self.operation_timeout):
+                        results[index] = (func(krest, item, array), None)
+                except Exception as e:
+                    LOG.exception("Bulk operation failed for %s", item)
+                    results[index] = (None, e)
+                finally:
+                    array.bulk_pool.release(krest)
+
+        workers = []
+        for i in range(min(self.bulk_concurrency, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.name = 'bulk_{}'.format(i)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+        for thread in workers:
+            thread.join()
+        return results
+
+    def _create_volume(self, krest, dataset_id, size, profile=None,
+                       array=None):
+        """Create the volume group and volume of a dataset.
+
+        With ``volumes_per_group`` above 1 the volume goes in a volume
+        group shared with other volumes of its profile instead, the
+        ``pack`` field of its tag naming the group's profile.
+
+        :param krest: The krest end point to issue the requests through.
         :param dataset_id: The Flocker dataset ID for the volume.
         :param size: The size of the new volume in bytes.
+        :param profile: The storage profile kept in the tag of the volume
+            group and volume, None for the default one.
+        :param array: The ``K2Array`` of ``krest``, the primary one by
+            default.
         :return: A ``BlockDeviceVolume``
         """
+        array = array or self.arrays.primary
         sc_volume = {}
-        volume_group = u"{}-{}".format(VG_PREFIX, dataset_id)
+        pack = (profile or u"default") if self.volumes_per_group > 1 \
+            else None
+        tag = self.api_client.encode_tag(cluster=self.cluster_id,
+                                         profile=profile, pack=pack)
         volume_name = u"{}-{}".format(VOL_PREFIX, dataset_id)
         volume_size = self.api_client.bytes_to_kib(size)
         try:
-            sc_volume_group = self.krest.new("volume_groups",
-                                        name=volume_group,
-                                        quota=UNLIMITED_QUOTA,
-                                        is_dedup=self.is_dedup).save()
+            if pack is None:
+                sc_volume_group = krest.new(
+                    "volume_groups",
+                    name=u"{}-{}".format(VG_PREFIX, dataset_id),
+                    quota=UNLIMITED_QUOTA, is_dedup=self.is_dedup,
+                    description=tag).save()
+            else:
+                sc_volume_group = self._shared_volume_group(array, krest,
+                                                            pack)
         except Exception as e:
             raise StorageDriverAPIException('Error creating volume group:'
                                             ' {}'.format(e.message))
         if sc_volume_group:
             try:
-                sc_volume = self.krest.new("volumes",
+                sc_volume = krest.new("volumes",
                                       name=volume_name,
                                       size=volume_size,
-                                      volume_group=sc_volume_group).save()
+                                      volume_group=sc_volume_group,
+                                      description=tag).save()
             except Exception:
-                raise StorageDriverAPIException('Error creating volume.')
+                if pack is None:
+                    raise StorageDriverAPIException('Error creating volume.')
+                self._release_volume_group(array, pack, sc_volume_group)
+                if not self._volume_group_gone(krest, sc_volume_group):
+                    raise StorageDriverAPIException('Error creating volume.')
+                # The shared group was emptied and deleted meanwhile, try
+                # once more in another one
+                self._forget_volume_group(array, pack, sc_volume_group)
+                try:
+                    sc_volume_group = self._shared_volume_group(array, krest,
+                                                                pack)
+                except Exception as e:
+                    raise StorageDriverAPIException(
+                        'Error creating volume group: {}'.format(e.message))
+                try:
+                    sc_volume = krest.new(
+                        "volumes", name=volume_name, size=volume_size,
+                        volume_group=sc_volume_group,
+                        description=tag).save()
+                except Exception:
+                    self._release_volume_group(array, pack, sc_volume_group)
+                    raise StorageDriverAPIException('Error creating volume.')
         return self._return_to_block_device_volume(sc_volume)
 
+    def _shared_volume_group(self, array, krest, pack):
+        """A shared volume group with room for one more volume.
+
+        The group being filled is cached per array and pack. When it is
+        full, or none is cached yet, the array is asked for this
+        cluster's groups of the pack, so groups started by other nodes or
+        before a restart are filled first; a new group is created when
+        all are full. Concurrent creations on other nodes may take a
+        group slightly over ``volumes_per_group``.
+
+        :param array: The ``K2Array`` to place the volume on.
+        :param krest: The krest end point of ``array``.
+        :param pack: The profile the group is shared by.
+        :return: The volume group krest object.
+        """
+        key = (array.name, pack)
+        with self._group_lock:
+            entry = self._groups.get(key)
+            if entry is None or entry['count'] >= self.volumes_per_group:
+                entry = self._find_volume_group(krest, pack)
+                if entry is None:
+                    entry = {'group': krest.new(
+                        "volume_groups",
+                        name=u"{}-{}".format(VG_PREFIX, uuid.uuid4()),
+                        quota=UNLIMITED_QUOTA, is_dedup=self.is_dedup,
+                        description=self.api_client.encode_tag(
+                            cluster=self.cluster_id, pack=pack)).save(),
+                        'count': 0}
+                    LOG.info('Created shared volume group %s for %s',
+                             entry['group'].name, pack)
+                self._groups[key] = entry
+            entry['count'] += 1
+            return entry['group']
+
+    def _find_volume_group(self, krest, pack):
+        """This cluster's shared volume group of a pack with room left.
+
+        :return: A dict of the ``group`` and its volume ``count``, or None.
+        """
+        tag = self.api_client.encode_tag(cluster=self.cluster_id, pack=pack)
+        groups = [group for group in krest.search(
+            "volume_groups", description__contains=tag)
+            if self.api_client.decode_tag(group.description) ==
+            self.api_client.decode_tag(tag)]
+        if not groups:
+            return None
+        counts = dict((group.id, 0) for group in groups)
+        for volume in krest.search("volumes", volume_group=groups,
+                                   **{"__fields": "volume_group"}):
+            counts[self.api_client.ref_id(volume, "volume_group")] += 1
+        for group in groups:
+            if counts[group.id] < self.volumes_per_group:
+                return {'group': group, 'count': counts[group.id]}
+        return None
+
+    def _release_volume_group(self, array, pack, group):
+        """Give back the place taken in a shared volume group by a volume
+        that could not be created."""
+        with self._group_lock:
+            entry = self._groups.get((array.name, pack))
+            if entry is not None and entry['group'].id == group.id:
+                entry['count'] -= 1
+
+    @staticmethod
+    def _volume_group_gone(krest, group):
+        """Whether a volume group no longer exists on the array."""
+        try:
+            return krest.search("volume_groups", id=group.id).total == 0
+        except Exception as e:
+            LOG.warning('Unable to look volume group %s up: %s',
+                        group.id, e)
+            return False
+
+    def _forget_volume_group(self, array, pack, group):
+        """Drop a shared volume group from the cache."""
+        with self._group_lock:
+            entry = self._groups.get((array.name, pack))
+            if entry is not None and entry['group'].id == group.id:
+                del self._groups[(array.name, pack)]
+
+    @driver_operation('create_volume')
+    def create_volume(self, dataset_id, size):
+        """Create a new volume on the K2 array.
+
+        With several arrays the volume is placed on the one with the most
+        free capacity for its load.
+
+        :param dataset_id: The Flocker dataset ID for the volume.
+        :param size: The size of the new volume in bytes.
+        :return: A ``BlockDeviceVolume``
+        """
+        array = self.arrays.place(self.api_client.bytes_to_kib(size))
+        volume = self._create_volume(array.krest, dataset_id, size,
+                                     array=array)
+        self.arrays.remember(volume.blockdevice_id, array)
+        return volume
+
+    @driver_operation('create_volumes', bounded=False)
+    def create_volumes(self, volumes):
+        """Create many volumes on the K2 array.
+
+        The volume group and volume creations of the datasets are pipelined
+        over ``bulk_concurrency`` connections, paced down while the array
+        answers busy.
+
+        :param volumes: An iterable of ``(dataset_id, size)`` tuples.
+        :return: A list of ``BulkVolumeResult``, one per dataset, in order.
+        """
+        volumes = list(volumes)
+        LOG.info('Creating %d volumes', len(volumes))
+        placed = [self.arrays.place(self.api_client.bytes_to_kib(size))
+                  for _, size in volumes]
+        results = self._run_bulk(
+            lambda krest, volume, array: self._create_volume(
+                krest, *volume, array=array),
+            zip(placed, volumes))
+        for array, (volume, _) in zip(placed, results):
+            if volume is not None:
+                self.arrays.remember(volume.blockdevice_id, array)
+        return [BulkVolumeResult(
+            dataset_id=dataset_id,
+            blockdevice_id=volume.blockdevice_id if volume else None,
+            volume=volume, error=error)
+            for (dataset_id, _), (volume, error) in zip(volumes, results)]
+
+    @driver_operation('create_volume_with_profile')
     def create_volume_with_profile(self, dataset_id, size, profile_name=None):
         """Create a new volume on the array.
 
+        The profile is kept in the tag of the volume and chooses the block
+        queue settings applied once it is attached. Flocker's gold, silver
+        and bronze profiles are served by the oltp, balanced and analytics
+        queue profiles unless ``queue_profiles`` defines them; an unknown
+        profile gets the default one.
+
         :param dataset_id: The Flocker dataset ID for the volume.
         :param size: The size of the new volume in bytes.
         :param profile_name: The name of the storage profile for
                              this volume.
         :return: A ``BlockDeviceVolume``
         """
-        pass
+        profile = (profile_name or u"").lower() or None
+        if profile is not None and self._profile_settings(profile) is None:
+            LOG.warning('Unknown profile %s for dataset %s, using %s',
+                        profile_name, dataset_id, self.queue_profile)
+            profile = None
+        array = self.arrays.place(self.api_client.bytes_to_kib(size))
+        volume = self._create_volume(array.krest, dataset_id, size, profile,
+                                     array)
+        self.arrays.remember(volume.blockdevice_id, array)
+        return volume
 
+    @driver_operation('attach_volume', journal=True)
     def attach_volume(self, blockdevice_id, attach_to):
         """Attach an existing volume to an initiator (host).
 
@@ -232,41 +1436,44 @@ class K2BlockDeviceAPI(object):
         LOG.info('attaching to blockdevice_id %s and host is %s',
                  blockdevice_id, attach_to)
         # Searching for volume by scsi_sn via krest
-        volume = self.krest.search("volumes", scsi_sn=blockdevice_id)
-        if volume.total == 0:
+        array, volume = self.arrays.find_volume(blockdevice_id)
+        if volume is None:
             raise blockdevice.UnknownVolume(blockdevice_id)
 
-        # Check for host which is associate with iqn(iSCSI Qualified Name)
-        iqn = self.api_client.get_initiator_name()
-        host_iqns = self.krest.search("host_iqns", iqn=iqn)
-        host = self.api_client.rgetattr(host_iqns.hits[0], "host", None) \
-            if host_iqns.total > 0 else None
+        host = self._claim_host(attach_to, array)
+        try:
+            mapping = self._map_volume(array, blockdevice_id, volume, host)
+        except Exception:
+            self._release_host(array, host)
+            raise
+        self.state.record_attachment(
+            blockdevice_id,
+            dataset_id=self._return_to_block_device_volume(volume).dataset_id,
+            host=host.name, mapping_id=mapping.id,
+            lun=self.api_client.rgetattr(mapping, "lun", None),
+            array=array.name)
+        self._watch_queues(blockdevice_id, volume)
 
-        # if iqn is not associate with any host
-        if not host:
-            # searching instance or node host which is return
-            # by compute_instance_id method.
-            host = self.krest.search("hosts", name=attach_to)
-            if host.total > 0:
-                raise InvalidDataException(
-                    'Present host is not mapped with iqn')
-            else:
-                host = self._create_new_host(attach_to)
-                self._map_host_with_iqn(host_iqns.hits[0], host)
+        # start iscsi rescan, then tune the queues of the new devices
+        self._iscsi_rescan('attach', self._tune_queues)
 
+        return self._return_to_block_device_volume(volume, attach_to)
+
+    def _map_volume(self, array, blockdevice_id, volume, host):
+        """Map a volume to this node's host.
+
+        :return: The mapping krest object.
+        """
         # Make sure the server is logged in to the array
-        ips = self.krest.search("system/net_ips")
-        for ip in ips.hits:
-            self.api_client.iscsi_login(
-                self.api_client.rgetattr(ip, 'ip_address', None), 3260)
+        self._login_portals(array)
+        self._check_multipath()
 
         # Make sure we were able to find host
         if not host:
             raise InvalidDataException('Host does not exits')
 
-        volume = volume.hits[0]
         # First check if we are already mapped
-        mapped = self.krest.search('mappings', volume=volume)
+        mapped = array.krest.search('mappings', volume=volume)
 
         if mapped.total > 0:
             # Get the mapped host
@@ -279,18 +1486,242 @@ class K2BlockDeviceAPI(object):
         # Make sure host should not be associate with host group
         # Note: Currently host groups not supported.
         try:
-            mapping = self.krest.new("mappings", volume=volume, host=host)
+            mapping = array.krest.new("mappings", volume=volume, host=host)
             mapping.save()
             LOG.info("Mapping is done- %s", mapping)
         except Exception:
             raise StorageDriverAPIException(
                 'Unable to map volume to server.')
+        return mapping
 
-        # start iscsi rescan
-        self._iscsi_rescan('attach')
+    @driver_operation('move_volume', journal=True)
+    def move_volume(self, blockdevice_id, attach_to, from_host=None):
+        """Attach a volume to this node, taking it over from the node it
+        is attached to.
+
+        Meant for failover, once the other node is known to be dead or
+        fenced: its mapping is replaced by one to this node's host in one
+        pass, without waiting for a detach on that node, and only the new
+        LUN is scanned for, right away. The other node drops its stale
+        device later, when it detaches the volume, starts up or collects
+        garbage.
+
+        :param blockdevice_id: The unique identifier(scsi_sn of k2)
+            for the volume.
+        :param attach_to: It is a hostname of node which is returned
+            by "compute_instance_id" method.
+        :param from_host: Name of the K2 host the volume is expected to be
+            mapped to, any host by default.
+        :raises UnknownVolume: If the supplied "blockdevice_id" does not
+            exist.
+        :raises AlreadyAttachedVolume: If the volume is mapped to another
+            host than ``from_host``.
+        :returns: A  "BlockDeviceVolume" with a "attached_to" attribute set
+            to "attach_to".
+        """
+        LOG.info('Moving %s to host %s', blockdevice_id, attach_to)
+        array, volume = self.arrays.find_volume(blockdevice_id)
+        if volume is None:
+            raise blockdevice.UnknownVolume(blockdevice_id)
+
+        host = self._claim_host(attach_to, array)
+        try:
+            self._login_portals(array)
+            self._check_multipath()
+            mapping = self._remap_volume(array, blockdevice_id, volume, host,
+                                         from_host)
+        except Exception:
+            self._release_host(array, host)
+            raise
+        self.state.record_attachment(
+            blockdevice_id,
+            dataset_id=self._return_to_block_device_volume(volume).dataset_id,
+            host=host.name, mapping_id=mapping.id,
+            lun=self.api_client.rgetattr(mapping, "lun", None),
+            array=array.name)
+        self._watch_queues(blockdevice_id, volume)
+
+        self._iscsi_rescan('move', scan=lambda: self._wait_for_devices(
+            {blockdevice_id: mapping}, {blockdevice_id: (array, volume)}))
 
         return self._return_to_block_device_volume(volume, attach_to)
 
+    def _remap_volume(self, array, blockdevice_id, volume, host, from_host):
+        """Replace the mapping of a volume by one to this node's host.
+
+        The old mapping is put back if the new one cannot be made.
+
+        :return: The mapping krest object.
+        """
+        mapped = array.krest.search("mappings", volume=volume)
+        old_mapping = mapped.hits[0] if mapped.total > 0 else None
+        old_host = self.api_client.rgetattr(old_mapping, "host", None) \
+            if old_mapping is not None else None
+        if old_host is not None:
+            if old_host.name == host.name:
+                self._release_host(array, host)
+                return old_mapping
+            if from_host is not None and old_host.name != from_host:
+                LOG.info("Mapped server %s", old_host.name)
+                raise blockdevice.AlreadyAttachedVolume(blockdevice_id)
+            old_mapping.delete()
+            LOG.info("Unmapped %s from host %s", blockdevice_id,
+                     old_host.name)
+        try:
+            mapping = array.krest.new("mappings", volume=volume, host=host)
+            mapping.save()
+        except Exception as e:
+            if old_host is not None:
+                try:
+                    array.krest.new("mappings", volume=volume,
+                                    host=old_host).save()
+                except Exception:
+                    LOG.exception("Unable to map %s back to host %s",
+                                  blockdevice_id, old_host.name)
+            raise StorageDriverAPIException(
+                'Unable to move volume {} to server: {}'.format(
+                    blockdevice_id, e))
+        LOG.info("Mapping is done- %s", mapping)
+        return mapping
+
+    @driver_operation('attach_volumes', bounded=False)
+    def attach_volumes(self, blockdevice_ids, attach_to):
+        """Attach many volumes to this node.
+
+        The volumes, and their current mappings, are looked up with one
+        search per array and chunk of ``BULK_SEARCH_CHUNK`` ids. The host
+        is resolved and the portals logged in to once per array, the
+        mappings are created pipelined over ``bulk_concurrency``
+        connections, then only the LUNs of the volumes are scanned for and
+        their devices are waited for together.
+
+        :param blockdevice_ids: An iterable of volume unique IDs.
+        :param attach_to: It is a hostname of node which is returned
+            by "compute_instance_id" method.
+        :return: A list of ``BulkVolumeResult``, one per id, in order,
+            with the volumes ``attached_to`` set. Unknown ids get an
+            ``UnknownVolume`` error and volumes mapped to another node an
+            ``AlreadyAttachedVolume`` one; volumes already mapped to this
+            node are reported attached.
+        """
+        blockdevice_ids = list(blockdevice_ids)
+        LOG.info('Attaching %d volumes to %s', len(blockdevice_ids),
+                 attach_to)
+        unavailable = {}
+        found = self.arrays.find_volumes(blockdevice_ids, BULK_SEARCH_CHUNK,
+                                         unavailable)
+        errors = dict((blockdevice_id, blockdevice.UnknownVolume(
+            blockdevice_id)) for blockdevice_id in blockdevice_ids
+            if blockdevice_id not in found)
+        errors.update(unavailable)
+        mapped = {}
+        to_map = []
+        for array in set(array for array, _ in found.values()):
+            ids = [blockdevice_id for blockdevice_id in found
+                   if found[blockdevice_id][0] is array]
+            try:
+                host = self._claim_host(attach_to, array, len(ids))
+            except Exception as e:
+                errors.update((blockdevice_id, e) for blockdevice_id in ids)
+                continue
+            try:
+                self._login_portals(array)
+                self._check_multipath()
+                existing = dict(
+                    (self.api_client.ref_id(mapping, "volume"), mapping)
+                    for mapping in self._search_mappings(
+                        array, [found[b][1] for b in ids]))
+            except Exception as e:
+                for blockdevice_id in ids:
+                    self._release_host(array, host)
+                    errors[blockdevice_id] = e
+                continue
+            for blockdevice_id in ids:
+                volume = found[blockdevice_id][1]
+                mapping = existing.get(volume.id)
+                if mapping is None:
+                    to_map.append((array, (blockdevice_id, volume, host)))
+                    continue
+                self._release_host(array, host)
+                if self.api_client.ref_id(mapping, "host") == host.id:
+                    mapped[blockdevice_id] = mapping
+                else:
+                    errors[blockdevice_id] = \
+                        blockdevice.AlreadyAttachedVolume(blockdevice_id)
+
+        entries = [self.state.begin('attach_volume', blockdevice_id)
+                   for _, (blockdevice_id, _, _) in to_map]
+        try:
+            outcome = self._run_bulk(
+                lambda krest, item, array: krest.new(
+                    "mappings", volume=item[1], host=item[2]).save(),
+                to_map)
+            for (array, (blockdevice_id, volume, host)), (mapping, error) \
+                    in zip(to_map, outcome):
+                if error is not None:
+                    self._release_host(array, host)
+                    errors[blockdevice_id] = StorageDriverAPIException(
+                        'Unable to map volume {} to server: {}'.format(
+                            blockdevice_id, error))
+                    continue
+                mapped[blockdevice_id] = mapping
+                self.state.record_attachment(
+                    blockdevice_id,
+                    dataset_id=self._return_to_block_device_volume(
+                        volume).dataset_id,
+                    host=host.name, mapping_id=mapping.id,
+                    lun=self.api_client.rgetattr(mapping, "lun", None),
+                    array=array.name)
+                self._watch_queues(blockdevice_id, volume)
+            if mapped:
+                self._wait_for_devices(mapped, found)
+        finally:
+            for entry in entries:
+                self.state.finish(entry)
+
+        results = []
+        for blockdevice_id in blockdevice_ids:
+            volume = self._return_to_block_device_volume(
+                found[blockdevice_id][1],
+                None if blockdevice_id in errors else attach_to) \
+                if blockdevice_id in found else None
+            results.append(BulkVolumeResult(
+                dataset_id=volume.dataset_id if volume else None,
+                blockdevice_id=blockdevice_id,
+                volume=None if blockdevice_id in errors else volume,
+                error=errors.get(blockdevice_id)))
+        return results
+
+    def _wait_for_devices(self, mappings, found):
+        """Scan for the LUNs of new mappings of this node and wait for
+        the devices of all of them, then record and tune the devices.
+
+        Devices still missing after ``ITERATION_LIMIT`` rounds are left
+        to ``get_device_path``.
+
+        :param mappings: A dict of blockdevice id to mapping krest object.
+        :param found: A dict of blockdevice id to ``(array, volume)``.
+        """
+        luns = [self.api_client.rgetattr(mapping, "lun", None)
+                for mapping in mappings.values()]
+        try:
+            if not self.api_client.scan_luns(
+                    [lun for lun in luns if lun is not None]):
+                self.api_client.rescan_iscsi()
+            with deadline_scope(self.operation_timeout):
+                paths = self.api_client.find_devices(list(mappings),
+                                                     ITERATION_LIMIT)
+        except Exception as e:
+            LOG.warning('Devices of %d attached volumes not found: %s',
+                        len(mappings), e)
+            return
+        for blockdevice_id, device_paths in paths.items():
+            self.state.set_device_path(blockdevice_id, device_paths[0])
+            self._watch_queues(blockdevice_id, found[blockdevice_id][1],
+                               device_paths[0])
+        self._tune_queues(list(mappings))
+
+    @driver_operation('detach_volume', journal=True)
     def detach_volume(self, blockdevice_id):
         """Detach ``blockdevice_id`` from whatever host it is attached to.
 
@@ -304,32 +1735,29 @@ class K2BlockDeviceAPI(object):
         """
         LOG.info('Detaching %s', blockdevice_id)
         # Check for volume by block device id(scsi_sn)
-        volume = self.krest.search("volumes", scsi_sn=blockdevice_id)
-        if volume.total == 0:
+        array, volume = self.arrays.find_volume(blockdevice_id)
+        if volume is None:
             raise blockdevice.UnknownVolume(blockdevice_id)
 
         # First check if we are mapped.
-        mapped = self.krest.search("mappings", volume=volume)
+        mapped = array.krest.search("mappings", volume=volume)
         if mapped.total == 0:
             raise blockdevice.UnattachedVolume(blockdevice_id)
 
         #  executing sync cmd for synchronize data on disk with memory
         self.api_client.sync_device()
 
-        paths = self.api_client.find_paths(blockdevice_id)
+        paths = self._device_paths(blockdevice_id)
         for path in paths:
             if "/dev/mapper/" in path:
                 self.api_client.remove_multipath(path)
                 break
+        with self._queue_lock:
+            self._queue_tuning.pop(blockdevice_id, None)
 
         # Make sure iqn is mapped with host.
-        iqn = self.api_client.get_initiator_name()
-        host_iqns = self.krest.search("host_iqns", iqn=iqn)
-
-        if host_iqns.total > 0:
-            # find host which is associate with iqn.
-            host_iqns = self.api_client.rgetattr(
-                host_iqns.hits[0], "host", None)
+        node_host = self._resolve_host(self.compute_instance_id(),
+                                       create=False, array=array)
 
         # Get the mapped host
         host = self.api_client.rgetattr(mapped.hits[0], "host", None)
@@ -338,19 +1766,139 @@ class K2BlockDeviceAPI(object):
             raise StorageDriverAPIException('Unable to locate server.')
 
         # Make sure both host have same name which is to be unmapped
-        if host.name == host_iqns.name:
+        if node_host is not None and host.name == node_host.name:
             mapped.hits[0].delete()
+            self.state.remove_attachment(blockdevice_id)
             LOG.info("Removed mapped host %s", host.name)
-        if self.destroy_host:
-            try:
-                host.delete()
-            except Exception as e:
-                LOG.exception("Unable to delete host due to %s", e.message)
-                pass
+            self._release_host(array, node_host)
+        elif self.state.attachment(blockdevice_id) is not None:
+            # Moved to another node while attached here
+            LOG.info("Volume %s was moved to host %s", blockdevice_id,
+                     host.name)
+            self.state.remove_attachment(blockdevice_id)
+            if node_host is not None:
+                self._release_host(array, node_host)
         # start iscsi rescan
         self._iscsi_rescan('detach')
         return None
 
+    @driver_operation('detach_volumes', bounded=False)
+    def detach_volumes(self, blockdevice_ids):
+        """Detach many volumes from this node.
+
+        The volumes, and their mappings, are looked up with one search per
+        array and chunk of ``BULK_SEARCH_CHUNK`` ids and the devices of
+        all of them in one pass. Data is synced once, the mappings are
+        deleted pipelined over ``bulk_concurrency`` connections and a
+        single rescan follows. Like ``detach_volume``, volumes mapped to
+        another node are left alone.
+
+        :param blockdevice_ids: An iterable of volume unique IDs.
+        :return: A list of ``BulkVolumeResult``, one per id, in order.
+            Unknown ids get an ``UnknownVolume`` error and volumes that
+            are not mapped an ``UnattachedVolume`` one.
+        """
+        blockdevice_ids = list(blockdevice_ids)
+        LOG.info('Detaching %d volumes', len(blockdevice_ids))
+        unavailable = {}
+        found = self.arrays.find_volumes(blockdevice_ids, BULK_SEARCH_CHUNK,
+                                         unavailable)
+        errors = dict((blockdevice_id, blockdevice.UnknownVolume(
+            blockdevice_id)) for blockdevice_id in blockdevice_ids
+            if blockdevice_id not in found)
+        errors.update(unavailable)
+        to_unmap = []
+        for array in set(array for array, _ in found.values()):
+            ids = [blockdevice_id for blockdevice_id in found
+                   if found[blockdevice_id][0] is array]
+            try:
+                existing = dict(
+                    (self.api_client.ref_id(mapping, "volume"), mapping)
+                    for mapping in self._search_mappings(
+                        array, [found[b][1] for b in ids]))
+                node_host = self._resolve_host(self.compute_instance_id(),
+                                               create=False, array=array)
+            except Exception as e:
+                errors.update((blockdevice_id, e) for blockdevice_id in ids)
+                continue
+            for blockdevice_id in ids:
+                mapping = existing.get(found[blockdevice_id][1].id)
+                if mapping is None:
+                    errors[blockdevice_id] = blockdevice.UnattachedVolume(
+                        blockdevice_id)
+                elif node_host is not None and self.api_client.ref_id(
+                        mapping, "host") == node_host.id:
+                    to_unmap.append((array, (blockdevice_id, mapping,
+                                             node_host)))
+
+        entries = [self.state.begin('detach_volume', blockdevice_id)
+                   for _, (blockdevice_id, _, _) in to_unmap]
+        try:
+            #  executing sync cmd for synchronize data on disk with memory
+            if to_unmap:
+                self.api_client.sync_device()
+            for path in self._mapper_paths(
+                    [item[0] for _, item in to_unmap]).values():
+                self.api_client.remove_multipath(path)
+            with self._queue_lock:
+                for _, (blockdevice_id, _, _) in to_unmap:
+                    self._queue_tuning.pop(blockdevice_id, None)
+            outcome = self._run_bulk(
+                lambda krest, item, array: krest.delete(item[1]), to_unmap)
+            for (array, (blockdevice_id, _, host)), (_, error) in zip(
+                    to_unmap, outcome):
+                if error is not None:
+                    errors[blockdevice_id] = StorageDriverAPIException(
+                        'Unable to unmap volume {}: {}'.format(
+                            blockdevice_id, error))
+                    continue
+                self.state.remove_attachment(blockdevice_id)
+                self._release_host(array, host)
+        finally:
+            for entry in entries:
+                self.state.finish(entry)
+        if to_unmap:
+            self._iscsi_rescan('detach')
+
+        results = []
+        for blockdevice_id in blockdevice_ids:
+            volume = self._return_to_block_device_volume(
+                found[blockdevice_id][1]) if blockdevice_id in found \
+                else None
+            results.append(BulkVolumeResult(
+                dataset_id=volume.dataset_id if volume else None,
+                blockdevice_id=blockdevice_id, volume=volume,
+                error=errors.get(blockdevice_id)))
+        return results
+
+    def _mapper_paths(self, blockdevice_ids):
+        """Multipath devices of volumes attached to this node.
+
+        Paths recorded in the local state store are used as long as they
+        still belong to their volume, the others are found with a single
+        pass over the devices.
+
+        :return: A dict of blockdevice id to ``/dev/mapper`` path, for the
+            volumes that have one.
+        """
+        paths = {}
+        missing = []
+        for blockdevice_id in blockdevice_ids:
+            attachment = self.state.attachment(blockdevice_id)
+            if attachment and self.api_client.device_matches(
+                    attachment['device_path'], blockdevice_id):
+                paths[blockdevice_id] = attachment['device_path']
+            else:
+                missing.append(blockdevice_id)
+        if missing:
+            paths.update((blockdevice_id, device_paths[0])
+                         for blockdevice_id, device_paths in
+                         self.api_client.find_devices(missing).items())
+        return dict((blockdevice_id, path)
+                    for blockdevice_id, path in paths.items()
+                    if "/dev/mapper/" in path)
+
+    @driver_operation('destroy_volume')
     def destroy_volume(self, blockdevice_id):
         """Destroy an existing volume from an initiator (host).
 
@@ -358,29 +1906,203 @@ class K2BlockDeviceAPI(object):
         """
         LOG.info('Destroying volume %s', blockdevice_id)
         try:
-            volume = self.krest.search("volumes", scsi_sn=blockdevice_id)
-            if volume.total == 0:
+            array, volume = self.arrays.find_volume(blockdevice_id)
+            if volume is None:
                 raise blockdevice.UnknownVolume(blockdevice_id)
-            volume = volume.hits[0]
-            volume_group = self.api_client.rgetattr(
-                volume, "volume_group", None)
-            volume.delete()
-            volume_group.delete()
+            self._destroy_volume(array.krest, volume, array)
+            self.arrays.forget(blockdevice_id)
         except Exception:
             raise StorageDriverAPIException(
                 'Error destroying volume blockdevice_id:{}'.format(
                     blockdevice_id))
         return None
 
+    def _destroy_volume(self, krest, volume, array=None):
+        """Delete a volume and its volume group.
+
+        The volume group is deleted through its reference, without
+        fetching it first. A shared volume group is only deleted with the
+        last of its volumes.
+
+        :param krest: The krest end point to issue the requests through.
+        :param volume: The krest volume object.
+        :param array: The ``K2Array`` of ``krest``, the primary one by
+            default.
+        """
+        array = array or self.arrays.primary
+        volume_group = self.api_client.ref_object(krest, volume,
+                                                  "volume_group")
+        pack = self.api_client.decode_tag(self.api_client.rgetattr(
+            volume, "description", None)).get("pack")
+        krest.delete(volume)
+        if volume_group is None:
+            return
+        if pack is None:
+            krest.delete(volume_group)
+            return
+        remaining = krest.search("volumes", volume_group=volume_group,
+                                 **{"__limit": 1}).total
+        with self._group_lock:
+            entry = self._groups.get((array.name, pack))
+            if entry is not None and entry['group'].id == volume_group.id:
+                entry['count'] = remaining
+        if remaining == 0:
+            try:
+                krest.delete(volume_group)
+                self._forget_volume_group(array, pack, volume_group)
+                LOG.info('Deleted emptied shared volume group %s',
+                         volume_group.id)
+            except Exception as e:
+                # A volume was placed in it meanwhile
+                LOG.info('Keeping shared volume group %s: %s',
+                         volume_group.id, e)
+
+    @driver_operation('destroy_volumes', bounded=False)
+    def destroy_volumes(self, blockdevice_ids):
+        """Destroy many volumes.
+
+        The volumes are looked up with one search per array and chunk of
+        ``BULK_SEARCH_CHUNK`` ids, the deletions are then pipelined over
+        ``bulk_concurrency`` connections, paced down while the array
+        answers busy.
+
+        :param blockdevice_ids: An iterable of volume unique IDs.
+        :return: A list of ``BulkVolumeResult``, one per id, in order.
+            Unknown ids get an ``UnknownVolume`` error.
+        """
+        blockdevice_ids = list(blockdevice_ids)
+        LOG.info('Destroying %d volumes', len(blockdevice_ids))
+        unavailable = {}
+        found = self.arrays.find_volumes(blockdevice_ids, BULK_SEARCH_CHUNK,
+                                         unavailable)
+        to_destroy = [found[b] for b in blockdevice_ids if b in found]
+        outcome = dict(zip(
+            [volume.scsi_sn for _, volume in to_destroy],
+            self._run_bulk(self._destroy_volume, to_destroy)))
+
+        results = []
+        for blockdevice_id in blockdevice_ids:
+            if blockdevice_id not in found:
+                results.append(BulkVolumeResult(
+                    dataset_id=None, blockdevice_id=blockdevice_id,
+                    volume=None,
+                    error=unavailable.get(
+                        blockdevice_id,
+                        blockdevice.UnknownVolume(blockdevice_id))))
+                continue
+            volume = self._return_to_block_device_volume(
+                found[blockdevice_id][1])
+            _, error = outcome[blockdevice_id]
+            if error is None:
+                self.arrays.forget(blockdevice_id)
+            else:
+                error = StorageDriverAPIException(
+                    'Error destroying volume blockdevice_id:{}: {}'.format(
+                        blockdevice_id, error))
+            results.append(BulkVolumeResult(
+                dataset_id=volume.dataset_id, blockdevice_id=blockdevice_id,
+                volume=volume, error=error))
+        return results
+
+    @driver_operation('resize_volume')
+    def resize_volume(self, blockdevice_id, size):
+        """Grow a volume, online.
+
+        The K2 volume is grown and, when it is attached to this node, only
+        the ``sd`` paths of its LUN are rescanned and its multipath map is
+        resized, so the new size shows without a detach. Another node the
+        volume is attached to sees it at its next rescan; growing the file
+        system is left to the caller.
+
+        :param blockdevice_id: The unique identifier(scsi_sn of k2)
+            for the volume.
+        :param size: The new size of the volume in bytes.
+        :raises UnknownVolume: If the supplied "blockdevice_id" does not
+            exist.
+        :raises InvalidDataException: If ``size`` is smaller than the
+            volume.
+        :returns: A "BlockDeviceVolume" of the new size.
+        """
+        LOG.info('Resizing %s to %s bytes', blockdevice_id, size)
+        array, volume = self.arrays.find_volume(blockdevice_id)
+        if volume is None:
+            raise blockdevice.UnknownVolume(blockdevice_id)
+
+        size_kib = self.api_client.bytes_to_kib(size)
+        if size_kib < volume.size:
+            raise InvalidDataException(
+                'Volume {} has {} bytes, it can only grow'.format(
+                    blockdevice_id,
+                    self.api_client.kib_to_bytes(volume.size)))
+        if size_kib > volume.size:
+            try:
+                volume.size = size_kib
+                volume.save()
+            except Exception as e:
+                raise StorageDriverAPIException(
+                    'Unable to resize volume {}: {}'.format(blockdevice_id,
+                                                            e))
+
+        attached_to = None
+        mapped = array.krest.search("mappings", volume=volume)
+        host = None
+        if mapped.total > 0:
+            host = self.api_client.rgetattr(mapped.hits[0], "host", None)
+        if host is not None:
+            node_host = self._resolve_host(self.compute_instance_id(),
+                                           create=False, array=array)
+            attached_to = host.name
+            if node_host is not None and host.name == node_host.name:
+                attached_to = self.compute_instance_id()
+                paths = self._device_paths(blockdevice_id)
+                if not paths or \
+                        not self.api_client.resize_device(paths[0]):
+                    LOG.warning('Volume %s grew, but not its device %s',
+                                blockdevice_id, paths[:1])
+        return self._return_to_block_device_volume(volume, attached_to)
+
+    @driver_operation('list_volumes')
     def list_volumes(self):
         """List all the block devices available via the back end API.
 
+        With ``cluster_scoped_listing`` only this cluster's volumes, and
+        their mappings, are fetched from the arrays.
+
         :returns: A ``list`` of ``BlockDeviceVolume``s.
         """
         LOG.info('Listing volumes')
         volumes = []
-        vols = self.krest.search("volumes")
-        mappings = self.krest.search('mappings')
+        for array in self.arrays:
+            volumes.extend(self._list_array_volumes(array))
+        return volumes
+
+    def _list_array_volumes(self, array):
+        """List the block devices of one array.
+
+        :returns: A ``list`` of ``BlockDeviceVolume``s.
+        """
+        volumes = []
+        if self.cluster_scoped_listing:
+            vols = array.krest.search("volumes",
+                                      description__contains=self.cluster_tag)
+            mappings = self._search_mappings(array, list(vols))
+        else:
+            vols = array.krest.search("volumes")
+            mappings = list(array.krest.search('mappings'))
+        # Host names come from one search rather than a fetch per mapping
+        attached = {}
+        if mappings:
+            host_ids = set(self.api_client.ref_id(mapping, "host")
+                           for mapping in mappings)
+            if self.cluster_scoped_listing:
+                hosts = array.krest.search("hosts", id=[
+                    unicode(host_id) for host_id in host_ids])
+            else:
+                hosts = array.krest.search("hosts")
+            hosts = dict((host.id, host.name) for host in hosts)
+            for mapping in mappings:
+                attached[self.api_client.ref_id(mapping, "volume")] = \
+                    hosts.get(self.api_client.ref_id(mapping, "host"))
         # we are removing CTRL volume from volume array, just to pass
         # functional test cases
         # NOTE: CTRL volume is making cause to functional test cases
@@ -389,16 +2111,26 @@ class K2BlockDeviceAPI(object):
                 del vols.hits[index]
         # Now convert our API objects to Flocker ones
         for vol in vols:
-            attached_to = None
-            mapped = self.api_client.advance_search(mappings,
-                                                    volume__name=vol.name)
-            if len(mapped) > 0:
-                attached_to = self.api_client.rgetattr(
-                    mapped[0], "host.name", None)
+            attached_to = attached.get(vol.id)
+            self.arrays.remember(vol.scsi_sn, array)
             volumes.append(
                 self._return_to_block_device_volume(vol, attached_to))
         return volumes
 
+    @staticmethod
+    def _search_mappings(array, volumes):
+        """Mappings of the given volumes, searched ``BULK_SEARCH_CHUNK``
+        volumes at a time.
+
+        :return: A list of mapping krest objects.
+        """
+        mappings = []
+        for start in range(0, len(volumes), BULK_SEARCH_CHUNK):
+            mappings.extend(array.krest.search(
+                "mappings", volume=volumes[start:start + BULK_SEARCH_CHUNK]))
+        return mappings
+
+    @driver_operation('get_device_path')
     def get_device_path(self, blockdevice_id):
         """Return the device path.
 
@@ -413,22 +2145,24 @@ class K2BlockDeviceAPI(object):
         :returns: A ``FilePath`` for the device.
         """
         # Check for volume
-        volume = self.krest.search("volumes", scsi_sn=blockdevice_id)
-        if volume.total == 0:
+        array, volume = self.arrays.find_volume(blockdevice_id)
+        if volume is None:
             raise blockdevice.UnknownVolume(blockdevice_id)
 
-        volume = volume.hits[0]
         # Check for volume is mapped or not
         # NOTE: The assumption right now is if we are mapped,
         # we are mapped to the instance host.
-        mapped = self.krest.search("mappings", volume=volume)
+        mapped = array.krest.search("mappings", volume=volume)
         if mapped.total == 0:
             # if not mapped raise exception
             raise blockdevice.UnattachedVolume(blockdevice_id)
 
         # Get devices path
-        paths = self.api_client.find_paths(blockdevice_id)
+        paths = self._device_paths(blockdevice_id)
         if paths:
+            # Tune the queues of paths added since the attach
+            self._watch_queues(blockdevice_id, volume, paths[0])
+            self._tune_queues([blockdevice_id])
             # return the first path
             LOG.info('%s path', paths[0])
             return filepath.FilePath(paths[0])
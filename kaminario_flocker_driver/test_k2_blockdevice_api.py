@@ -0,0 +1,1068 @@
+""" This Unit Test code for k2_blockdevice_api
+
+The driver is exercised against the in-memory K2 array and host layer of
+``kaminario_flocker_driver.benchmark.fakes``.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from uuid import uuid4
+from flocker.node.agents import blockdevice
+from kaminario_flocker_driver.utils.k2_api_client import \
+    ArrayUnavailableException, ImproperConfigurationError, \
+    InvalidDataException, StorageDriverAPIException
+from kaminario_flocker_driver.benchmark.fakes import FakeK2Array
+from kaminario_flocker_driver.benchmark.lifecycle import array_config, \
+    build_arrays, build_driver, join_rescans
+from kaminario_flocker_driver.k2_blockdevice_api import K2BlockDeviceAPI
+from kaminario_flocker_driver.constants import REST_CALL_BUDGETS, \
+    MULTIPATH_CONF
+
+GIB = 1024 ** 3
+
+
+class K2BlockDeviceAPIBulkTest(unittest.TestCase):
+    """Tests for the bulk operations of `K2BlockDeviceAPI`."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(
+            self.array, bulk_concurrency=3)
+        # Keep the background warm-up requests out of the counts
+        self.driver.ready.wait()
+
+    def test_create_volumes(self):
+        """Are all datasets created and reported in order?"""
+        dataset_ids = [uuid4() for _ in range(7)]
+        results = self.driver.create_volumes(
+            [(dataset_id, GIB) for dataset_id in dataset_ids])
+        self.assertEqual([r.dataset_id for r in results], dataset_ids)
+        self.assertEqual([r.error for r in results], [None] * 7)
+        self.assertEqual(sorted(v.dataset_id
+                                for v in self.driver.list_volumes()),
+                         sorted(dataset_ids))
+
+    def test_create_volumes_reports_failures(self):
+        """Does one failing dataset leave the others created?"""
+        dataset_id = uuid4()
+        self.driver.create_volume(dataset_id, GIB)
+        results = self.driver.create_volumes([(uuid4(), GIB),
+                                              (dataset_id, GIB)])
+        self.assertIsNone(results[0].error)
+        self.assertIsNotNone(results[1].error)
+
+    def test_destroy_volumes(self):
+        """Are known volumes destroyed and unknown ones reported?"""
+        created = self.driver.create_volumes(
+            [(uuid4(), GIB) for _ in range(5)])
+        unknown = u"20024f4ffffffffff"
+        ids = [r.blockdevice_id for r in created] + [unknown]
+        gets = self.array.request_counts["GET"]
+        deletes = self.array.request_counts["DELETE"]
+        results = self.driver.destroy_volumes(ids)
+        # A volume and a volume group delete per dataset, and no fetch of
+        # the volume groups: one search plus at most one discovery per
+        # pooled connection.
+        self.assertEqual(self.array.request_counts["DELETE"] - deletes, 10)
+        self.assertLessEqual(self.array.request_counts["GET"] - gets, 1 + 3)
+        self.assertEqual([r.error for r in results[:5]], [None] * 5)
+        self.assertIsInstance(results[5].error, blockdevice.UnknownVolume)
+        self.assertEqual(self.driver.list_volumes(), [])
+        self.assertEqual(self.array.objects["volume_groups"], {})
+
+    def test_busy_array_is_paced(self):
+        """Do busy answers slow down and then recover?"""
+        pacer = self.api_client.pacer
+        pacer.min_delay = 0.001
+        pacer.on_busy()
+        pacer.on_busy()
+        self.assertEqual(pacer.delay, 0.002)
+        for _ in range(4):
+            pacer.on_success()
+        self.assertEqual(pacer.delay, 0.0)
+
+
+class K2BlockDeviceAPIWarmUpTest(unittest.TestCase):
+    """Tests for the lazy connection and background warm-up."""
+
+    def test_no_connection_without_warm_up(self):
+        """Is the array left alone until the first operation?"""
+        array = FakeK2Array(seed=0)
+        driver, _, _ = build_driver(array, warm_up="False")
+        self.assertTrue(driver.is_ready())
+        self.assertEqual(array.request_count, 0)
+        driver.list_volumes()
+        self.assertGreater(array.request_count, 0)
+
+    def test_warm_up_primes_first_attach(self):
+        """Does the first attach skip host resolution and portal login?"""
+        array = FakeK2Array(seed=0)
+        driver, _, _ = build_driver(array)
+        self.assertTrue(driver.ready.wait(5))
+        self.assertIsNone(driver.warm_up_error)
+        self.assertEqual(len(driver.arrays.primary.portals), 2)
+        volume = driver.create_volume(uuid4(), GIB)
+        requests = array.request_count
+        driver.attach_volume(volume.blockdevice_id,
+                             driver.compute_instance_id())
+        # volume search, mapping search and mapping creation only
+        self.assertEqual(array.request_count - requests, 3)
+
+
+class K2BlockDeviceAPIStateTest(unittest.TestCase):
+    """Tests for the local state store integration."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(self.array,
+                                                       warm_up="False")
+        self.attach_to = self.driver.compute_instance_id()
+
+    def _attached_volume(self):
+        volume = self.driver.create_volume(uuid4(), GIB)
+        self.driver.attach_volume(volume.blockdevice_id, self.attach_to)
+        join_rescans()
+        return volume.blockdevice_id
+
+    def _restart(self):
+        """Make the state recorded so far look left by a previous run."""
+        self.driver.started = time.time() + 1
+
+    def test_device_path_is_remembered(self):
+        """Does the second get_device_path skip the device scan?"""
+        blockdevice_id = self._attached_volume()
+        first = self.driver.get_device_path(blockdevice_id)
+        commands = self.api_client.command_count
+        self.assertEqual(self.driver.get_device_path(blockdevice_id), first)
+        self.assertEqual(self.api_client.command_count - commands, 1)
+
+    def test_reconcile_forgets_moved_volume(self):
+        """Is an attachment unmapped while down cleaned up on restart?"""
+        blockdevice_id = self._attached_volume()
+        self.driver.get_device_path(blockdevice_id)
+        for mapping in self.array.objects["mappings"].values():
+            self.array.delete("mappings", mapping["id"])
+        self._restart()
+        self.driver.reconcile()
+        self.assertIsNone(self.driver.state.attachment(blockdevice_id))
+
+    def test_reconcile_resumes_detach(self):
+        """Is a detach interrupted by a crash completed on restart?"""
+        blockdevice_id = self._attached_volume()
+        self.driver.state.begin("detach_volume", blockdevice_id)
+        self._restart()
+        self.driver.reconcile()
+        self.assertEqual(self.array.objects["mappings"], {})
+        self.assertEqual(self.driver.state.pending_operations(), [])
+
+    def test_reconcile_skips_live_operations(self):
+        """Are operations and attachments of the running driver left
+        alone?"""
+        blockdevice_id = self._attached_volume()
+        self.driver.get_device_path(blockdevice_id)
+        entry_id = self.driver.state.begin("detach_volume", blockdevice_id)
+        for mapping in self.array.objects["mappings"].values():
+            self.array.delete("mappings", mapping["id"])
+        commands = self.api_client.command_count
+        self.driver.reconcile()
+        self.assertIsNotNone(self.driver.state.attachment(blockdevice_id))
+        self.assertEqual(self.driver.state.pending_operations(),
+                         [(entry_id, "detach_volume", blockdevice_id)])
+        self.assertEqual(self.api_client.command_count, commands)
+
+    def test_reconcile_without_warm_up(self):
+        """Is the state left by a previous run reconciled on start up
+        when the warm-up is disabled?"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        state_db = os.path.join(directory, "state.db")
+        driver, _, _ = build_driver(self.array, warm_up="False",
+                                    state_db=state_db)
+        driver.state.begin("detach_volume", u"sn1")
+        driver.state.close()
+        restarted, _, _ = build_driver(self.array, warm_up="False",
+                                       state_db=state_db)
+        self.assertEqual(restarted.state.pending_operations(), [])
+
+
+class K2BlockDeviceAPIResilienceTest(unittest.TestCase):
+    """Tests for deadlines and circuit breaking."""
+
+    def test_array_down_fails_fast(self):
+        """Are requests refused once the array is clearly down?"""
+        array = FakeK2Array(seed=0)
+        driver, _, _ = build_driver(array, warm_up="False",
+                                    circuit_failure_threshold=2)
+        driver.list_volumes()
+        array.available = False
+        for _ in range(2):
+            self.assertRaises(ArrayUnavailableException,
+                              driver.list_volumes)
+        requests = array.request_count
+        self.assertRaises(ArrayUnavailableException, driver.list_volumes)
+        self.assertEqual(array.request_count, requests)
+
+    def test_busy_array_runs_out_of_retries(self):
+        """Is an array still busy after every retry reported as such?"""
+        array = FakeK2Array(seed=0)
+        driver, api_client, _ = build_driver(array, warm_up="False",
+                                             retries=3)
+        api_client.pacer.min_delay = 0.001
+        driver.list_volumes()
+        array.busy_rate = 1.0
+        self.assertRaises(ArrayUnavailableException, driver.list_volumes)
+
+    def test_slow_array_bounded_by_deadline(self):
+        """Does a hung array call end at the operation deadline?"""
+        array = FakeK2Array(seed=0)
+        driver, _, _ = build_driver(array, warm_up="False",
+                                    operation_timeout=0.2)
+        driver.list_volumes()
+        array.latency = 5
+        start = time.time()
+        self.assertRaises(Exception, driver.list_volumes)
+        self.assertLess(time.time() - start, 2)
+
+
+class K2BlockDeviceAPIMultiArrayTest(unittest.TestCase):
+    """Tests for placing and routing volumes over several arrays."""
+
+    def setUp(self):
+        self.small, self.large = build_arrays(2, seed=0)
+        self.small.capacity_kib = 2 * 1024 ** 2
+        self.driver, self.api_client, _ = build_driver(
+            self.small, extra_arrays=[self.large], warm_up="False")
+        self.attach_to = self.driver.compute_instance_id()
+
+    def test_volumes_placed_by_free_capacity(self):
+        """Do new volumes go to the arrays with room for them?"""
+        self.large.capacity_kib = self.small.capacity_kib
+        for _ in range(4):
+            self.driver.create_volume(uuid4(), GIB)
+        self.assertEqual(len(self.small.objects["volumes"]), 2)
+        self.assertEqual(len(self.large.objects["volumes"]), 2)
+        self.assertEqual(len(self.driver.list_volumes()), 4)
+
+    def test_lookups_routed_to_owning_array(self):
+        """Is a volume attached without asking the other array?"""
+        self.small.capacity_kib = 0
+        volume = self.driver.create_volume(uuid4(), GIB)
+        requests = self.small.request_count
+        self.driver.attach_volume(volume.blockdevice_id, self.attach_to)
+        self.assertIsNotNone(
+            self.driver.get_device_path(volume.blockdevice_id))
+        self.driver.detach_volume(volume.blockdevice_id)
+        self.driver.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(self.small.request_count, requests)
+        self.assertEqual(self.large.objects["volumes"], {})
+
+    def test_unindexed_volume_found(self):
+        """Does a restarted driver still find volumes on every array?"""
+        volumes = self.driver.create_volumes(
+            [(uuid4(), GIB) for _ in range(3)])
+        driver = K2BlockDeviceAPI(
+            cluster_id=uuid4(), is_dedup="False", warm_up="False",
+            state_db=":memory:",
+            **array_config(self.api_client, [self.large]))
+        results = driver.destroy_volumes([v.blockdevice_id for v in volumes])
+        self.assertEqual([r.error for r in results], [None] * 3)
+        self.assertEqual(driver.list_volumes(), [])
+
+    def test_array_down_skipped(self):
+        """Are the volumes of the other arrays found with one array
+        down?"""
+        self.small.capacity_kib = 0
+        volumes = self.driver.create_volumes(
+            [(uuid4(), GIB) for _ in range(2)])
+        driver = K2BlockDeviceAPI(
+            cluster_id=uuid4(), is_dedup="False", warm_up="False",
+            state_db=":memory:", circuit_failure_threshold=1,
+            **array_config(self.api_client, [self.large]))
+        self.small.available = False
+        driver.destroy_volume(volumes[0].blockdevice_id)
+        unknown = u"20024f4ffffffffff"
+        results = driver.destroy_volumes([volumes[1].blockdevice_id,
+                                          unknown])
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, ArrayUnavailableException)
+        self.assertRaises(ArrayUnavailableException,
+                          driver.arrays.find_volume, unknown)
+        self.assertEqual(self.large.objects["volumes"], {})
+
+
+class K2BlockDeviceAPICallBudgetTest(unittest.TestCase):
+    """Tests keeping the K2 requests of every operation within budget."""
+
+    def test_lifecycle_within_budget(self):
+        """Does every operation keep to its K2 request budget?"""
+        driver, _, _ = build_driver(FakeK2Array(seed=0),
+                                    trace_requests="True")
+        self.assertTrue(driver.ready.wait(5))
+        attach_to = driver.compute_instance_id()
+        volumes = [driver.create_volume(uuid4(), GIB) for _ in range(3)]
+        for volume in volumes:
+            driver.attach_volume(volume.blockdevice_id, attach_to)
+            driver.get_device_path(volume.blockdevice_id)
+        driver.list_volumes()
+        driver.collect_stats()
+        for volume in volumes:
+            driver.detach_volume(volume.blockdevice_id)
+            driver.destroy_volume(volume.blockdevice_id)
+        report = driver.call_report()
+        self.assertEqual(sorted(report), sorted(REST_CALL_BUDGETS))
+        self.assertEqual(driver.tracer.over_budget(REST_CALL_BUDGETS), [])
+        for operation, entry in report.items():
+            self.assertEqual(entry["duplicates"], {},
+                             "{} repeats K2 queries".format(operation))
+
+    def test_list_volumes_does_not_fetch_per_mapping(self):
+        """Is listing attached volumes a fixed number of requests?"""
+        driver, _, _ = build_driver(FakeK2Array(seed=0), warm_up="False",
+                                    trace_requests="True")
+        for _ in range(5):
+            volume = driver.create_volume(uuid4(), GIB)
+            driver.attach_volume(volume.blockdevice_id,
+                                 driver.compute_instance_id())
+        driver.tracer.reset()
+        volumes = driver.list_volumes()
+        self.assertEqual([v.attached_to for v in volumes],
+                         [driver.compute_instance_id()] * 5)
+        self.assertEqual(driver.call_report()["list_volumes"]["max_calls"],
+                         REST_CALL_BUDGETS["list_volumes"])
+
+
+class K2BlockDeviceAPIClusterScopeTest(unittest.TestCase):
+    """Tests for cluster tagging and cluster scoped listing."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(
+            self.array, warm_up="False", cluster_scoped_listing="True",
+            trace_requests="True")
+        self.other, _, _ = build_driver(self.array, warm_up="False")
+
+    def test_volumes_tagged_with_cluster(self):
+        """Do the volume group and volume carry the cluster id?"""
+        self.driver.create_volume(uuid4(), GIB)
+        for resource in ("volume_groups", "volumes"):
+            tags = [self.api_client.decode_tag(obj["description"])
+                    for obj in self.array.objects[resource].values()]
+            self.assertEqual(tags, [{"cluster": unicode(
+                self.driver.cluster_id)}])
+
+    def test_listing_scoped_to_cluster(self):
+        """Are other clusters' and non-Flocker volumes left out?"""
+        own = self.driver.create_volume(uuid4(), GIB)
+        self.driver.attach_volume(own.blockdevice_id,
+                                  self.driver.compute_instance_id())
+        for _ in range(3):
+            self.other.create_volume(uuid4(), GIB)
+        self.array.handle("POST", "/api/v2/volume_groups",
+                          '{"name": "vmware"}')
+        self.array.handle("POST", "/api/v2/volumes",
+                          '{"name": "CTRL", "size": 1, "volume_group": '
+                          '{"ref": "/volume_groups/%d"}}' %
+                          max(self.array.objects["volume_groups"]))
+        self.driver.tracer.reset()
+        volumes = self.driver.list_volumes()
+        self.assertEqual([v.blockdevice_id for v in volumes],
+                         [own.blockdevice_id])
+        self.assertEqual(volumes[0].attached_to,
+                         self.driver.compute_instance_id())
+        # Unscoped listing still skips CTRL only
+        self.assertEqual(len(self.other.list_volumes()), 4)
+        self.assertLessEqual(
+            self.driver.call_report()["list_volumes"]["max_calls"],
+            REST_CALL_BUDGETS["list_volumes"])
+
+    def test_tag_round_trip(self):
+        """Are tags encoded in key order and decoded back?"""
+        tag = self.api_client.encode_tag(profile=u"db", cluster=u"c1",
+                                         unused=None)
+        self.assertEqual(tag, u"cluster=c1,profile=db")
+        self.assertEqual(self.api_client.decode_tag(tag),
+                         {"cluster": u"c1", "profile": u"db"})
+        self.assertEqual(self.api_client.decode_tag(None), {})
+
+
+class K2BlockDeviceAPIIscsiTuningTest(unittest.TestCase):
+    """Tests for the iSCSI session tuning of K2 targets."""
+
+    settings = {"iscsi_sessions_per_portal": 2,
+                "iscsi_replacement_timeout": 15,
+                "iscsi_header_digest": "CRC32C,None"}
+
+    def test_settings_applied_before_login(self):
+        """Are the node records updated and the sessions verified?"""
+        driver, api_client, _ = build_driver(FakeK2Array(seed=0),
+                                             **self.settings)
+        self.assertTrue(driver.ready.wait(5))
+        for record in api_client.node_records.values():
+            self.assertEqual(record["node.session.nr_sessions"], "2")
+            self.assertEqual(
+                record["node.session.timeo.replacement_timeout"], "15")
+        self.assertEqual(len(api_client.sessions), 4)
+        self.assertEqual(driver.iscsi_mismatches, [])
+
+    def test_live_sessions_verified(self):
+        """Are sessions logged in before tuning reported and topped up?"""
+        array = FakeK2Array(seed=0)
+        untuned, api_client, _ = build_driver(array)
+        self.assertTrue(untuned.ready.wait(5))
+        self.assertEqual(len(api_client.sessions), 2)
+        driver = K2BlockDeviceAPI(cluster_id=uuid4(), api_client=api_client,
+                                  is_dedup="False", state_db=":memory:",
+                                  warm_up="False", **self.settings)
+        driver._login_portals()
+        self.assertEqual(len(api_client.sessions), 4)
+        self.assertEqual(len(driver.iscsi_mismatches), 2)
+        self.assertIn("Recovery Timeout is 120", driver.iscsi_mismatches[0])
+
+    def test_untuned_login_unchanged(self):
+        """Does login run no extra commands without settings?"""
+        driver, api_client, _ = build_driver(FakeK2Array(seed=0),
+                                             warm_up="False")
+        driver._login_portals()
+        self.assertEqual(api_client.command_counts["iscsiadm"], 4)
+
+
+class K2BlockDeviceAPIMultipathPolicyTest(unittest.TestCase):
+    """Tests for the multipath policy of K2 LUNs."""
+
+    def test_drift_reported_at_startup(self):
+        """Is the built in K2 policy reported as drift, and left alone?"""
+        driver, api_client, _ = build_driver(FakeK2Array(seed=0))
+        self.assertTrue(driver.ready.wait(5))
+        self.assertIn("path_selector is not set, recommended queue-length 0",
+                      driver.multipath_drift)
+        self.assertEqual(api_client.files, {})
+
+    def test_policy_applied_once(self):
+        """Is multipathd reloaded only when the policy changed?"""
+        driver, api_client, _ = build_driver(
+            FakeK2Array(seed=0), multipath_policy="apply",
+            multipath_no_path_retry=12)
+        self.assertTrue(driver.ready.wait(5))
+        self.assertEqual(driver.multipath_drift, [])
+        self.assertIn("no_path_retry 12", api_client.files[MULTIPATH_CONF])
+        self.assertEqual(api_client.command_counts["multipathd"], 3)
+        again = K2BlockDeviceAPI(cluster_id=uuid4(), api_client=api_client,
+                                 is_dedup="False", state_db=":memory:",
+                                 multipath_policy="apply",
+                                 multipath_no_path_retry=12)
+        self.assertTrue(again.ready.wait(5))
+        self.assertEqual(again.multipath_drift, [])
+        self.assertEqual(api_client.command_counts["multipathd"], 4)
+
+
+class K2BlockDeviceAPIQueueTuningTest(unittest.TestCase):
+    """Tests for the block queue profiles of attached volumes."""
+
+    def _attached_volume(self, profile=None, **config):
+        self.driver, self.api_client, _ = build_driver(
+            FakeK2Array(seed=0), warm_up="False", **config)
+        if profile is None:
+            volume = self.driver.create_volume(uuid4(), GIB)
+        else:
+            volume = self.driver.create_volume_with_profile(uuid4(), GIB,
+                                                            profile)
+        self.driver.attach_volume(volume.blockdevice_id,
+                                  self.driver.compute_instance_id())
+        join_rescans()
+        return volume.blockdevice_id
+
+    def _queue(self, name, attribute):
+        return self.api_client.sysfs.get(
+            "/sys/block/{}/queue/{}".format(name, attribute))
+
+    def test_default_profile_applied(self):
+        """Are the multipath device and all its paths tuned on attach?"""
+        blockdevice_id = self._attached_volume(queue_profile="balanced")
+        names = self.api_client.lun_devices[blockdevice_id] + \
+            [self.api_client.dm_names[blockdevice_id]]
+        self.assertEqual(len(names), 3)
+        for name in names:
+            self.assertEqual(self._queue(name, "scheduler"), "none")
+            self.assertEqual(self._queue(name, "read_ahead_kb"), "128")
+
+    def test_profile_kept_in_tag(self):
+        """Does a volume created with a profile get its queue settings?"""
+        blockdevice_id = self._attached_volume(
+            "bronze", queue_profiles={"bronze": {"read_ahead_kb": 8192}})
+        volume = self.driver.krest.search("volumes",
+                                          scsi_sn=blockdevice_id).hits[0]
+        self.assertIn(u"profile=bronze", volume.description)
+        dm_name = self.api_client.dm_names[blockdevice_id]
+        self.assertEqual(self._queue(dm_name, "read_ahead_kb"), "8192")
+        self.assertIsNone(self._queue(dm_name, "scheduler"))
+
+    def test_new_paths_tuned(self):
+        """Are paths added after the attach tuned, and only them?"""
+        blockdevice_id = self._attached_volume("gold")
+        writes = len(self.api_client.sysfs)
+        name = self.api_client.add_path(blockdevice_id)
+        self.driver.get_device_path(blockdevice_id)
+        self.assertEqual(self._queue(name, "read_ahead_kb"), "0")
+        self.assertEqual(len(self.api_client.sysfs) - writes, 4)
+
+    def test_legacy_scheduler(self):
+        """Is noop used on kernels without the none scheduler?"""
+        self.driver, self.api_client, _ = build_driver(
+            FakeK2Array(seed=0), warm_up="False")
+        self.api_client.schedulers = ("noop", "deadline", "cfq")
+        self.assertEqual(self.api_client.tune_block_queue(
+            "sdb", (("scheduler", "none"), ("scheduler", "bfq"))),
+            [("scheduler", "bfq")])
+        self.assertEqual(self._queue("sdb", "scheduler"), "noop")
+
+    def test_tuning_off(self):
+        """Are queues left alone by default and with queue_profile off?"""
+        self._attached_volume()
+        self.assertEqual(self.api_client.sysfs, {})
+        self._attached_volume(queue_profile="off")
+        self.assertEqual(self.api_client.sysfs, {})
+        self.assertRaises(ImproperConfigurationError, build_driver,
+                          FakeK2Array(seed=0), warm_up="False",
+                          queue_profile="platinum")
+
+
+class K2BlockDeviceAPIVolumeStatsTest(unittest.TestCase):
+    """Tests for the K2 volume statistics collector."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.textfile = os.path.join(tempfile.mkdtemp(), "k2.prom")
+        self.driver, _, _ = build_driver(self.array, warm_up="False",
+                                         trace_requests="True",
+                                         metrics_textfile=self.textfile,
+                                         stats_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.textfile))
+
+    def test_stats_keyed_by_dataset(self):
+        """Are the counters of the cluster's volumes exported by dataset?"""
+        dataset_id = uuid4()
+        volume = self.driver.create_volume(dataset_id, GIB)
+        self.array.volume_counters = dict(
+            (obj["id"], {"iops_avg": 1500, "throughput_avg": 2048,
+                         "latency_avg": 250})
+            for obj in self.array.objects["volumes"].values())
+        self.driver.create_volume(uuid4(), GIB)
+        stats = self.driver.collect_stats()
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats[dataset_id], {
+            "kaminario_volume_iops": 1500,
+            "kaminario_volume_throughput_bytes": 2048 * 1024,
+            "kaminario_volume_latency_seconds": 250 * 1e-6})
+        self.assertEqual(self.driver.call_report()["collect_stats"][
+            "max_calls"], 2)
+        with open(self.textfile) as metrics_file:
+            text = metrics_file.read()
+        self.assertIn('kaminario_volume_iops{{array="fake-k2",'
+                      'blockdevice_id="{}",dataset_id="{}"}} 1500.0'.format(
+                          volume.blockdevice_id, dataset_id), text)
+
+    def test_destroyed_volume_dropped(self):
+        """Does a destroyed volume leave the metrics?"""
+        volume = self.driver.create_volume(uuid4(), GIB)
+        self.driver.collect_stats()
+        self.driver.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(self.driver.collect_stats(), {})
+        self.assertEqual(
+            self.driver.metrics.samples("kaminario_volume_iops"), {})
+
+
+class K2BlockDeviceAPISingleFlightTest(unittest.TestCase):
+    """Tests for coalescing identical concurrent K2 requests."""
+
+    def _concurrently(self, func, count):
+        threads = [threading.Thread(target=func) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_identical_searches_coalesced(self):
+        """Do identical concurrent searches share one request?"""
+        array = FakeK2Array(seed=0, latency=0.1)
+        driver, _, _ = build_driver(array, warm_up="False")
+        pool = driver.arrays.primary.bulk_pool
+        endpoints = [pool.acquire() for _ in range(4)]
+        results = []
+
+        def search():
+            results.append(endpoints.pop().search("system/net_ips"))
+
+        driver.krest.search("volumes")
+        requests = array.request_count
+        self._concurrently(search, 4)
+        self.assertEqual(array.request_count - requests, 1)
+        self.assertEqual([len(list(result)) for result in results],
+                         [len(array.objects["system/net_ips"])] * 4)
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+        driver.krest.search("system/net_ips")
+        self.assertEqual(array.request_count - requests, 2)
+
+    def test_first_attaches_create_one_host(self):
+        """Do concurrent first attaches create a single host and iqn?"""
+        array = FakeK2Array(seed=0, latency=0.01)
+        driver, api_client, _ = build_driver(array, warm_up="False",
+                                             register_host=False)
+        volumes = [driver.create_volume(uuid4(), GIB) for _ in range(4)]
+        attach_to = driver.compute_instance_id()
+        attached = []
+
+        def attach():
+            volume = volumes.pop()
+            attached.append(driver.attach_volume(volume.blockdevice_id,
+                                                 attach_to))
+
+        self._concurrently(attach, 4)
+        join_rescans()
+        self.assertEqual(len(attached), 4)
+        self.assertEqual(len(array.objects["hosts"]), 1)
+        self.assertEqual([iqn["iqn"] for iqn in
+                          array.objects["host_iqns"].values()],
+                         [api_client.iqn])
+
+
+class K2BlockDeviceAPISharedGroupTest(unittest.TestCase):
+    """Tests for volume groups shared by several volumes."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(
+            self.array, warm_up="False", volumes_per_group=3)
+
+    def _group_sizes(self):
+        sizes = dict((group_id, 0)
+                     for group_id in self.array.objects["volume_groups"])
+        for volume in self.array.objects["volumes"].values():
+            sizes[int(volume["volume_group"]["ref"].rpartition("/")[2])] += 1
+        return sorted(sizes.values())
+
+    def test_volumes_packed(self):
+        """Do volumes of a profile fill shared groups of the set size?"""
+        dataset_ids = [uuid4() for _ in range(5)]
+        self.driver.create_volumes([(dataset_id, GIB)
+                                    for dataset_id in dataset_ids[:3]])
+        self.driver.create_volume(dataset_ids[3], GIB)
+        self.driver.create_volume_with_profile(dataset_ids[4], GIB, "gold")
+        self.assertEqual(self._group_sizes(), [1, 1, 3])
+        self.assertEqual(
+            sorted(volume.dataset_id for volume in self.driver.list_volumes()),
+            sorted(dataset_ids))
+
+    def test_packing_resumed_after_restart(self):
+        """Is a partly filled group of the array filled first?"""
+        self.driver.create_volume(uuid4(), GIB)
+        driver = K2BlockDeviceAPI(cluster_id=self.driver.cluster_id,
+                                  api_client=self.api_client,
+                                  is_dedup="False", state_db=":memory:",
+                                  warm_up="False", volumes_per_group=3)
+        requests = self.array.request_counts["POST"]
+        driver.create_volume(uuid4(), GIB)
+        self.assertEqual(self.array.request_counts["POST"] - requests, 1)
+        self.assertEqual(self._group_sizes(), [2])
+
+    def test_group_deleted_with_last_volume(self):
+        """Is a shared group kept until its last volume is destroyed?"""
+        volumes = [self.driver.create_volume(uuid4(), GIB)
+                   for _ in range(4)]
+        self.driver.destroy_volume(volumes[0].blockdevice_id)
+        self.driver.destroy_volume(volumes[3].blockdevice_id)
+        self.assertEqual(self._group_sizes(), [2])
+        results = self.driver.destroy_volumes(
+            [volume.blockdevice_id for volume in volumes[1:3]])
+        self.assertEqual([result.error for result in results],
+                         [None, None])
+        self.assertEqual(self.array.objects["volume_groups"], {})
+        self.driver.create_volume(uuid4(), GIB)
+        self.assertEqual(self._group_sizes(), [1])
+
+    def test_failed_volume_keeps_group(self):
+        """Does a failed creation leave the shared group and its room?"""
+        dataset_id = uuid4()
+        self.driver.create_volume(dataset_id, GIB)
+        posts = self.array.request_counts["POST"]
+        self.assertRaises(StorageDriverAPIException,
+                          self.driver.create_volume, dataset_id, GIB)
+        self.assertEqual(self.array.request_counts["POST"] - posts, 1)
+        gets = self.array.request_counts["GET"]
+        for _ in range(2):
+            self.driver.create_volume(uuid4(), GIB)
+        # the group is filled from the cache, without counting again
+        self.assertEqual(self.array.request_counts["GET"], gets)
+        self.assertEqual(self._group_sizes(), [3])
+
+    def test_deleted_group_replaced(self):
+        """Is a volume put in a new group when the cached one is gone?"""
+        volume = self.driver.create_volume(uuid4(), GIB)
+        for obj_id in list(self.array.objects["volumes"]):
+            self.array.delete("volumes", obj_id)
+        for obj_id in list(self.array.objects["volume_groups"]):
+            self.array.delete("volume_groups", obj_id)
+        self.driver.create_volume(uuid4(), GIB)
+        self.assertEqual(self._group_sizes(), [1])
+        self.assertNotIn(volume.blockdevice_id,
+                         [v.blockdevice_id
+                          for v in self.driver.list_volumes()])
+
+
+class K2BlockDeviceAPIProfilingTest(unittest.TestCase):
+    """Tests for the profiling of driver operations."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_operations_profiled(self):
+        """Is every driver operation profiled under its own name?"""
+        driver, _, _ = build_driver(
+            FakeK2Array(seed=0), warm_up="False", profile_operations="True",
+            profile_sample_rate=1, profile_dir=self.directory)
+        volume = driver.create_volume(uuid4(), GIB)
+        driver.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["create_volume", "destroy_volume"])
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.directory, "create_volume"))), 1)
+
+
+class K2BlockDeviceAPIGarbageCollectionTest(unittest.TestCase):
+    """Tests for the collection of orphaned array and node objects."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(
+            self.array, warm_up="False", gc_max_deletions=2)
+        self.api_client.keep_stale_devices = True
+
+    def _leftover_group(self, description=None):
+        return self.driver.krest.new(
+            "volume_groups", name=u"K2FVG-{}".format(uuid4()), quota=0,
+            is_dedup=False,
+            description=description or self.driver.cluster_tag).save()
+
+    def _group_names(self):
+        return sorted(group["name"] for group in
+                      self.array.objects["volume_groups"].values())
+
+    def test_empty_volume_groups_removed(self):
+        """Are this cluster's empty groups removed on the second pass?"""
+        volume = self.driver.create_volume(uuid4(), GIB)
+        leftover = self._leftover_group()
+        foreign = self._leftover_group(u"cluster=other")
+        report = self.driver.collect_garbage()
+        self.assertEqual(report["removed"], [])
+        self.assertEqual(len(report["candidates"]), 1)
+        self.assertIn(leftover.name, report["candidates"][0])
+        report = self.driver.collect_garbage()
+        self.assertEqual(len(report["removed"]), 1)
+        self.assertIn(leftover.name, report["removed"][0])
+        self.assertEqual(self._group_names(), sorted(
+            [u"K2FVG-{}".format(volume.dataset_id), foreign.name]))
+
+    def test_dry_run_and_rate_limit(self):
+        """Are orphans only reported on a dry run, and removed a few at a
+        time?"""
+        for _ in range(3):
+            self._leftover_group()
+        self.driver.collect_garbage(dry_run=True)
+        report = self.driver.collect_garbage(dry_run=True)
+        self.assertEqual((len(report["removed"]), report["deferred"]),
+                         (2, 1))
+        self.assertEqual(len(self._group_names()), 3)
+        report = self.driver.collect_garbage()
+        self.assertEqual((len(report["removed"]), report["deferred"]),
+                         (2, 1))
+        self.assertEqual(len(self._group_names()), 1)
+        self.driver.collect_garbage()
+        self.assertEqual(self._group_names(), [])
+
+    def test_stale_devices_removed(self):
+        """Are the paths and map of an unmapped LUN removed, and those of
+        attached volumes kept?"""
+        volumes = [self.driver.create_volume(uuid4(), GIB)
+                   for _ in range(2)]
+        for volume in volumes:
+            self.driver.attach_volume(volume.blockdevice_id,
+                                      self.driver.compute_instance_id())
+        join_rescans()
+        stale_id, kept_id = [volume.blockdevice_id for volume in volumes]
+        stale = list(self.api_client.lun_devices[stale_id])
+        mpath = self.api_client.mpath_names[stale_id]
+        for mapping in list(self.array.objects["mappings"].values()):
+            volume = self.array._deref(mapping["volume"])
+            if volume["scsi_sn"] == stale_id:
+                self.array.delete("mappings", mapping["id"])
+        self.driver.gc_max_deletions = 10
+        self.driver.collect_garbage()
+        report = self.driver.collect_garbage()
+        node = self.driver.compute_instance_id()
+        self.assertEqual(report["removed"], [
+            u"multipath {}/{}".format(node, mpath)] + sorted(
+            u"device {}/{}".format(node, name) for name in stale))
+        self.assertEqual(sorted(self.api_client.k2_devices()),
+                         sorted(self.api_client.lun_devices[kept_id]))
+        self.assertEqual(self.driver.get_device_path(kept_id).path,
+                         u"/dev/mapper/{}".format(
+                             self.api_client.mpath_names[kept_id]))
+
+    def test_unregistered_host_removed(self):
+        """Is a host left without iqn by a failed registration removed,
+        so the next attach registers the node again?"""
+        array = FakeK2Array(seed=0)
+        driver, _, _ = build_driver(array, warm_up="False",
+                                    register_host=False)
+        driver.krest.new("hosts", name=driver.compute_instance_id(),
+                         type=u"Linux").save()
+        volume = driver.create_volume(uuid4(), GIB)
+        self.assertRaises(Exception, driver.attach_volume,
+                          volume.blockdevice_id,
+                          driver.compute_instance_id())
+        driver.collect_garbage()
+        report = driver.collect_garbage()
+        self.assertEqual(report["removed"], [u"host {}/{}".format(
+            driver.arrays.primary.name, driver.compute_instance_id())])
+        driver.attach_volume(volume.blockdevice_id,
+                             driver.compute_instance_id())
+        join_rescans()
+        self.assertEqual(len(array.objects["host_iqns"]), 1)
+
+
+class K2BlockDeviceAPIHostLifecycleTest(unittest.TestCase):
+    """Tests for the deletion of idle hosts with destroy_host."""
+
+    def _driver(self, grace):
+        self.array = FakeK2Array(seed=0)
+        driver, _, _ = build_driver(self.array, warm_up="False",
+                                    register_host=False, destroy_host="True",
+                                    host_grace_period=grace)
+        return driver
+
+    def _attach(self, driver, count=1):
+        volumes = []
+        for _ in range(count):
+            volume = driver.create_volume(uuid4(), GIB)
+            driver.attach_volume(volume.blockdevice_id,
+                                 driver.compute_instance_id())
+            volumes.append(volume.blockdevice_id)
+        join_rescans()
+        return volumes
+
+    @staticmethod
+    def _join_retirements():
+        for thread in threading.enumerate():
+            if thread.name == 'k2_host_retire':
+                thread.join()
+
+    def test_host_deleted_with_last_mapping(self):
+        """Is the host kept while mapped and deleted once idle?"""
+        driver = self._driver(0)
+        volumes = self._attach(driver, 2)
+        deletes = self.array.request_counts["DELETE"]
+        driver.detach_volume(volumes[0])
+        self._join_retirements()
+        self.assertEqual(self.array.request_counts["DELETE"] - deletes, 1)
+        self.assertEqual(len(self.array.objects["hosts"]), 1)
+        driver.detach_volume(volumes[1])
+        self._join_retirements()
+        self.assertEqual(self.array.objects["hosts"], {})
+        self._attach(driver)
+        self.assertEqual(len(self.array.objects["hosts"]), 1)
+        self.assertEqual(len(self.array.objects["host_iqns"]), 1)
+
+    def test_host_reused_within_grace_period(self):
+        """Does an attach within the grace period reuse the host?"""
+        driver = self._driver(60)
+        blockdevice_id = self._attach(driver)[0]
+        driver.detach_volume(blockdevice_id)
+        posts = self.array.request_counts["POST"]
+        driver.attach_volume(blockdevice_id, driver.compute_instance_id())
+        join_rescans()
+        self.assertEqual(self.array.request_counts["POST"] - posts, 1)
+        driver.detach_volume(blockdevice_id)
+        driver.collect_garbage()
+        self.assertEqual(driver.collect_garbage()["removed"], [])
+        array = driver.arrays.primary
+        driver._retire_host(array)
+        self.assertEqual(len(self.array.objects["hosts"]), 1)
+        array.host_idle_since -= 60
+        driver._retire_host(array)
+        self.assertEqual(self.array.objects["hosts"], {})
+
+
+class K2BlockDeviceAPIBatchAttachTest(unittest.TestCase):
+    """Tests for attaching and detaching volumes in batches."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(
+            self.array, warm_up="False", bulk_concurrency=3)
+        self.volumes = [self.driver.create_volume(uuid4(), GIB)
+                        for _ in range(4)]
+        self.ids = [volume.blockdevice_id for volume in self.volumes]
+
+    def test_attach_volumes(self):
+        """Are the volumes attached with one login and a LUN scan?"""
+        node = self.driver.compute_instance_id()
+        self.driver.attach_volume(self.ids[0], node)
+        join_rescans()
+        rescans = self.api_client.command_counts["rescan-scsi-bus.sh"]
+        results = self.driver.attach_volumes(self.ids + [u"missing"], node)
+        self.assertEqual([r.blockdevice_id for r in results],
+                         self.ids + [u"missing"])
+        self.assertEqual([r.error for r in results[:4]], [None] * 4)
+        self.assertIsInstance(results[4].error, blockdevice.UnknownVolume)
+        self.assertEqual([r.volume.attached_to for r in results[:4]],
+                         [node] * 4)
+        self.assertEqual(len(self.array.objects["mappings"]), 4)
+        self.assertEqual(self.api_client.command_counts["rescan-scsi-bus.sh"],
+                         rescans)
+        self.assertTrue(any(path.endswith("/scan")
+                            for path in self.api_client.sysfs))
+        for blockdevice_id in self.ids:
+            self.assertTrue(self.driver.state.attachment(
+                blockdevice_id)["device_path"].startswith("/dev/mapper/"))
+
+    def test_attach_volumes_mapped_elsewhere(self):
+        """Is a volume mapped to another node reported, not remapped?"""
+        self.array.register_host(u"other", u"iqn.other")
+        other = self.driver.krest.search("hosts", name=u"other").hits[0]
+        _, volume = self.driver.arrays.find_volume(self.ids[0])
+        self.driver.krest.new("mappings", volume=volume, host=other).save()
+        results = self.driver.attach_volumes(
+            self.ids[:2], self.driver.compute_instance_id())
+        self.assertIsInstance(results[0].error,
+                              blockdevice.AlreadyAttachedVolume)
+        self.assertIsNone(results[1].error)
+        self.assertEqual(len(self.array.objects["mappings"]), 2)
+
+    def test_detach_volumes(self):
+        """Are the volumes unmapped and their devices removed?"""
+        self.driver.attach_volumes(self.ids[:3],
+                                   self.driver.compute_instance_id())
+        results = self.driver.detach_volumes(self.ids)
+        join_rescans()
+        self.assertEqual([r.error for r in results[:3]], [None] * 3)
+        self.assertIsInstance(results[3].error, blockdevice.UnattachedVolume)
+        self.assertEqual(self.array.objects["mappings"], {})
+        self.assertEqual(self.api_client.command_counts["sync"], 1)
+        for blockdevice_id in self.ids:
+            self.assertIsNone(self.driver.state.attachment(blockdevice_id))
+        self.assertEqual([volume.attached_to
+                          for volume in self.driver.list_volumes()],
+                         [None] * 4)
+
+
+class K2BlockDeviceAPIMoveTest(unittest.TestCase):
+    """Tests for moving volumes from a failed node."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(self.array,
+                                                       warm_up="False")
+        self.node = self.driver.compute_instance_id()
+        self.array.register_host(u"failed", u"iqn.failed")
+        self.failed = self.driver.krest.search("hosts",
+                                               name=u"failed").hits[0]
+        self.blockdevice_id = self.driver.create_volume(
+            uuid4(), GIB).blockdevice_id
+        _, self.volume = self.driver.arrays.find_volume(self.blockdevice_id)
+
+    def _map_to_failed(self):
+        for mapping in self.driver.krest.search("mappings",
+                                                volume=self.volume):
+            mapping.delete()
+        self.driver.krest.new("mappings", volume=self.volume,
+                              host=self.failed).save()
+
+    def _mapped_hosts(self):
+        return [self.api_client.rgetattr(mapping, "host", None).name
+                for mapping in self.driver.krest.search(
+                    "mappings", volume=self.volume)]
+
+    def test_volume_moved(self):
+        """Is the volume remapped in one pass and only its LUN scanned?"""
+        self._map_to_failed()
+        volume = self.driver.move_volume(self.blockdevice_id, self.node,
+                                         from_host=u"failed")
+        join_rescans()
+        self.assertEqual(volume.attached_to, self.node)
+        self.assertEqual(self._mapped_hosts(), [self.node])
+        self.assertEqual(self.api_client.command_counts["rescan-scsi-bus.sh"],
+                         0)
+        self.assertEqual(
+            self.driver.get_device_path(self.blockdevice_id).path,
+            self.driver.state.attachment(self.blockdevice_id)["device_path"])
+
+    def test_unexpected_host_refused(self):
+        """Is a volume mapped to another host than expected left alone?"""
+        self._map_to_failed()
+        self.assertRaises(blockdevice.AlreadyAttachedVolume,
+                          self.driver.move_volume, self.blockdevice_id,
+                          self.node, from_host=u"other")
+        self.assertEqual(self._mapped_hosts(), [u"failed"])
+
+    def test_moved_away_forgotten(self):
+        """Does the old node forget a volume moved away on detach?"""
+        self.driver.attach_volume(self.blockdevice_id, self.node)
+        join_rescans()
+        self._map_to_failed()
+        self.driver.detach_volume(self.blockdevice_id)
+        join_rescans()
+        self.assertIsNone(self.driver.state.attachment(self.blockdevice_id))
+        self.assertEqual(self._mapped_hosts(), [u"failed"])
+
+
+class K2BlockDeviceAPIResizeTest(unittest.TestCase):
+    """Tests for growing volumes online."""
+
+    def setUp(self):
+        self.array = FakeK2Array(seed=0)
+        self.driver, self.api_client, _ = build_driver(self.array,
+                                                       warm_up="False")
+        self.volume = self.driver.create_volume(uuid4(), GIB)
+
+    def test_attached_volume_grown(self):
+        """Are only the paths of the LUN rescanned and its map resized?"""
+        node = self.driver.compute_instance_id()
+        self.driver.attach_volume(self.volume.blockdevice_id, node)
+        join_rescans()
+        path = self.driver.get_device_path(self.volume.blockdevice_id).path
+        rescans = self.api_client.command_counts["rescan-scsi-bus.sh"]
+        multipathd = self.api_client.command_counts["multipathd"]
+        volume = self.driver.resize_volume(self.volume.blockdevice_id,
+                                           3 * GIB)
+        self.assertEqual((volume.size, volume.attached_to), (3 * GIB, node))
+        self.assertEqual([v.size for v in self.driver.list_volumes()],
+                         [3 * GIB])
+        self.assertEqual(self.api_client.command_counts["multipathd"],
+                         multipathd + 1)
+        self.assertEqual(self.api_client.command_counts["rescan-scsi-bus.sh"],
+                         rescans)
+        rescanned = sorted(p for p in self.api_client.sysfs
+                           if p.endswith("/device/rescan"))
+        self.assertEqual(rescanned, sorted(
+            "/sys/block/{}/device/rescan".format(name) for name in
+            self.api_client.block_devices(path)[:-1]))
+
+    def test_volume_cannot_shrink(self):
+        """Is a smaller size refused and the same size accepted?"""
+        self.assertRaises(InvalidDataException, self.driver.resize_volume,
+                          self.volume.blockdevice_id, GIB // 2)
+        volume = self.driver.resize_volume(self.volume.blockdevice_id,
+                                           GIB)
+        self.assertEqual((volume.size, volume.attached_to), (GIB, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
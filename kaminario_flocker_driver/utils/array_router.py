@@ -0,0 +1,275 @@
+""" This is array_router docstring
+
+Spreads the driver over several K2 arrays: every array keeps its own
+connection, node host and portal sessions, new volumes are placed by free
+capacity and load, and volumes are found again through a serial number to
+array index.
+"""
+import logging
+import threading
+import time
+from kaminario_flocker_driver.utils.resilience import CircuitBreaker
+from kaminario_flocker_driver.utils.k2_api_client import \
+    ArrayUnavailableException
+from kaminario_flocker_driver.constants import CAPACITY_REFRESH_INTERVAL, \
+    PLACEMENT_LATENCY_UNIT
+
+LOG = logging.getLogger(__name__)
+
+
+class K2Array(object):
+    """One K2 array used by the driver.
+
+    :param name: Name of the array in logs and in the local state store.
+    :param api_client: The ``K2StorageCenterApi`` of the array.
+    :param bulk_concurrency: Size of the connection pool of bulk
+        operations.
+    """
+
+    def __init__(self, name, api_client, bulk_concurrency):
+        self.name = name
+        self.api_client = api_client
+        self.bulk_concurrency = bulk_concurrency
+        # Single instance of krest, connected on first use
+        self._krest = None
+        self._krest_lock = threading.Lock()
+        self._bulk_pool = None
+        # This node's host on the array and its portal logins
+        self.host = None
+        self.host_lock = threading.Lock()
+        # Mappings of the host, attaches in flight included, None until
+        # counted, since when it has none and the timer deleting it then
+        self.host_users = None
+        self.host_idle_since = None
+        self.host_retire = None
+        self.portals = set()
+        self.portals_refreshed = None
+        self.portal_lock = threading.Lock()
+        # Free capacity, refreshed every CAPACITY_REFRESH_INTERVAL
+        self.free_kib = None
+        self.capacity_checked = None
+        self.latency = 0.0
+        self.capacity_lock = threading.Lock()
+
+    def __repr__(self):
+        return "K2Array({})".format(self.name)
+
+    @property
+    def krest(self):
+        """The K2 API connection, opened on first use."""
+        if self._krest is None:
+            with self._krest_lock:
+                if self._krest is None:
+                    self._krest = self.api_client.connect_to_api()
+        return self._krest
+
+    @property
+    def bulk_pool(self):
+        """Pool of K2 connections shared by the bulk operations."""
+        if self._bulk_pool is None:
+            with self._krest_lock:
+                if self._bulk_pool is None:
+                    self._bulk_pool = self.api_client.endpoint_pool(
+                        self.bulk_concurrency)
+        return self._bulk_pool
+
+    def is_available(self):
+        """Whether the array is not known to be down."""
+        return self.api_client.breaker.state != CircuitBreaker.OPEN
+
+    def refresh_capacity(self, force=False):
+        """Look the free capacity of the array up, at most every
+        ``CAPACITY_REFRESH_INTERVAL`` seconds.
+
+        The round trip of the lookup is folded into ``latency``, a moving
+        average used as the load of the array.
+
+        :return: The free capacity in KiB.
+        """
+        with self.capacity_lock:
+            now = time.time()
+            if not force and self.capacity_checked is not None and \
+                    now - self.capacity_checked < CAPACITY_REFRESH_INTERVAL:
+                return self.free_kib
+            capacity = self.krest.search("system/capacity")
+            elapsed = time.time() - now
+            self.latency = elapsed if self.capacity_checked is None else \
+                0.7 * self.latency + 0.3 * elapsed
+            self.free_kib = self.api_client.rgetattr(
+                capacity.hits[0], "free", 0) if capacity.total else 0
+            self.capacity_checked = now
+            return self.free_kib
+
+    def reserve(self, size_kib):
+        """Take a placed volume off the cached free capacity, so a burst
+        of creations is spread before the next lookup."""
+        with self.capacity_lock:
+            if self.free_kib is not None:
+                self.free_kib -= size_kib
+
+    def placement_score(self, size_kib):
+        """Score of the array for a new volume, higher is better.
+
+        Free capacity is divided by the load of the array: its request
+        latency, in ``PLACEMENT_LATENCY_UNIT``, and its current busy back
+        off.
+
+        :return: The score, or None when the volume does not fit.
+        """
+        free_kib = self.refresh_capacity()
+        if free_kib < size_kib:
+            return None
+        load = 1.0 + self.latency / PLACEMENT_LATENCY_UNIT + \
+            self.api_client.pacer.delay
+        return free_kib / load
+
+
+class ArrayRouter(object):
+    """Routes the driver operations to its K2 arrays.
+
+    :param arrays: The ``K2Array``s, the first one is the primary array
+        used for host side work.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = list(arrays)
+        self.primary = self.arrays[0]
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def get(self, name):
+        """The array called ``name``, the primary one when unknown."""
+        for array in self.arrays:
+            if array.name == name:
+                return array
+        return self.primary
+
+    def remember(self, blockdevice_id, array):
+        """Record which array a volume lives on."""
+        with self._lock:
+            self._owners[blockdevice_id] = array
+
+    def forget(self, blockdevice_id):
+        """Drop a destroyed volume from the index."""
+        with self._lock:
+            self._owners.pop(blockdevice_id, None)
+
+    def owner(self, blockdevice_id):
+        """The indexed array of a volume, or None."""
+        with self._lock:
+            return self._owners.get(blockdevice_id)
+
+    def _search_order(self, blockdevice_id):
+        owner = self.owner(blockdevice_id)
+        if owner is None:
+            return self.arrays
+        return [owner] + [a for a in self.arrays if a is not owner]
+
+    def find_volume(self, blockdevice_id):
+        """Find a volume by its scsi_sn.
+
+        The indexed array is asked first, the other arrays only when the
+        volume is not indexed or was not found there. Arrays that are
+        down are skipped.
+
+        :return: ``(array, volume)``, or ``(None, None)`` if no array has
+            the volume.
+        :raises ArrayUnavailableException: If the volume was not found
+            and an array could not be asked.
+        """
+        unavailable = None
+        for array in self._search_order(blockdevice_id):
+            try:
+                volume = array.krest.search("volumes",
+                                            scsi_sn=blockdevice_id)
+            except ArrayUnavailableException as e:
+                LOG.warning('Skipping array %s: %s', array.name, e)
+                unavailable = e
+                continue
+            if volume.total > 0:
+                self.remember(blockdevice_id, array)
+                return array, volume.hits[0]
+        if unavailable is not None:
+            raise unavailable
+        self.forget(blockdevice_id)
+        return None, None
+
+    def find_volumes(self, blockdevice_ids, chunk, unavailable=None):
+        """Find many volumes, with one search per array and chunk of ids.
+
+        :param blockdevice_ids: A list of scsi_sn.
+        :param chunk: Maximum number of ids per search.
+        :param unavailable: A dict filled with scsi_sn to
+            ``ArrayUnavailableException`` for the ids not found while an
+            array was down; those arrays are skipped.
+        :return: A dict of scsi_sn to ``(array, volume)``.
+        """
+        found = {}
+        errors = {}
+
+        def search(array, ids):
+            if array.name in errors:
+                return
+            try:
+                for start in range(0, len(ids), chunk):
+                    for volume in array.krest.search(
+                            "volumes", scsi_sn=ids[start:start + chunk]).hits:
+                        found[volume.scsi_sn] = (array, volume)
+                        self.remember(volume.scsi_sn, array)
+            except ArrayUnavailableException as e:
+                LOG.warning('Skipping array %s: %s', array.name, e)
+                errors[array.name] = e
+
+        # Indexed volumes on their array first, then whatever is left
+        # everywhere
+        for array in self.arrays:
+            ids = [b for b in blockdevice_ids
+                   if b not in found and self.owner(b) is array]
+            if ids:
+                search(array, ids)
+        for array in self.arrays:
+            ids = [b for b in blockdevice_ids if b not in found]
+            if ids:
+                search(array, ids)
+        if errors and unavailable is not None:
+            error = errors.values()[0]
+            unavailable.update((b, error) for b in blockdevice_ids
+                               if b not in found)
+        return found
+
+    def place(self, size_kib):
+        """Choose the array for a new volume.
+
+        Arrays that are down or cannot fit the volume are skipped, the
+        best ``placement_score`` wins.
+
+        :param size_kib: The size of the new volume.
+        :return: The chosen ``K2Array``.
+        """
+        if len(self.arrays) == 1:
+            return self.primary
+        best, best_score = None, None
+        for array in self.arrays:
+            if not array.is_available():
+                continue
+            try:
+                score = array.placement_score(size_kib)
+            except Exception as e:
+                LOG.warning('Unable to get the capacity of %s: %s',
+                            array.name, e)
+                continue
+            if score is not None and (best is None or score > best_score):
+                best, best_score = array, score
+        if best is None:
+            LOG.warning('No array has room for %d KiB, using %s', size_kib,
+                        self.primary.name)
+            return self.primary
+        best.reserve(size_kib)
+        LOG.info('Placing a %d KiB volume on %s', size_kib, best.name)
+        return best
@@ -0,0 +1,286 @@
+""" This is call_trace docstring
+
+Records the K2 requests made by every driver operation, to report the
+number of calls each operation costs and to catch the same query being
+issued again within one operation. A finished trace, with the arguments,
+timing and host commands of its operation, can also be handed to a sink
+as a JSON-serializable dict for offline replay.
+"""
+import logging
+import threading
+import time
+import urlparse
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# One K2 request: ``status`` is the HTTP status code, or the name of the
+# exception when no answer was received; ``offset`` is the time it started
+# at, in seconds since the start of the operation
+RequestRecord = namedtuple('RequestRecord', ['method', 'resource', 'query',
+                                             'duration', 'status', 'offset'])
+# One host command: ``status`` is the exit status, or the error message
+CommandRecord = namedtuple('CommandRecord', ['command', 'duration', 'status',
+                                             'offset'])
+
+
+def _parse_url(url):
+    """Split a krest request URL into resource and query.
+
+    Object URLs keep their id, ``/api/v2/hosts/3`` gives ``hosts/3``; the
+    API root (discovery) gives ``/``.
+    """
+    parsed = urlparse.urlparse(url)
+    path = parsed.path
+    if path.startswith("/api/"):
+        path = path.split("/", 3)[3] if path.count("/") > 2 else ""
+    query = "&".join(sorted(parsed.query.split("&"))) if parsed.query \
+        else ""
+    return path.strip("/") or "/", query
+
+
+def _jsonable(value):
+    """A JSON-serializable form of an operation argument or result.
+
+    Volumes, and bulk results, are reduced to their blockdevice id.
+    """
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    if hasattr(value, "blockdevice_id"):
+        return value.blockdevice_id
+    if isinstance(value, dict):
+        return dict((unicode(key), _jsonable(item))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_jsonable(item) for item in value]
+    return unicode(value)
+
+
+def _resource_type(resource):
+    """``hosts/3`` -> ``hosts``"""
+    head, _, tail = resource.rpartition("/")
+    return head if tail.isdigit() else resource
+
+
+class OperationTrace(object):
+    """The K2 requests made by one driver operation.
+
+    :param name: The operation name.
+    :param arguments: The positional arguments of the operation, when
+        known.
+    :param keywords: Its keyword arguments.
+    """
+
+    def __init__(self, name, arguments=None, keywords=None):
+        self.name = name
+        self.arguments = _jsonable(arguments)
+        self.keywords = _jsonable(keywords or {})
+        self.records = []
+        self.commands = []
+        self.started = time.time()
+        self.finished = None
+        self.thread = threading.current_thread().name
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def record(self, method, url, duration, status):
+        """Add one request."""
+        resource, query = _parse_url(url)
+        offset = time.time() - duration - self.started
+        with self.lock:
+            self.records.append(RequestRecord(method, resource, query,
+                                              duration, status, offset))
+
+    def record_command(self, command, duration, status):
+        """Add one host command."""
+        offset = time.time() - duration - self.started
+        with self.lock:
+            self.commands.append(CommandRecord(command, duration, status,
+                                               offset))
+
+    def set_result(self, result):
+        """Keep the JSON-serializable form of the operation result."""
+        self.result = _jsonable(result)
+
+    def to_dict(self):
+        """The trace as a JSON-serializable dict."""
+        with self.lock:
+            return {
+                "operation": self.name,
+                "arguments": self.arguments,
+                "keywords": self.keywords,
+                "thread": self.thread,
+                "started": self.started,
+                "duration": (self.finished or time.time()) - self.started,
+                "result": self.result,
+                "error": self.error,
+                "requests": [record._asdict() for record in self.records],
+                "commands": [record._asdict() for record in self.commands],
+            }
+
+    @property
+    def calls(self):
+        """Number of requests made."""
+        return len(self.records)
+
+    def duplicates(self):
+        """Identical read requests issued more than once.
+
+        :return: A dict of ``"GET resource?query"`` to number of times it
+            was issued.
+        """
+        counts = defaultdict(int)
+        for record in self.records:
+            if record.method == "GET":
+                key = "GET {}".format(record.resource)
+                if record.query:
+                    key = "{}?{}".format(key, record.query)
+                counts[key] += 1
+        return dict((key, count) for key, count in counts.items()
+                    if count > 1)
+
+
+class CallTracer(object):
+    """Collects the traces of finished driver operations.
+
+    :param keep: Number of most recent operation traces kept.
+    :param sink: Called with ``to_dict()`` of every finished trace.
+    """
+
+    def __init__(self, keep=1000, sink=None):
+        self.traces = deque(maxlen=keep)
+        self.sink = sink
+        self.lock = threading.Lock()
+
+    def add(self, trace):
+        """Keep a finished operation trace."""
+        with self.lock:
+            self.traces.append(trace)
+        if self.sink is not None:
+            try:
+                self.sink(trace.to_dict())
+            except Exception as e:
+                LOG.warning('Unable to output the trace of %s: %s',
+                            trace.name, e)
+
+    def reset(self):
+        """Forget all traces."""
+        with self.lock:
+            self.traces.clear()
+
+    def report(self):
+        """Per operation call-budget report.
+
+        :return: A dict keyed by operation name with the number of traced
+            ``operations``, the ``max_calls`` and ``mean_calls`` per
+            operation, the mean time spent in K2 requests (``k2_ms``),
+            the mean count per request type (``by_request``, e.g.
+            ``GET volumes``) and the ``duplicates`` seen, with the highest
+            repeat count of each.
+        """
+        with self.lock:
+            traces = list(self.traces)
+        report = {}
+        for trace in traces:
+            entry = report.setdefault(trace.name, {
+                "operations": 0, "calls": 0, "max_calls": 0, "k2_s": 0.0,
+                "by_request": defaultdict(int), "duplicates": {}})
+            entry["operations"] += 1
+            entry["calls"] += trace.calls
+            entry["max_calls"] = max(entry["max_calls"], trace.calls)
+            for record in trace.records:
+                entry["k2_s"] += record.duration
+                entry["by_request"]["{} {}".format(
+                    record.method, _resource_type(record.resource))] += 1
+            for key, count in trace.duplicates().items():
+                entry["duplicates"][key] = max(
+                    count, entry["duplicates"].get(key, 0))
+        for entry in report.values():
+            operations = float(entry["operations"])
+            entry["mean_calls"] = round(entry.pop("calls") / operations, 3)
+            entry["k2_ms"] = round(entry.pop("k2_s") * 1000 / operations, 3)
+            entry["by_request"] = dict(
+                (key, round(count / operations, 3))
+                for key, count in entry["by_request"].items())
+        return report
+
+    def over_budget(self, budgets):
+        """Operations that made more K2 requests than allowed.
+
+        :param budgets: A dict of operation name to maximum number of
+            requests per call.
+        :return: A list of human readable violations, empty when all
+            traced operations kept to their budget.
+        """
+        violations = []
+        for name, entry in sorted(self.report().items()):
+            budget = budgets.get(name)
+            if budget is not None and entry["max_calls"] > budget:
+                violations.append(
+                    "{} made {} K2 requests, budget is {}: {}".format(
+                        name, entry["max_calls"], budget,
+                        entry["by_request"]))
+        return violations
+
+
+def current_trace():
+    """The trace of the operation running in this thread, or None."""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def trace_scope(operation, tracer=None, arguments=None, keywords=None):
+    """Trace the K2 requests of a block.
+
+    Requests made in a nested scope count for the outermost operation.
+
+    :param operation: The operation name, or an existing
+        ``OperationTrace`` to carry a trace over to another thread.
+    :param tracer: The ``CallTracer`` receiving the finished trace; with
+        None nothing new is traced.
+    :param arguments: The positional arguments of the operation, kept by
+        a new trace.
+    :param keywords: Its keyword arguments.
+    """
+    previous = current_trace()
+    if isinstance(operation, OperationTrace):
+        trace, owner = operation, False
+    elif previous is None and tracer is not None:
+        trace, owner = OperationTrace(operation, arguments, keywords), True
+    else:
+        trace, owner = previous, False
+    _local.trace = trace
+    try:
+        yield trace
+    except Exception as e:
+        if owner:
+            trace.error = u"{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        _local.trace = previous
+        if owner:
+            trace.finished = time.time()
+            tracer.add(trace)
+            duplicates = trace.duplicates()
+            if duplicates:
+                LOG.warning('%s repeated identical K2 requests: %s',
+                            trace.name, duplicates)
+
+
+def record_request(method, url, duration, status):
+    """Record a K2 request against the current operation, if traced."""
+    trace = current_trace()
+    if trace is not None:
+        trace.record(method, url, duration, status)
+
+
+def record_command(command, duration, status):
+    """Record a host command against the current operation, if traced."""
+    trace = current_trace()
+    if trace is not None:
+        trace.record_command(command, duration, status)
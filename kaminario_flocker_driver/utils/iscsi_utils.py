@@ -4,10 +4,16 @@ import logging
 import os
 import re
 import shlex
+import threading
 import time
-from subprocess import CalledProcessError, check_output
+from subprocess import CalledProcessError, PIPE, Popen
 from kaminario_flocker_driver.constants import DELAY, ITERATION_LIMIT, \
-    RESCAN_DELAY
+    RESCAN_DELAY, COMMAND_TIMEOUT, ISCSI_SESSION_FIELDS, MULTIPATH_CONF, \
+    SCHEDULER_FALLBACKS
+from kaminario_flocker_driver.utils.resilience import check_deadline, \
+    time_budget
+from kaminario_flocker_driver.utils import multipath_conf
+from kaminario_flocker_driver.utils.call_trace import record_command
 
 
 LOG = logging.getLogger(__name__)
@@ -15,31 +21,191 @@ LOG = logging.getLogger(__name__)
 
 class IscsiUtils(object):
     """iSCSI utilities for smooth communication of Host Server with K2 array"""
+    # Upper bound for any command, in seconds
+    command_timeout = COMMAND_TIMEOUT
+    # (node record parameter, value) applied to K2 targets before login
+    iscsi_node_settings = ()
+    # (target iqn, portal) node records already tuned
+    _tuned_nodes = None
 
-    @staticmethod
-    def _run_command(cmd):
+    def _run_command(self, cmd):
         """
            Run a command and capture its output. Used for common code in
            the implementation of many methods of the iscsi interface.
+
+           The command is killed once it runs longer than
+           ``command_timeout`` or past the deadline of the running
+           operation.
         :param cmd: The command arguments(the first argument
                     for the check_output)
         :returns: The output captured from the execution of the command.
+        :raises DeadlineExceeded: If the operation deadline has already
+                    passed.
         """
+        check_deadline('running {}'.format(cmd))
+        timeout = time_budget(self.command_timeout)
         status = 0
+        start = time.time()
         try:
             LOG.info('Running %s', cmd)
-            output = check_output(shlex.split(cmd))
+            process = Popen(shlex.split(cmd), stdout=PIPE)
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+            try:
+                output, _ = process.communicate()
+            finally:
+                timer.cancel()
+            if process.returncode:
+                raise CalledProcessError(process.returncode, cmd, output)
             if output:
                 LOG.debug('Result: %s', output)
         except CalledProcessError as call_error:
             output = ""
-            status = call_error.message
+            status = call_error.message or call_error.returncode
+            if call_error.returncode == -9:
+                LOG.error('Command %s killed after %.1fs', cmd, timeout)
         except OSError as os_err:
             output = ""
             status = os_err.message
 
+        record_command(cmd, time.time() - start, status)
         return output, status
 
+    @staticmethod
+    def _list_devices():
+        """List the device nodes present under /dev.
+
+        :returns: A list of device node names.
+        """
+        return os.listdir('/dev/')
+
+    @staticmethod
+    def _path_exists(path):
+        """Whether ``path`` exists on this host."""
+        return os.path.exists(path)
+
+    @staticmethod
+    def _read_file(path):
+        """Read a file, an empty string if it does not exist."""
+        try:
+            with open(path) as conf_file:
+                return conf_file.read()
+        except IOError:
+            return ""
+
+    @staticmethod
+    def _write_file(path, content):
+        """Replace a file atomically."""
+        temp_path = "{}.flocker-tmp".format(path)
+        with open(temp_path, "w") as conf_file:
+            conf_file.write(content)
+            conf_file.flush()
+            os.fsync(conf_file.fileno())
+        os.rename(temp_path, path)
+
+    @staticmethod
+    def _realpath(path):
+        """Resolve the symbolic links of a device path."""
+        return os.path.realpath(path)
+
+    @staticmethod
+    def _list_dir(path):
+        """List a directory, empty if it does not exist."""
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+
+    @staticmethod
+    def _write_sysfs(path, value):
+        """Write a sysfs attribute.
+
+        :return: True if the kernel accepted the value.
+        """
+        try:
+            with open(path, "w") as sysfs_file:
+                sysfs_file.write(value)
+            return True
+        except IOError:
+            return False
+
+    def block_devices(self, path):
+        """Kernel names of a device and of the paths under it.
+
+        :param path: Device path (e.g. /dev/mapper/mpathb or /dev/sdb).
+        :returns: The names of the slave paths (e.g. sdb, sdc) followed by
+            the name of the device itself (e.g. dm-2), empty if the device
+            is gone.
+        """
+        if not path or not self._path_exists(path):
+            return []
+        name = os.path.basename(self._realpath(path))
+        slaves = self._list_dir('/sys/block/{}/slaves'.format(name))
+        return sorted(slaves) + [name]
+
+    def resize_device(self, path):
+        """Make this node see the new size of a grown LUN.
+
+        Only the ``sd`` paths of the LUN are rescanned, then its multipath
+        map is resized.
+
+        :param path: The multipath device of the LUN, or its ``sd`` path.
+        :returns: False if a path could not be rescanned or the map could
+            not be resized.
+        """
+        names = self.block_devices(path)
+        resized = bool(names)
+        for name in names:
+            if name.startswith('sd') and not self._write_sysfs(
+                    '/sys/block/{}/device/rescan'.format(name), '1'):
+                resized = False
+        if resized and '/dev/mapper/' in path:
+            output, status = self._run_command('multipathd resize map {}'
+                                               .format(os.path.basename(path)))
+            resized = not status and 'fail' not in output
+        return resized
+
+    def tune_block_queue(self, name, settings):
+        """Apply block queue settings to a device.
+
+        A blk-mq scheduler name the kernel refuses is retried with its
+        single queue equivalent (``none`` as ``noop``).
+
+        :param name: Kernel name of the device, e.g. sdb or dm-2.
+        :param settings: A list of ``(queue attribute, value)``.
+        :returns: The settings the kernel refused.
+        """
+        refused = []
+        for attribute, value in settings:
+            path = '/sys/block/{}/queue/{}'.format(name, attribute)
+            if self._write_sysfs(path, value):
+                continue
+            fallback = SCHEDULER_FALLBACKS.get(value) \
+                if attribute == 'scheduler' else None
+            if fallback and self._write_sysfs(path, fallback):
+                continue
+            refused.append((attribute, value))
+        return refused
+
+    def device_matches(self, path, device_id):
+        """Check that a previously found device path still belongs to
+        the given device.
+
+        :param path: Device path (e.g. /dev/mapper/mpathb or /dev/sdb).
+        :param device_id: The page 80 device id.
+        :returns: True if the path exists and reports the device id.
+        """
+        if not path or not self._path_exists(path):
+            return False
+        if '/dev/mapper/' in path:
+            output, status = self._run_command('multipath -l {}'.format(
+                path.replace('/dev/mapper/', '')))
+        else:
+            output, status = self._run_command(
+                '/lib/udev/scsi_id --page=0x80 '
+                '--whitelisted --device={}'.format(path))
+        return device_id in output
+
     def _iscsi_login_logout(self, target_iqn, login_action):
         """
             Perform the iSCSI login or logout depending on the caller
@@ -60,6 +226,32 @@ class IscsiUtils(object):
             LOG.info('Error logging in.')
         return False
 
+    def _update_iscsi_node(self, target_iqn, portal):
+        """Apply ``iscsi_node_settings`` to the node record of a target
+        portal, once per portal.
+
+        Settings are read by open-iscsi at login, live sessions keep
+        theirs until logged in again.
+
+        :param target_iqn: The target iqn.
+        :param portal: The portal, ``ip:port``.
+        """
+        if self._tuned_nodes is None:
+            self._tuned_nodes = set()
+        if not self.iscsi_node_settings or \
+                (target_iqn, portal) in self._tuned_nodes:
+            return None
+        for name, value in self.iscsi_node_settings:
+            output, status = self._run_command(
+                'iscsiadm -m node -T {} -p {} -o update -n {} -v {}'.format(
+                    target_iqn, portal, name, value))
+            if status != 0:
+                LOG.error('Unable to set %s=%s for %s at %s: %s', name,
+                          value, target_iqn, portal, status)
+        LOG.info('Tuned iSCSI node %s at %s', target_iqn, portal)
+        self._tuned_nodes.add((target_iqn, portal))
+        return None
+
     def _iscsi_discovery_login_logout(self, ip_address,
                                       port, login_action=True):
         """Manage iSCSI sessions for K2 storage device data ports."""
@@ -71,9 +263,93 @@ class IscsiUtils(object):
                 continue
             target = line.split(' ')
             target_iqn = target[1]
+            if login_action:
+                self._update_iscsi_node(target_iqn, target[0].split(',')[0])
             self._iscsi_login_logout(target_iqn, login_action)
         return None
 
+    def iscsi_sessions(self):
+        """List the live iSCSI sessions with their negotiated settings.
+
+        Parses ``iscsiadm -m session -P 2``, e.g.::
+
+            Target: iqn.2009-01.com.kaminario:storage.k2.54615 (non-flash)
+                Current Portal: 10.11.57.2:3260,1
+                ...
+                SID: 3
+                ...
+                Recovery Timeout: 120
+                ...
+                HeaderDigest: None
+                MaxBurstLength: 262144
+
+        :return: A list of dicts with the ``target``, ``portal`` and every
+            ``field: value`` line of the session.
+        """
+        output, status = self._run_command('iscsiadm -m session -P 2')
+        sessions = []
+        target = None
+        for line in output.split('\n'):
+            key, sep, value = line.strip().partition(': ')
+            if not sep:
+                continue
+            if key == 'Target':
+                target = value.split(' ')[0]
+            elif key == 'Current Portal':
+                sessions.append({'target': target,
+                                 'portal': value.split(',')[0]})
+            elif sessions:
+                sessions[-1].setdefault(key, value)
+        return sessions
+
+    def verify_iscsi_sessions(self):
+        """Check that the live sessions to tuned K2 targets run with
+        ``iscsi_node_settings``.
+
+        Portals with fewer sessions than ``node.session.nr_sessions`` get
+        the missing ones added. Queue depth and cmds_max are not shown
+        for live sessions and are not checked.
+
+        :return: A list of human readable mismatches, empty when all
+            settings took effect.
+        """
+        settings = dict(self.iscsi_node_settings)
+        tuned = self._tuned_nodes
+        if not settings or not tuned:
+            return []
+        mismatches = []
+        by_portal = {}
+        for session in self.iscsi_sessions():
+            node = (session['target'], session['portal'])
+            if node not in tuned:
+                continue
+            by_portal.setdefault(node, []).append(session)
+            for name, field in ISCSI_SESSION_FIELDS.items():
+                if name not in settings or field not in session:
+                    continue
+                wanted = u"{}".format(settings[name])
+                live = session[field]
+                if live != wanted and live not in wanted.split(','):
+                    mismatches.append('{} at {} session {}: {} is {}, '
+                                      'configured {}'.format(
+                                          node[0], node[1],
+                                          session.get('SID'), field, live,
+                                          wanted))
+        wanted = int(settings.get('node.session.nr_sessions', 1))
+        for (target_iqn, portal), sessions in sorted(by_portal.items()):
+            for _ in range(wanted - len(sessions)):
+                output, status = self._run_command(
+                    'iscsiadm -m session -r {} --op new'.format(
+                        sessions[0].get('SID')))
+                if status != 0:
+                    mismatches.append('{} at {} has {} sessions, configured '
+                                      '{}'.format(target_iqn, portal,
+                                                  len(sessions), wanted))
+                    break
+        for mismatch in mismatches:
+            LOG.warning('iSCSI setting not in effect: %s', mismatch)
+        return mismatches
+
     def _get_multipath_device(self, scsi_device):
         """
         Get the multi-path device for a K2 volume.
@@ -191,7 +467,7 @@ class IscsiUtils(object):
         """
         result = []
         regex = re.compile(r'sd[a-z]+(?![\d])')
-        for dev in os.listdir('/dev/'):
+        for dev in self._list_devices():
             if regex.match(dev):
                 try:
                     output, status = self._run_command(
@@ -218,9 +494,158 @@ class IscsiUtils(object):
                     result.insert(0, mpath_dev)
                     break
                 retries += 1
+                check_deadline('waiting for multipath device')
                 time.sleep(DELAY)
         return result
 
+    def k2_devices(self, known=None):
+        """The SCSI devices (``sd`` paths) of K2 LUNs on this node.
+
+        :param known: Identifications already read, by device name; they
+            are reused instead of running scsi_id again and the new ones
+            are added.
+        :returns: A dict of device name to its page 80 identification,
+            which holds the volume serial number.
+        """
+        known = {} if known is None else known
+        devices = {}
+        regex = re.compile(r'sd[a-z]+(?![\d])')
+        for dev in self._list_devices():
+            if regex.match(dev):
+                if dev not in known:
+                    output, status = self._run_command(
+                        '/lib/udev/scsi_id --page=0x80 '
+                        '--whitelisted --device=/dev/{}'.format(dev))
+                    known[dev] = output.strip()
+                if 'KMNRIO' in known[dev]:
+                    devices[dev] = known[dev]
+        return devices
+
+    def scan_luns(self, luns):
+        """Scan only some LUNs on every iSCSI session of this node,
+        instead of a full rescan of all sessions and buses.
+
+        :param luns: The LUN numbers to scan for.
+        :return: False if no iSCSI host was found to scan.
+        """
+        hosts = self._list_dir('/sys/class/iscsi_host')
+        for host in sorted(hosts):
+            for lun in sorted(set(luns)):
+                self._write_sysfs('/sys/class/scsi_host/{}/scan'.format(host),
+                                  '- - {}'.format(lun))
+        if not hosts:
+            return False
+        self._run_multipath()
+        return True
+
+    def find_devices(self, device_ids, retries=0):
+        """Look for the devices of several volumes together.
+
+        Every round reads the identification of the new ``sd`` devices
+        only, once for all the volumes.
+
+        :param device_ids: The page 80 device ids.
+        :param retries: Rounds to wait, ``DELAY`` apart, for volumes
+            whose devices or multipath device are missing.
+        :returns: A dict of device id to its local paths, the multipath
+            device first when there is one; volumes without device are
+            left out.
+        """
+        known = {}
+        found = {}
+        retry = 0
+        while True:
+            devices = self.k2_devices(known)
+            for device_id in device_ids:
+                if found.get(device_id, [""])[0].startswith('/dev/mapper/'):
+                    continue
+                paths = sorted('/dev/{}'.format(name)
+                               for name, ident in devices.items()
+                               if device_id in ident)
+                if paths:
+                    mpath_dev = self._get_multipath_device(paths[0])
+                    found[device_id] = [mpath_dev] + paths if mpath_dev \
+                        else paths
+            missing = [device_id for device_id in device_ids
+                       if not found.get(device_id, [""])[0].startswith(
+                           '/dev/mapper/')]
+            if not missing or retry >= retries:
+                return found
+            retry += 1
+            check_deadline('waiting for the devices of {}'.format(missing))
+            time.sleep(DELAY)
+
+    def k2_multipath_maps(self):
+        """The multipath maps of K2 LUNs on this node.
+
+        Parsed from ``multipath -ll``, e.g.::
+
+            mpathb (20024f400d5570001) dm-2 KMNRIO ,k2
+            size=2.0G features='0' hwhandler='0' wp=rw
+            `-+- policy='queue-length 0' prio=1 status=active
+              |- 11:0:0:2 sdw 8:32 active ready running
+              `- 12:0:0:2 sdx 8:64 active ready running
+
+        :returns: A dict of map name to the list of its ``sd`` paths.
+        """
+        maps = {}
+        current = None
+        output, status = self._run_command('multipath -ll')
+        path_regex = re.compile(r'\d+:\d+:\d+:\d+\s+(sd[a-z]+)\s')
+        for line in output.split('\n'):
+            if line[:1].isalnum() and not line.startswith('size='):
+                current = line.split(' ')[0] if 'KMNRIO' in line else None
+                if current is not None:
+                    maps[current] = []
+                continue
+            match = path_regex.search(line)
+            if match and current is not None:
+                maps[current].append(match.group(1))
+        return maps
+
+    def remove_scsi_device(self, name):
+        """Remove a SCSI device (one path of a LUN) from the kernel.
+
+        :param name: The device name, e.g. ``sdc``.
+        :return: True if the kernel accepted the removal.
+        """
+        return self._write_sysfs('/sys/block/{}/device/delete'.format(name),
+                                 '1')
+
+    def multipath_drift(self, settings):
+        """Compare the multipath configuration in effect for K2 LUNs with
+        the wanted settings.
+
+        The configuration multipathd runs with (``multipathd show
+        config``, built in defaults included) is used, ``multipath.conf``
+        when multipathd does not answer.
+
+        :param settings: A list of ``(attribute, value)``.
+        :return: A list of human readable differences.
+        """
+        output, status = self._run_command('multipathd show config')
+        if status != 0 or not output:
+            output = self._read_file(MULTIPATH_CONF)
+        return multipath_conf.device_drift(output, settings)
+
+    def apply_multipath_policy(self, settings):
+        """Write the K2 ``device`` section of ``multipath.conf`` and
+        reload multipathd, only if the file is missing a setting.
+
+        :param settings: A list of ``(attribute, value)``.
+        :return: True if the configuration was changed.
+        """
+        current = self._read_file(MULTIPATH_CONF)
+        if not multipath_conf.device_drift(current, settings) and \
+                len(multipath_conf.k2_device_sections(current)) == 1:
+            return False
+        self._write_file(MULTIPATH_CONF, multipath_conf.with_device_section(
+            current, settings))
+        output, status = self._run_command('multipathd reconfigure')
+        LOG.info('Applied K2 multipath policy to %s, reload status %s',
+                 MULTIPATH_CONF, status)
+        return True
+
     def sync_device(self):
         """synchronize data on disk with memory
 
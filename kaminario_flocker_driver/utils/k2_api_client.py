@@ -2,14 +2,21 @@
 import logging
 import functools
 import platform
-import bitmath
 import krest
 import threading
 import time
 import ast
-from requests.exceptions import HTTPError
+import uuid
+from urllib import urlencode
+from requests.exceptions import ConnectionError, HTTPError, Timeout
 from kaminario_flocker_driver.utils.iscsi_utils import IscsiUtils
-from kaminario_flocker_driver.constants import TRUE_EXP
+from kaminario_flocker_driver.utils.resilience import CircuitBreaker, \
+    DeadlineExceeded, SingleFlight, check_deadline, time_budget
+from kaminario_flocker_driver.utils.call_trace import record_request
+from kaminario_flocker_driver.constants import TRUE_EXP, RETRIES, \
+    BUSY_MIN_DELAY, BUSY_MAX_DELAY, REQUEST_TIMEOUT, \
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, LEN_OF_DATASET_ID, \
+    VOLUME_STATS_FIELDS, BULK_SEARCH_CHUNK
 
 LOG = logging.getLogger(__name__)
 
@@ -25,18 +32,18 @@ class FunctionalUtility(IscsiUtils):
         """Convert size in bytes to KiB.
 
         :param size: The number of bytes.
-        :returns: The size in Kilobytes.
+        :returns: The size in Kilobytes, rounded up to a whole one.
         """
-        return bitmath.Byte(size).to_KiB().value
+        return -(-int(size) // 1024)
 
     @staticmethod
     def kib_to_bytes(size):
         """Convert  KiB to size in bytes.
 
         :param size: The number of Kilobytes.
-        :returns: The size in Kilobytes.
+        :returns: The size in bytes.
         """
-        return bitmath.KiB(size).to_Byte().value
+        return int(size) * 1024
 
     @staticmethod
     def is_true(flag):
@@ -78,6 +85,74 @@ class FunctionalUtility(IscsiUtils):
                 return getattr(obj, name, default)
         return functools.reduce(_getattr, [obj]+attr.split('.'))
 
+    @staticmethod
+    def ref_object(ep, obj, attr):
+        """Build a krest object for a reference attribute without
+        fetching it from the array.
+
+        :param ep: krest end point the object is bound to.
+        :param obj: Krest object holding the reference.
+        :param attr: Name of the reference attribute.
+        :return: A ``krest.RestObject`` usable for ``delete``, or None.
+        """
+        ref = obj._get_raw(attr) if attr in obj._current else None
+        if ref is None:
+            return None
+        return krest.RestObject(ep, ref._resource_type, id=ref.id)
+
+    @staticmethod
+    def ref_id(obj, attr):
+        """The id of the object a reference attribute points to, without
+        fetching it from the array.
+
+        :param obj: Krest object holding the reference.
+        :param attr: Name of the reference attribute.
+        :return: The id, or None.
+        """
+        ref = obj._get_raw(attr) if attr in obj._current else None
+        return getattr(ref, "id", None)
+
+    @staticmethod
+    def encode_tag(**fields):
+        """Build the ``description`` tag of a driver-owned K2 object.
+
+        :param fields: Tag fields, e.g. ``cluster=<cluster_id>``. Fields
+            set to None are left out.
+        :return: The tag, ``key=value`` pairs joined by commas, in key
+            order.
+        """
+        return u",".join(u"{}={}".format(key, value)
+                         for key, value in sorted(fields.items())
+                         if value is not None)
+
+    @staticmethod
+    def decode_tag(tag):
+        """Parse a tag built by ``encode_tag``.
+
+        :param tag: The ``description`` of a K2 object, may be None.
+        :return: A dict of the tag fields, empty for an untagged object.
+        """
+        fields = {}
+        for item in (tag or u"").split(u","):
+            key, sep, value = item.partition(u"=")
+            if sep:
+                fields[key.strip()] = value.strip()
+        return fields
+
+    @staticmethod
+    def dataset_id_of(name):
+        """Flocker dataset ID of a driver volume or volume group.
+
+        :param name: The K2 name, a prefix then the dataset ID (e.g.
+            ``K2F-<dataset_id>``).
+        :return: The dataset ``UUID``, or None if the name holds none.
+        """
+        try:
+            # Assumption: dataset id is of 36 chars.
+            return uuid.UUID(u"{0}".format(name)[-LEN_OF_DATASET_ID:])
+        except ValueError:
+            return None
+
     @staticmethod
     def get_attr_list(query):
         """Make list if attributes
@@ -115,6 +190,49 @@ class FunctionalUtility(IscsiUtils):
         return return_set
 
 
+class BusyPacer(object):
+    """Shared request pacing for the connections to one K2 array.
+
+    Every "busy" answer from the array doubles the delay applied before
+    the next request on any connection sharing the pacer, every successful
+    request halves it again. With an idle array no delay is applied.
+    """
+
+    def __init__(self, min_delay=BUSY_MIN_DELAY, max_delay=BUSY_MAX_DELAY):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, retry=False):
+        """Sleep for the current pacing delay.
+
+        :param retry: True when the request is a retry of a busy answer,
+            which always waits at least ``min_delay``.
+        """
+        delay = self.delay
+        if retry:
+            delay = max(delay, self.min_delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_busy(self):
+        """The array answered busy: slow down."""
+        with self.lock:
+            self.delay = min(self.max_delay,
+                             max(self.min_delay, self.delay * 2))
+            LOG.info("K2 array is busy, pacing requests by %.2fs", self.delay)
+
+    def on_success(self):
+        """A request went through: speed up again."""
+        if not self.delay:
+            return
+        with self.lock:
+            self.delay /= 2
+            if self.delay < self.min_delay / 4:
+                self.delay = 0.0
+
+
 class KrestExtendedEndPoint(krest.EndPoint):
     """This is extended class of Krest EndPoint
 
@@ -123,15 +241,43 @@ class KrestExtendedEndPoint(krest.EndPoint):
     """
     instances = []  # list of class instances
 
+    class RetryCfg(krest.EndPoint.RetryCfg):
+        """No blind retries inside krest: they can hold a call for up to
+        ten minutes. Busy answers are retried by ``_request`` and an
+        unreachable array is handled by the circuit breaker."""
+        on_connect_errors = False
+        on_5xx_errors = False
+        on_other_errors = False
+
     def __init__(self, *args, **kwargs):
         self.krestlock = threading.Lock()
         KrestExtendedEndPoint.instances.append(self)
-        if "retries" in kwargs:
-            self.retries = int(kwargs["retries"])
-            del kwargs["retries"]
+        self.retries = int(kwargs.pop("retries", None) or RETRIES)
+        self.pacer = kwargs.pop("pacer", None) or BusyPacer()
+        self.breaker = kwargs.pop("breaker", None) or CircuitBreaker(
+            args[0] if args else "K2")
+        self.request_timeout = kwargs.pop("request_timeout", REQUEST_TIMEOUT)
+        self.single_flight = kwargs.pop("single_flight", None)
 
         super(KrestExtendedEndPoint, self).__init__(*args, **kwargs)
 
+    def search(self, resource_type, options={}, **query):
+        """Search the array.
+
+        Identical searches running at the same time on connections
+        sharing a ``single_flight`` are answered by a single request;
+        every caller still gets its own result set. A search never shares
+        the answer of one sent before a write completed.
+        """
+        if self.single_flight is None or options:
+            return super(KrestExtendedEndPoint, self).search(
+                resource_type, options, **query)
+        self._serialize_query_objects(query)
+        url = "{}?{}".format(self._resource_url(resource_type),
+                             urlencode(sorted(query.items())))
+        data = self.single_flight.do(url, lambda: self._request("GET", url))
+        return krest.ResultSet(self, resource_type, data, query)
+
     @staticmethod
     def _should_retry(status_code, message):
         LOG.info("Instaces count %d", len(KrestExtendedEndPoint.instances))
@@ -145,27 +291,66 @@ class KrestExtendedEndPoint(krest.EndPoint):
         else:
             return False
 
+    @staticmethod
+    def _error_message(response):
+        """Extract the K2 error message from an error response."""
+        try:
+            return ast.literal_eval(response.text)['error_msg']
+        except (ValueError, SyntaxError, KeyError, TypeError):
+            return response.text
+
     def _request(self, method, *args, **kwargs):
         i = 0
         while i < self.retries:
-            if i > 0:
-                time.sleep(1)
+            self.pacer.wait(retry=i > 0)
+            check_deadline('K2 {} request'.format(method))
+            if not self.breaker.allow():
+                raise ArrayUnavailableException(
+                    'K2 array {} is unavailable, failing fast'.format(
+                        self.base_url))
+            url = args[0] if args else kwargs.get('endpoint')
             try:
                 LOG.info("running through the _request wrapper...")
                 self.krestlock.acquire()
-                return super(KrestExtendedEndPoint, self)._request(
+                check_deadline('K2 {} request'.format(method))
+                kwargs['timeout'] = time_budget(self.request_timeout)
+                if kwargs['timeout'] == 0:
+                    raise DeadlineExceeded(
+                        'No time left for K2 {} request'.format(method))
+                start = time.time()
+                result = super(KrestExtendedEndPoint, self)._request(
                     method, *args, **kwargs)
+                record_request(method, url, time.time() - start, 200)
+                self.pacer.on_success()
+                self.breaker.on_success()
+                return result
             except HTTPError as ex:
-                if self._should_retry(ex.response.status_code, ast.literal_eval(
-                        ex.response.text)['error_msg']):
+                record_request(method, url, time.time() - start,
+                               ex.response.status_code)
+                if ex.response.status_code >= 500:
+                    self.breaker.on_failure()
+                else:
+                    self.breaker.on_success()
+                if self._should_retry(ex.response.status_code,
+                                      self._error_message(ex.response)):
+                    self.pacer.on_busy()
                     i += 1
                     continue
                 else:
                     raise Exception('%s' % ex.response.text)
-            except Exception as ex:
-                raise Exception('%s' % ex.message)
+            except (ConnectionError, Timeout) as ex:
+                record_request(method, url, time.time() - start,
+                               type(ex).__name__)
+                self.breaker.on_failure()
+                raise ArrayUnavailableException(
+                    'K2 request failed: {}'.format(ex))
             finally:
                 self.krestlock.release()
+                if method != "GET" and self.single_flight is not None:
+                    self.single_flight.invalidate()
+        raise ArrayUnavailableException(
+            'K2 array {} is still busy after {} attempts'.format(
+                self.base_url, self.retries))
 
 
 class K2StorageCenterApi(FunctionalUtility):
@@ -190,6 +375,19 @@ class K2StorageCenterApi(FunctionalUtility):
         self.password = password
         self.is_ssl = self.is_true(is_ssl)
         self.retries = retries
+        self.request_timeout = REQUEST_TIMEOUT
+        # Shared by all connections to this array for busy-aware pacing
+        # and for failing fast while the array is down
+        self.pacer = BusyPacer()
+        self.breaker = CircuitBreaker(host, CIRCUIT_FAILURE_THRESHOLD,
+                                      CIRCUIT_RESET_TIMEOUT)
+        # Coalesces identical searches in flight on any connection
+        self.single_flight = SingleFlight()
+
+    def _new_endpoint(self, **kwargs):
+        """Create a krest end point to this array."""
+        return KrestExtendedEndPoint(self.host, self.username, self.password,
+                                     **kwargs)
 
     def connect_to_api(self):
         """It will connect to K2 API layer.
@@ -198,19 +396,95 @@ class K2StorageCenterApi(FunctionalUtility):
         :raises: StorageDriverAPIException
         """
         try:
-            ep = KrestExtendedEndPoint(self.host, self.username,
-                                       self.password, ssl_validate=self.is_ssl,
-                                       retries=self.retries)
+            ep = self._new_endpoint(ssl_validate=self.is_ssl,
+                                    retries=self.retries, pacer=self.pacer,
+                                    breaker=self.breaker,
+                                    request_timeout=self.request_timeout,
+                                    single_flight=self.single_flight)
+        except ArrayUnavailableException:
+            raise
         except Exception as e:
             raise StorageDriverAPIException('K2 API connection failure: {}'.
                                             format(e))
         return ep
 
+    def volume_stats(self, krest, volumes):
+        """Latest performance counters of volumes.
+
+        The counters of all the volumes come from one ``stats/volumes``
+        search per ``BULK_SEARCH_CHUNK`` volumes.
+
+        :param krest: The krest end point of the array.
+        :param volumes: A list of volume krest objects.
+        :return: A dict of volume id to a dict of K2 counter name (see
+            ``VOLUME_STATS_FIELDS``) to value.
+        """
+        stats = {}
+        for start in range(0, len(volumes), BULK_SEARCH_CHUNK):
+            for stat in krest.search(
+                    "stats/volumes",
+                    volume=volumes[start:start + BULK_SEARCH_CHUNK],
+                    **{"__datapoints": 1}):
+                stats[self.ref_id(stat, "volume")] = dict(
+                    (field, self.rgetattr(stat, field, 0) or 0)
+                    for field, _, _, _ in VOLUME_STATS_FIELDS)
+        return stats
+
+    def endpoint_pool(self, size):
+        """Create a pool of up to ``size`` K2 API connections.
+
+        :param size: Maximum number of concurrent connections.
+        :return: An ``EndPointPool``.
+        """
+        return EndPointPool(self.connect_to_api, size)
+
+
+class EndPointPool(object):
+    """Bounded pool of krest end points.
+
+    ``KrestExtendedEndPoint`` serializes the requests issued through one
+    connection, bulk operations check out one connection per worker to
+    keep several requests in flight.
+    """
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = max(1, int(size))
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Check out a connection, opening a new one if allowed."""
+        with self.condition:
+            while not self.idle and self.created >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, ep):
+        """Return a connection checked out with ``acquire``."""
+        with self.condition:
+            self.idle.append(ep)
+            self.condition.notify()
+
 
 class StorageDriverAPIException(Exception):
     """K2(krest) backend API exception."""
 
 
+class ArrayUnavailableException(StorageDriverAPIException):
+    """The K2 array is unreachable or its circuit breaker is open."""
+
+
 class InvalidDataException(Exception):
     """Invalid data exception.
 
@@ -0,0 +1,115 @@
+""" This is metrics docstring
+
+Gauges of the driver in the Prometheus text format, served over HTTP for
+the agent to scrape or written to a node_exporter textfile.
+"""
+import BaseHTTPServer
+import logging
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+def _escape(value):
+    """Escape a label value."""
+    return unicode(value).replace(u"\\", u"\\\\").replace(
+        u"\n", u"\\n").replace(u'"', u'\\"')
+
+
+class MetricsRegistry(object):
+    """The current value of every driver gauge."""
+
+    def __init__(self):
+        self._help = {}
+        self._samples = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        """Declare a gauge.
+
+        :param name: Metric name, e.g. ``kaminario_volume_iops``.
+        :param help_text: One line description of the gauge.
+        """
+        with self.lock:
+            self._help[name] = help_text
+            self._samples.setdefault(name, {})
+
+    def replace(self, name, samples):
+        """Set all the samples of a gauge, dropping those not given.
+
+        :param name: A declared metric name.
+        :param samples: A list of ``(labels, value)``, labels being a dict.
+        """
+        with self.lock:
+            self._samples[name] = dict(
+                (tuple(sorted(labels.items())), value)
+                for labels, value in samples)
+
+    def samples(self, name):
+        """The samples of a gauge.
+
+        :return: A dict of label tuples to value.
+        """
+        with self.lock:
+            return dict(self._samples.get(name, {}))
+
+    def render(self):
+        """The gauges in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name in sorted(self._samples):
+                lines.append(u"# HELP {} {}".format(name, self._help[name]))
+                lines.append(u"# TYPE {} gauge".format(name))
+                for labels, value in sorted(self._samples[name].items()):
+                    label_text = u",".join(
+                        u'{}="{}"'.format(key, _escape(label))
+                        for key, label in labels)
+                    lines.append(u"{}{{{}}} {!r}".format(
+                        name, label_text, float(value)))
+        return u"\n".join(lines) + u"\n"
+
+    def write_textfile(self, path):
+        """Write the gauges to a file, replacing it atomically so a
+        collector never reads a partial file."""
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write(self.render().encode("utf-8"))
+        os.rename(temp_path, path)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers ``GET /metrics`` from the registry of the server."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug("metrics %s", format % args)
+
+
+def serve_metrics(registry, port, address="127.0.0.1"):
+    """Serve a registry over HTTP from a background thread.
+
+    :param registry: The ``MetricsRegistry`` to serve.
+    :param port: TCP port to listen on, 0 for any free port.
+    :param address: Address to listen on, the loopback by default; "" for
+        all interfaces.
+    :return: The ``HTTPServer``, its ``server_port`` is the port used.
+    """
+    server = BaseHTTPServer.HTTPServer((address, port), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.name = 'k2_metrics'
+    thread.daemon = True
+    thread.start()
+    LOG.info('Serving metrics on %s:%d', address or '*', server.server_port)
+    return server
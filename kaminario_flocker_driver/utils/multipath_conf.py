@@ -0,0 +1,139 @@
+""" This is multipath_conf docstring
+
+Reads and edits the ``device`` section for K2 LUNs (vendor ``KMNRIO``,
+product ``K2``) of a multipath.conf, or of the ``multipathd show config``
+output which has the same syntax.
+"""
+import re
+
+K2_VENDOR = "KMNRIO"
+K2_PRODUCT = "K2"
+
+
+def _unquote(value):
+    return value.strip().strip('"')
+
+
+def _quote(value):
+    value = u"{}".format(value)
+    return u'"{}"'.format(value) if " " in value else value
+
+
+def parse_sections(text):
+    """Parse the sections of a multipath configuration.
+
+    :param text: The configuration.
+    :return: A list of dicts, one per section in closing order, with the
+        ``path`` of section names (e.g. ``("devices", "device")``), the
+        ``start`` and ``end`` line numbers and the ``attributes``.
+    """
+    sections = []
+    stack = []
+    for number, line in enumerate(text.split("\n")):
+        stripped = re.split(r"[#!]", line, 1)[0].strip()
+        if not stripped:
+            continue
+        if stripped.endswith("{"):
+            stack.append({"name": stripped[:-1].strip(), "start": number,
+                          "attributes": {}})
+        elif stripped == "}":
+            if not stack:
+                continue
+            section = stack.pop()
+            section["end"] = number
+            section["path"] = tuple(s["name"] for s in stack) + \
+                (section.pop("name"),)
+            sections.append(section)
+        elif stack:
+            parts = stripped.split(None, 1)
+            stack[-1]["attributes"][parts[0]] = \
+                parts[1] if len(parts) > 1 else ""
+    return sections
+
+
+def _is_k2_device(section):
+    if section["path"][-2:] != ("devices", "device"):
+        return False
+    attributes = section["attributes"]
+    product = _unquote(attributes.get("product", ""))
+    try:
+        product_matches = re.match(product, K2_PRODUCT, re.I) is not None
+    except re.error:
+        product_matches = False
+    return _unquote(attributes.get("vendor", "")) == K2_VENDOR and \
+        product_matches
+
+
+def k2_device_sections(text):
+    """The ``device`` sections of a configuration matching K2 LUNs."""
+    return [section for section in parse_sections(text)
+            if _is_k2_device(section)]
+
+
+def device_drift(text, settings):
+    """Compare the K2 ``device`` section of a configuration with the
+    wanted settings.
+
+    The last matching section is used, as multipath does.
+
+    :param text: The configuration.
+    :param settings: A list of ``(attribute, value)``.
+    :return: A list of human readable differences, empty when the
+        section has all the settings.
+    """
+    sections = k2_device_sections(text)
+    if not sections:
+        return ["no device section for {} {}".format(K2_VENDOR, K2_PRODUCT)]
+    attributes = sections[-1]["attributes"]
+    drift = []
+    for name, value in settings:
+        wanted = _unquote(u"{}".format(value))
+        if name not in attributes:
+            drift.append("{} is not set, recommended {}".format(
+                name, wanted))
+        elif _unquote(attributes[name]) != wanted:
+            drift.append("{} is {}, recommended {}".format(
+                name, _unquote(attributes[name]), wanted))
+    return drift
+
+
+def render_device_section(settings, indent="\t"):
+    """Render the K2 ``device`` section.
+
+    :param settings: A list of ``(attribute, value)``.
+    :return: The section lines, indented for a ``devices`` section.
+    """
+    lines = [indent + "device {",
+             indent * 2 + 'vendor "{}"'.format(K2_VENDOR),
+             indent * 2 + 'product "{}"'.format(K2_PRODUCT)]
+    lines.extend(indent * 2 + u"{} {}".format(name, _quote(value))
+                 for name, value in settings)
+    lines.append(indent + "}")
+    return lines
+
+
+def with_device_section(text, settings):
+    """Replace the K2 ``device`` sections of a configuration.
+
+    :param text: The current configuration, may be empty.
+    :param settings: A list of ``(attribute, value)``.
+    :return: The configuration with a single K2 ``device`` section, in
+        its ``devices`` section, holding the settings.
+    """
+    lines = text.split("\n") if text else []
+    for section in sorted(k2_device_sections(text),
+                          key=lambda s: s["start"], reverse=True):
+        del lines[section["start"]:section["end"] + 1]
+    block = render_device_section(settings)
+    devices = [section for section in parse_sections("\n".join(lines))
+               if section["path"] == ("devices",)]
+    if devices:
+        end = devices[-1]["end"]
+        lines[end:end] = block
+    else:
+        if lines and lines[-1] == "":
+            lines.pop()
+        lines.extend(["devices {"] + block + ["}"])
+    if not lines or lines[-1] != "":
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,208 @@
+""" This is profiling docstring
+
+Opt-in profiling of driver operations. A sampled fraction of operations
+runs under cProfile, and tracemalloc where available, and their stats are
+kept in a bounded on-disk ring per operation type. Profiling is switched
+on without a restart by creating a flag file or sending SIGUSR2.
+"""
+import argparse
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import random
+import signal
+import StringIO
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from kaminario_flocker_driver.constants import PROFILE_DIR, \
+    PROFILE_FLAG_FILE, PROFILE_SAMPLE_RATE, PROFILE_RING_SIZE
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.7 only has it through the pytracemalloc backport
+    tracemalloc = None
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class OperationProfiler(object):
+    """Profiles a sample of the driver operations.
+
+    :param directory: Where the profiles are written, one sub directory
+        per operation type.
+    :param sample_rate: Fraction of the operations profiled while
+        profiling is on.
+    :param ring_size: Profiles kept per operation type, older ones are
+        deleted.
+    :param enabled: Whether profiling starts switched on.
+    :param flag_file: Profiling is also on while this file exists.
+    """
+
+    def __init__(self, directory=PROFILE_DIR,
+                 sample_rate=PROFILE_SAMPLE_RATE,
+                 ring_size=PROFILE_RING_SIZE, enabled=False,
+                 flag_file=PROFILE_FLAG_FILE):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.ring_size = ring_size
+        self.switched_on = enabled
+        self.flag_file = flag_file
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.sequence = 0
+
+    @property
+    def enabled(self):
+        """Whether operations are being profiled."""
+        return self.switched_on or bool(
+            self.flag_file and os.path.exists(self.flag_file))
+
+    def toggle(self, *args):
+        """Switch profiling on or off, usable as a signal handler."""
+        self.switched_on = not self.switched_on
+        LOG.info('Operation profiling switched %s',
+                 'on' if self.switched_on else 'off')
+
+    def install_signal(self, signum=signal.SIGUSR2):
+        """Toggle profiling on ``signum``, unless the signal is already
+        handled or this is not the main thread.
+
+        :return: True if the handler was installed.
+        """
+        try:
+            if signal.getsignal(signum) not in (signal.SIG_DFL, None):
+                return False
+            signal.signal(signum, self.toggle)
+        except ValueError:
+            return False
+        return True
+
+    def _sampled(self):
+        return self.enabled and self.random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, operation):
+        """Profile a block as one ``operation``, if it is sampled.
+
+        Operations nested in a profiled one are part of its profile.
+        """
+        if getattr(_local, 'active', False) or not self._sampled():
+            yield
+            return
+        _local.active = True
+        tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.time() - start
+            snapshot = tracemalloc.take_snapshot() \
+                if tracemalloc is not None and tracemalloc.is_tracing() \
+                else None
+            if tracing:
+                tracemalloc.stop()
+            _local.active = False
+            try:
+                self._save(operation, profiler, snapshot, elapsed)
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to save the profile of %s: %s',
+                            operation, e)
+
+    def _save(self, operation, profiler, snapshot, elapsed):
+        """Write the stats of one operation and trim its ring."""
+        directory = os.path.join(self.directory, operation)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            self.sequence += 1
+            base = os.path.join(directory, "{:.6f}-{}-{}".format(
+                time.time(), os.getpid(), self.sequence))
+        profiler.dump_stats(base + ".prof")
+        if snapshot is not None:
+            snapshot.dump(base + ".tracemalloc")
+        LOG.info('Profiled %s (%.3fs) to %s.prof', operation, elapsed, base)
+        for pattern in ("*.prof", "*.tracemalloc"):
+            paths = sorted(glob.glob(os.path.join(directory, pattern)),
+                           key=_sequence_key)
+            for path in paths[:-self.ring_size]:
+                os.remove(path)
+
+
+def _sequence_key(path):
+    """Order profile files by time of capture."""
+    stamp, _, rest = os.path.basename(path).partition("-")
+    pid, _, sequence = rest.partition("-")
+    return float(stamp), int(pid), int(sequence.split(".")[0])
+
+
+def summarize(directory=PROFILE_DIR, operation=None, top=15,
+              sort="cumulative"):
+    """Summarize the captured profiles.
+
+    :param directory: The profile directory of the driver.
+    :param operation: Only this operation type, all by default.
+    :param top: Number of functions (and allocation sites) listed per
+        operation type.
+    :param sort: pstats sort key of the functions.
+    :return: The summary text.
+    """
+    out = StringIO.StringIO()
+    operations = [operation] if operation else sorted(
+        name for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name))) \
+        if os.path.isdir(directory) else []
+    for name in operations:
+        profiles = sorted(glob.glob(os.path.join(directory, name, "*.prof")),
+                          key=_sequence_key)
+        if not profiles:
+            continue
+        stats = pstats.Stats(*profiles, stream=out)
+        out.write("== {}: {} profiles, {:.3f}s profiled on average\n".format(
+            name, len(profiles), stats.total_tt / len(profiles)))
+        stats.sort_stats(sort).print_stats(top)
+        snapshots = sorted(glob.glob(os.path.join(directory, name,
+                                                  "*.tracemalloc")),
+                           key=_sequence_key)
+        if snapshots and tracemalloc is not None:
+            out.write("Largest allocations of the latest snapshot:\n")
+            snapshot = tracemalloc.Snapshot.load(snapshots[-1])
+            for stat in snapshot.statistics("lineno")[:top]:
+                out.write("  {}\n".format(stat))
+    if not out.getvalue():
+        out.write("No profiles in {}\n".format(directory))
+    return out.getvalue()
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description="Summarize the operation profiles of the Kaminario "
+                    "Flocker driver")
+    parser.add_argument("directory", nargs="?", default=PROFILE_DIR,
+                        help="Profile directory (default %(default)s)")
+    parser.add_argument("--operation", help="Only this operation type")
+    parser.add_argument("--top", type=int, default=15,
+                        help="Functions listed per operation type")
+    parser.add_argument("--sort", default="cumulative",
+                        choices=("cumulative", "tottime", "ncalls"),
+                        help="Order of the functions")
+    args = parser.parse_args(argv)
+    sys.stdout.write(summarize(args.directory, args.operation, args.top,
+                               args.sort))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+""" This is resilience docstring
+
+Per-operation deadlines and a circuit breaker, keeping the driver's tail
+latency bounded when the array or a host command stops answering, and
+single flight calls sparing the array identical concurrent requests.
+"""
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """The deadline of the running driver operation has passed."""
+
+
+class Deadline(object):
+    """Point in time by which an operation has to complete."""
+
+    def __init__(self, timeout):
+        """:param timeout: Seconds from now."""
+        self.timeout = timeout
+        self.expires = time.time() + timeout
+
+    def remaining(self):
+        """Seconds left, never negative."""
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        """Whether the deadline has passed."""
+        return time.time() >= self.expires
+
+
+def current_deadline():
+    """The deadline of the operation running in this thread, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline_scope(timeout):
+    """Run a block under a deadline.
+
+    Nested scopes never extend the enclosing deadline, the earliest one
+    wins.
+
+    :param timeout: Seconds from now, an existing ``Deadline`` (to carry a
+        deadline over to another thread) or None for no new deadline.
+    """
+    previous = current_deadline()
+    deadline = timeout
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(timeout)
+    if previous is not None and (
+            deadline is None or previous.expires < deadline.expires):
+        deadline = previous
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+
+def check_deadline(what):
+    """Raise ``DeadlineExceeded`` if the current deadline has passed.
+
+    :param what: Description of the step about to start, for the error.
+    """
+    deadline = current_deadline()
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded('Deadline of {}s exceeded before {}'.format(
+            deadline.timeout, what))
+
+
+def time_budget(limit):
+    """Seconds a blocking call may take.
+
+    :param limit: Upper bound for the call, or None.
+    :return: The smaller of ``limit`` and the time left before the current
+        deadline (None when neither is set).
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return limit
+    if limit is None:
+        return deadline.remaining()
+    return min(limit, deadline.remaining())
+
+
+class CircuitBreaker(object):
+    """Fail fast while a dependency is clearly down.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls are refused for ``reset_timeout`` seconds. Then a single trial
+    call is let through: its success closes the circuit, its failure opens
+    it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may be attempted now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            # a trial call that ended without an outcome (e.g. its
+            # deadline passed) is replaced by a new one
+            if time.time() - self.opened_at >= self.reset_timeout:
+                LOG.info('Circuit %s half-open, trying one call', self.name)
+                self.state = self.HALF_OPEN
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def on_success(self):
+        """Record a successful call."""
+        with self.lock:
+            if self.state != self.CLOSED:
+                LOG.info('Circuit %s closed', self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def on_failure(self):
+        """Record a failed call."""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    LOG.error('Circuit %s open after %d failures',
+                              self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class _Flight(object):
+    """One call in flight and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce identical concurrent calls.
+
+    While a call for a key is running, callers asking for the same key
+    wait for it and share its result, or its exception, instead of making
+    the call again. Once it has completed the next call runs anew, as
+    does any call made after ``invalidate``.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.shared = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """Stop sharing the calls already running with later callers,
+        e.g. once a write made their result stale."""
+        with self.lock:
+            self.generation += 1
+
+    def do(self, key, func):
+        """Run ``func()``, or wait for the running call of ``key``.
+
+        :param key: Hashable identity of the call.
+        :param func: The call, without arguments.
+        :return: The result of the call.
+        """
+        with self.lock:
+            key = (self.generation, key)
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            # a follower keeps to its own deadline, not the leader's
+            if not flight.done.wait(time_budget(None)):
+                raise DeadlineExceeded(
+                    'Deadline exceeded waiting for a shared call')
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
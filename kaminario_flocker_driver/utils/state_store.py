@@ -0,0 +1,219 @@
+""" This is state_store docstring """
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS attachments (
+        blockdevice_id TEXT PRIMARY KEY,
+        dataset_id TEXT,
+        host TEXT,
+        mapping_id INTEGER,
+        lun INTEGER,
+        device_path TEXT,
+        updated REAL,
+        array TEXT)""",
+    """CREATE TABLE IF NOT EXISTS operations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        operation TEXT,
+        blockdevice_id TEXT,
+        started REAL)""",
+)
+ATTACHMENT_FIELDS = ("blockdevice_id", "dataset_id", "host", "mapping_id",
+                     "lun", "device_path", "updated", "array")
+# Columns added after the first release, with their type
+MIGRATIONS = (("attachments", "array", "TEXT"),)
+
+
+class LocalStateStore(object):
+    """Crash-safe record of what the driver attached on this node.
+
+    Keeps, per attached volume, the dataset, K2 host, mapping and local
+    device path, plus a journal of the attach/detach operations in
+    progress. Every change is committed before returning, so after an
+    agent restart or node reboot the driver can reconcile against it
+    instead of rediscovering everything.
+    """
+
+    def __init__(self, path):
+        """Open (creating if needed) the store.
+
+        :param path: Path of the sqlite database file, or ``:memory:``.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=FULL")
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+            for table, column, column_type in MIGRATIONS:
+                columns = [row[1] for row in self.db.execute(
+                    "PRAGMA table_info({})".format(table))]
+                if column not in columns:
+                    self.db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                        table, column, column_type))
+
+    def _execute(self, statement, *args):
+        with self.lock:
+            with self.db:
+                return self.db.execute(statement, args).fetchall()
+
+    def record_attachment(self, blockdevice_id, dataset_id=None, host=None,
+                          mapping_id=None, lun=None, device_path=None,
+                          array=None):
+        """Record a volume as attached to this node.
+
+        :param blockdevice_id: The volume unique ID (scsi_sn).
+        :param dataset_id: The Flocker dataset ID of the volume.
+        :param host: Name of the K2 host the volume is mapped to.
+        :param mapping_id: ID of the K2 mapping object.
+        :param lun: LUN number of the mapping.
+        :param device_path: Local device path, when known.
+        :param array: Name of the K2 array of the volume.
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO attachments ({}) VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?)".format(", ".join(ATTACHMENT_FIELDS)),
+            blockdevice_id, dataset_id and u"{}".format(dataset_id), host,
+            mapping_id, lun, device_path, time.time(), array)
+
+    def set_device_path(self, blockdevice_id, device_path):
+        """Remember the local device path of an attached volume."""
+        self._execute(
+            "UPDATE attachments SET device_path = ?, updated = ? "
+            "WHERE blockdevice_id = ?",
+            device_path, time.time(), blockdevice_id)
+
+    def remove_attachment(self, blockdevice_id):
+        """Forget an attachment."""
+        self._execute("DELETE FROM attachments WHERE blockdevice_id = ?",
+                      blockdevice_id)
+
+    def attachment(self, blockdevice_id):
+        """Look up one attachment.
+
+        :return: A dict of the attachment fields, or None.
+        """
+        rows = self._execute(
+            "SELECT {} FROM attachments WHERE blockdevice_id = ?".format(
+                ", ".join(ATTACHMENT_FIELDS)), blockdevice_id)
+        return dict(zip(ATTACHMENT_FIELDS, rows[0])) if rows else None
+
+    def attachments(self, before=None):
+        """All the recorded attachments, as a list of dicts.
+
+        :param before: Only attachments last updated before this time.
+        """
+        statement = "SELECT {} FROM attachments".format(
+            ", ".join(ATTACHMENT_FIELDS))
+        if before is None:
+            rows = self._execute(statement)
+        else:
+            rows = self._execute(statement + " WHERE updated < ?", before)
+        return [dict(zip(ATTACHMENT_FIELDS, row)) for row in rows]
+
+    def begin(self, operation, blockdevice_id):
+        """Journal the start of an operation.
+
+        :return: The journal entry id, to pass to ``finish``.
+        """
+        with self.lock:
+            with self.db:
+                cursor = self.db.execute(
+                    "INSERT INTO operations (operation, blockdevice_id, "
+                    "started) VALUES (?, ?, ?)",
+                    (operation, blockdevice_id, time.time()))
+                return cursor.lastrowid
+
+    def finish(self, entry_id):
+        """Remove a finished operation from the journal."""
+        self._execute("DELETE FROM operations WHERE id = ?", entry_id)
+
+    @contextmanager
+    def operation(self, operation, blockdevice_id):
+        """Journal an operation for the duration of a ``with`` block.
+
+        The entry is only left behind when the process dies inside the
+        block, which is what ``pending_operations`` reports on restart.
+        """
+        entry_id = self.begin(operation, blockdevice_id)
+        try:
+            yield entry_id
+        finally:
+            self.finish(entry_id)
+
+    def pending_operations(self, before=None):
+        """Operations started but never finished, oldest first.
+
+        :param before: Only operations started before this time.
+        :return: A list of ``(entry_id, operation, blockdevice_id)``.
+        """
+        if before is None:
+            rows = self._execute("SELECT id, operation, blockdevice_id "
+                                 "FROM operations ORDER BY id")
+        else:
+            rows = self._execute("SELECT id, operation, blockdevice_id "
+                                 "FROM operations WHERE started < ? "
+                                 "ORDER BY id", before)
+        return [tuple(row) for row in rows]
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.db.close()
+
+
+class NullStateStore(object):
+    """Stand-in used when no local state is kept; records nothing."""
+
+    def record_attachment(self, blockdevice_id, **fields):
+        pass
+
+    def set_device_path(self, blockdevice_id, device_path):
+        pass
+
+    def remove_attachment(self, blockdevice_id):
+        pass
+
+    def attachment(self, blockdevice_id):
+        return None
+
+    def attachments(self, before=None):
+        return []
+
+    @contextmanager
+    def operation(self, operation, blockdevice_id):
+        yield None
+
+    def begin(self, operation, blockdevice_id):
+        return None
+
+    def pending_operations(self, before=None):
+        return []
+
+    def finish(self, entry_id):
+        pass
+
+
+def open_state_store(path):
+    """Open the local state store at ``path``.
+
+    :param path: Database path; an empty value disables the store.
+    :return: A ``LocalStateStore``, or a ``NullStateStore`` when disabled
+        or the database cannot be opened.
+    """
+    if not path or str(path).lower() == "none":
+        return NullStateStore()
+    try:
+        return LocalStateStore(path)
+    except Exception as e:
+        LOG.warning("Unable to open local state store %s, running without "
+                    "it: %s", path, e)
+        return NullStateStore()
@@ -0,0 +1,99 @@
+""" This Unit Test code for call_trace """
+
+import threading
+import unittest
+from uuid import UUID
+from kaminario_flocker_driver.utils.call_trace import CallTracer, \
+    current_trace, record_command, record_request, trace_scope
+
+URL = "https://k2/api/v2/{}"
+
+
+class CallTracerTest(unittest.TestCase):
+    """Tests for `call_trace.py`."""
+
+    def setUp(self):
+        self.tracer = CallTracer()
+
+    def test_requests_counted_per_operation(self):
+        """Are requests reported against their operation?"""
+        for _ in range(2):
+            with trace_scope("attach_volume", self.tracer):
+                record_request("GET", URL.format("volumes?scsi_sn=1"), 0.1,
+                               200)
+                record_request("POST", URL.format("mappings"), 0.1, 201)
+        report = self.tracer.report()["attach_volume"]
+        self.assertEqual(report["operations"], 2)
+        self.assertEqual(report["max_calls"], 2)
+        self.assertEqual(report["by_request"],
+                         {"GET volumes": 1.0, "POST mappings": 1.0})
+        self.assertEqual(report["duplicates"], {})
+
+    def test_repeated_query_flagged(self):
+        """Is an identical query issued twice in an operation flagged?"""
+        with trace_scope("detach_volume", self.tracer):
+            for host_id in (3, 3, 4):
+                record_request("GET", URL.format("hosts/{}".format(host_id)),
+                               0.1, 200)
+            record_request("GET", URL.format("mappings?b=2&a=1"), 0.1, 200)
+            record_request("GET", URL.format("mappings?a=1&b=2"), 0.1, 200)
+        self.assertEqual(self.tracer.report()["detach_volume"]["duplicates"],
+                         {"GET hosts/3": 2, "GET mappings?a=1&b=2": 2})
+
+    def test_over_budget(self):
+        """Is an operation making too many requests reported?"""
+        with trace_scope("list_volumes", self.tracer):
+            for _ in range(3):
+                record_request("GET", URL.format("volumes"), 0.1, 200)
+        self.assertEqual(self.tracer.over_budget({"list_volumes": 3}), [])
+        self.assertEqual(len(self.tracer.over_budget({"list_volumes": 2})),
+                         1)
+
+    def test_nested_and_carried_scopes(self):
+        """Do nested scopes and worker threads add to the outer trace?"""
+        with trace_scope("destroy_volumes", self.tracer) as trace:
+            with trace_scope("destroy_volume", self.tracer) as inner:
+                self.assertIs(inner, trace)
+
+            def worker():
+                with trace_scope(trace):
+                    record_request("DELETE", URL.format("volumes/1"), 0.1,
+                                   204)
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+        self.assertIsNone(current_trace())
+        self.assertEqual(list(self.tracer.report()), ["destroy_volumes"])
+        self.assertEqual(trace.calls, 1)
+
+    def test_untraced_requests_ignored(self):
+        """Are requests outside of a traced operation dropped?"""
+        with trace_scope("list_volumes", None):
+            record_request("GET", URL.format("volumes"), 0.1, 200)
+        self.assertEqual(self.tracer.report(), {})
+
+    def test_structured_trace_output(self):
+        """Is a finished trace handed to the sink with its arguments,
+        commands and error?"""
+        traces = []
+        self.tracer.sink = traces.append
+        dataset_id = UUID(int=1)
+        with self.assertRaises(ValueError):
+            with trace_scope("create_volume", self.tracer,
+                             (dataset_id, 1024), {"profile": None}):
+                record_request("POST", URL.format("volumes"), 0.1, 201)
+                record_command("multipath -ll", 0.2, 0)
+                raise ValueError("no space")
+        trace = traces[0]
+        self.assertEqual(trace["arguments"], [unicode(dataset_id), 1024])
+        self.assertEqual(trace["keywords"], {u"profile": None})
+        self.assertEqual(trace["error"], u"ValueError: no space")
+        self.assertEqual([r["resource"] for r in trace["requests"]],
+                         ["volumes"])
+        self.assertEqual([c["command"] for c in trace["commands"]],
+                         ["multipath -ll"])
+        self.assertGreaterEqual(trace["duration"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
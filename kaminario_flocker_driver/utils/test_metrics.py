@@ -0,0 +1,48 @@
+""" This Unit Test code for metrics """
+
+import unittest
+import urllib2
+from kaminario_flocker_driver.utils.metrics import MetricsRegistry, \
+    serve_metrics
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    """Tests for `metrics.py`."""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.registry.describe("k2_iops", "IOPS of a volume")
+
+    def test_render(self):
+        """Are gauges rendered in the Prometheus text format?"""
+        self.registry.replace("k2_iops", [({"name": u'a"b'}, 3),
+                                          ({"name": u"c"}, 1.5)])
+        self.assertEqual(self.registry.render(),
+                         u"# HELP k2_iops IOPS of a volume\n"
+                         u"# TYPE k2_iops gauge\n"
+                         u'k2_iops{name="a\\"b"} 3.0\n'
+                         u'k2_iops{name="c"} 1.5\n')
+
+    def test_replace_drops_old_samples(self):
+        """Are samples not given again dropped?"""
+        self.registry.replace("k2_iops", [({"name": u"a"}, 3)])
+        self.registry.replace("k2_iops", [({"name": u"b"}, 4)])
+        self.assertEqual(self.registry.samples("k2_iops"),
+                         {(("name", u"b"),): 4})
+
+    def test_served_over_http(self):
+        """Can the gauges be scraped over HTTP, locally by default?"""
+        self.registry.replace("k2_iops", [({"name": u"a"}, 3)])
+        server = serve_metrics(self.registry, 0)
+        try:
+            self.assertEqual(server.server_address[0], "127.0.0.1")
+            body = urllib2.urlopen("http://127.0.0.1:{}/metrics".format(
+                server.server_port), timeout=5).read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('k2_iops{name="a"} 3.0', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+""" This Unit Test code for multipath_conf """
+
+import unittest
+from kaminario_flocker_driver.utils import multipath_conf
+
+SETTINGS = [("path_selector", "queue-length 0"), ("no_path_retry", "fail")]
+CONF = """defaults {
+    user_friendly_names yes   # keep mpathX names
+}
+blacklist {
+    devnode "^sda$"
+}
+devices {
+    device {
+        vendor "OTHER"
+        product "X"
+        path_selector "round-robin 0"
+    }
+    device {
+        vendor "KMNRIO"
+        product "K2"
+        path_selector "round-robin 0"
+        rr_min_io 1000
+    }
+}
+"""
+
+
+class MultipathConfTest(unittest.TestCase):
+    """Tests for `multipath_conf.py`."""
+
+    def test_parse_sections(self):
+        """Are nested sections and their attributes parsed?"""
+        sections = multipath_conf.parse_sections(CONF)
+        paths = [section["path"] for section in sections]
+        self.assertIn(("devices", "device"), paths)
+        self.assertEqual(sections[0]["attributes"],
+                         {"user_friendly_names": "yes"})
+
+    def test_drift_reported(self):
+        """Are wrong and missing settings reported?"""
+        drift = multipath_conf.device_drift(CONF, SETTINGS)
+        self.assertEqual(drift, [
+            "path_selector is round-robin 0, recommended queue-length 0",
+            "no_path_retry is not set, recommended fail"])
+        self.assertEqual(len(multipath_conf.device_drift("", SETTINGS)), 1)
+
+    def test_section_replaced(self):
+        """Is only the K2 section replaced, and idempotently?"""
+        conf = multipath_conf.with_device_section(CONF, SETTINGS)
+        self.assertEqual(multipath_conf.device_drift(conf, SETTINGS), [])
+        self.assertIn('vendor "OTHER"', conf)
+        self.assertIn("user_friendly_names yes", conf)
+        self.assertNotIn("rr_min_io", conf)
+        self.assertEqual(
+            multipath_conf.with_device_section(conf, SETTINGS), conf)
+
+    def test_devices_section_added(self):
+        """Is a devices section created when there is none?"""
+        conf = multipath_conf.with_device_section("defaults {\n}\n",
+                                                  SETTINGS)
+        self.assertEqual(multipath_conf.device_drift(conf, SETTINGS), [])
+        self.assertTrue(conf.startswith("defaults {\n}\ndevices {\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+""" This Unit Test code for profiling """
+
+import os
+import shutil
+import tempfile
+import unittest
+from kaminario_flocker_driver.utils.profiling import OperationProfiler, \
+    summarize
+
+
+def _work():
+    return sum(range(1000))
+
+
+class OperationProfilerTest(unittest.TestCase):
+    """Tests for `profiling.py`."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.flag_file = os.path.join(self.directory, "enabled")
+        self.profiler = OperationProfiler(
+            os.path.join(self.directory, "profiles"), sample_rate=1,
+            ring_size=3, flag_file=self.flag_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _profiles(self, operation):
+        directory = os.path.join(self.profiler.directory, operation)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory)
+                      if name.endswith(".prof"))
+
+    def test_off_by_default(self):
+        """Is nothing profiled until profiling is switched on?"""
+        with self.profiler.profile("attach_volume"):
+            _work()
+        self.assertEqual(self._profiles("attach_volume"), [])
+
+    def test_flag_file_and_toggle(self):
+        """Do the flag file and the signal handler switch profiling?"""
+        open(self.flag_file, "w").close()
+        self.assertTrue(self.profiler.enabled)
+        os.remove(self.flag_file)
+        self.assertFalse(self.profiler.enabled)
+        self.profiler.toggle()
+        with self.profiler.profile("attach_volume"):
+            _work()
+        self.assertEqual(len(self._profiles("attach_volume")), 1)
+        self.profiler.toggle()
+        self.assertFalse(self.profiler.enabled)
+
+    def test_sampling_and_ring(self):
+        """Are only sampled operations kept, the latest ones per type?"""
+        self.profiler.toggle()
+        self.profiler.sample_rate = 0
+        with self.profiler.profile("create_volume"):
+            _work()
+        self.assertEqual(self._profiles("create_volume"), [])
+        self.profiler.sample_rate = 1
+        for _ in range(5):
+            with self.profiler.profile("create_volume"):
+                with self.profiler.profile("list_volumes"):
+                    _work()
+        profiles = self._profiles("create_volume")
+        self.assertEqual([name.rsplit("-", 1)[1] for name in profiles],
+                         ["3.prof", "4.prof", "5.prof"])
+        self.assertEqual(self._profiles("list_volumes"), [])
+
+    def test_summarize(self):
+        """Does the summary list the operations and their functions?"""
+        self.assertIn("No profiles", summarize(self.profiler.directory))
+        self.profiler.toggle()
+        for operation in ("attach_volume", "detach_volume"):
+            with self.profiler.profile(operation):
+                _work()
+        summary = summarize(self.profiler.directory)
+        self.assertIn("== attach_volume: 1 profiles", summary)
+        self.assertIn("== detach_volume: 1 profiles", summary)
+        self.assertIn("_work", summary)
+        summary = summarize(self.profiler.directory, "detach_volume")
+        self.assertNotIn("attach_volume", summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
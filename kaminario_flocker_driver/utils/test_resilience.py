@@ -0,0 +1,159 @@
+""" This Unit Test code for resilience """
+
+import threading
+import time
+import unittest
+from kaminario_flocker_driver.utils.iscsi_utils import IscsiUtils
+from kaminario_flocker_driver.utils.resilience import CircuitBreaker, \
+    DeadlineExceeded, SingleFlight, check_deadline, current_deadline, \
+    deadline_scope, time_budget
+
+
+class DeadlineTest(unittest.TestCase):
+    """Tests for the deadline helpers."""
+
+    def test_nested_scope_keeps_earliest(self):
+        """Does an inner scope never extend the outer deadline?"""
+        with deadline_scope(1) as outer:
+            with deadline_scope(100) as inner:
+                self.assertIs(inner, outer)
+            with deadline_scope(0.5) as inner:
+                self.assertLess(inner.expires, outer.expires)
+            self.assertIs(current_deadline(), outer)
+        self.assertIsNone(current_deadline())
+
+    def test_expired_deadline_raises(self):
+        """Is an expired deadline reported?"""
+        with deadline_scope(0):
+            self.assertRaises(DeadlineExceeded, check_deadline, "test")
+
+    def test_time_budget(self):
+        """Is the budget bounded by both the limit and the deadline?"""
+        self.assertEqual(time_budget(5), 5)
+        with deadline_scope(1):
+            self.assertLessEqual(time_budget(5), 1)
+
+    def test_command_killed_at_deadline(self):
+        """Is a hung command killed when the deadline passes?"""
+        start = time.time()
+        with deadline_scope(0.5):
+            output, status = IscsiUtils()._run_command("sleep 10")
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(output, "")
+        self.assertNotEqual(status, 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Tests for `CircuitBreaker`."""
+
+    def test_opens_and_recovers(self):
+        """Does the circuit open on failures and close after a trial?"""
+        breaker = CircuitBreaker("test", failure_threshold=2,
+                                 reset_timeout=0.05)
+        breaker.on_failure()
+        self.assertTrue(breaker.allow())
+        breaker.on_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow(), "only one trial call")
+        breaker.on_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_lost_trial_replaced(self):
+        """Is a trial call that never reported back tried again?"""
+        breaker = CircuitBreaker("test", failure_threshold=1,
+                                 reset_timeout=0.05)
+        breaker.on_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+
+
+class SingleFlightTest(unittest.TestCase):
+    """Tests for the single flight calls."""
+
+    def _concurrently(self, flight, func, count=5):
+        results = []
+
+        def call():
+            try:
+                results.append(flight.do("key", func))
+            except ValueError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_result(self):
+        """Do identical concurrent calls run once?"""
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return len(calls)
+
+        flight = SingleFlight()
+        self.assertEqual(self._concurrently(flight, slow), [1] * 5)
+        self.assertEqual(flight.shared, 4)
+        self.assertEqual(flight.do("key", slow), 2)
+
+    def test_error_shared(self):
+        """Do waiting callers get the exception of the call?"""
+        def failing():
+            time.sleep(0.2)
+            raise ValueError("down")
+
+        results = self._concurrently(SingleFlight(), failing, 3)
+        self.assertEqual([str(e) for e in results], ["down"] * 3)
+
+    def test_invalidated_call_not_shared(self):
+        """Does a call made after invalidate run anew?"""
+        calls = []
+        started = threading.Event()
+
+        def slow():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return len(calls)
+
+        flight = SingleFlight()
+        leader = threading.Thread(target=flight.do, args=("key", slow))
+        leader.start()
+        started.wait()
+        flight.invalidate()
+        self.assertEqual(flight.do("key", slow), 2)
+        leader.join()
+        self.assertEqual(flight.shared, 0)
+
+    def test_follower_keeps_to_its_deadline(self):
+        """Does a waiting caller give up at its own deadline?"""
+        started = threading.Event()
+        release = threading.Event()
+
+        def hung():
+            started.set()
+            release.wait(5)
+
+        flight = SingleFlight()
+        leader = threading.Thread(target=flight.do, args=("key", hung))
+        leader.start()
+        started.wait()
+        start = time.time()
+        with deadline_scope(0.1):
+            self.assertRaises(DeadlineExceeded, flight.do, "key", hung)
+        self.assertLess(time.time() - start, 1)
+        release.set()
+        leader.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+""" This Unit Test code for state_store """
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from kaminario_flocker_driver.utils.state_store import LocalStateStore, \
+    NullStateStore, open_state_store
+
+
+class LocalStateStoreTest(unittest.TestCase):
+    """Tests for `state_store.py`."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.db")
+        self.store = LocalStateStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_attachment_round_trip(self):
+        """Is a recorded attachment returned and then forgotten?"""
+        self.store.record_attachment(u"sn1", dataset_id=u"ds1", host=u"h",
+                                     mapping_id=7, lun=1)
+        self.store.set_device_path(u"sn1", u"/dev/mapper/mpatha")
+        attachment = self.store.attachment(u"sn1")
+        self.assertEqual(attachment["mapping_id"], 7)
+        self.assertEqual(attachment["device_path"], u"/dev/mapper/mpatha")
+        self.store.remove_attachment(u"sn1")
+        self.assertIsNone(self.store.attachment(u"sn1"))
+
+    def test_state_survives_reopen(self):
+        """Are attachments and unfinished operations kept across restarts?"""
+        self.store.record_attachment(u"sn1", mapping_id=3)
+        self.store.begin("detach", u"sn1")
+        with self.store.operation("attach", u"sn2"):
+            pass
+        self.store.close()
+        self.store = LocalStateStore(self.path)
+        self.assertEqual([a["blockdevice_id"]
+                          for a in self.store.attachments()], [u"sn1"])
+        pending = self.store.pending_operations()
+        self.assertEqual([(op, bid) for _, op, bid in pending],
+                         [("detach", u"sn1")])
+
+    def test_state_before(self):
+        """Is state recorded after the cutoff left out?"""
+        cutoff = time.time()
+        for blockdevice_id in (u"sn1", u"sn2"):
+            self.store.record_attachment(blockdevice_id, mapping_id=3)
+            self.store.begin("detach", blockdevice_id)
+        # sn2 was touched by the running driver
+        self.store._execute("UPDATE attachments SET updated = ? "
+                            "WHERE blockdevice_id = ?", cutoff + 1, u"sn2")
+        self.store._execute("UPDATE operations SET started = ? "
+                            "WHERE blockdevice_id = ?", cutoff + 1, u"sn2")
+        self.store._execute("UPDATE attachments SET updated = ? "
+                            "WHERE blockdevice_id = ?", cutoff - 1, u"sn1")
+        self.store._execute("UPDATE operations SET started = ? "
+                            "WHERE blockdevice_id = ?", cutoff - 1, u"sn1")
+        self.assertEqual([a["blockdevice_id"] for a in
+                          self.store.attachments(before=cutoff)], [u"sn1"])
+        self.assertEqual([bid for _, _, bid in
+                          self.store.pending_operations(before=cutoff)],
+                         [u"sn1"])
+        self.assertEqual(len(self.store.pending_operations()), 2)
+
+    def test_store_of_older_release_is_migrated(self):
+        """Is the array column added to an existing database?"""
+        self.store.close()
+        path = os.path.join(self.directory, "old.db")
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE attachments (blockdevice_id TEXT PRIMARY "
+                   "KEY, dataset_id TEXT, host TEXT, mapping_id INTEGER, "
+                   "lun INTEGER, device_path TEXT, updated REAL)")
+        db.execute("INSERT INTO attachments VALUES "
+                   "('sn1', NULL, 'h', 3, 1, NULL, 0)")
+        db.commit()
+        db.close()
+        self.store = LocalStateStore(path)
+        self.assertIsNone(self.store.attachment(u"sn1")["array"])
+        self.store.record_attachment(u"sn2", mapping_id=4, array=u"k2-b")
+        self.assertEqual(self.store.attachment(u"sn2")["array"], u"k2-b")
+
+    def test_open_state_store_disabled(self):
+        """Is the store disabled for an empty or unusable path?"""
+        self.assertIsInstance(open_state_store(""), NullStateStore)
+        self.assertIsInstance(
+            open_state_store(os.path.join(self.directory, "no", "x.db")),
+            NullStateStore)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,10 +16,17 @@ setup(
         'bitmath',
         'krest'],
     keywords='backend, plugin, flocker, docker, python',
-    packages=['kaminario_flocker_driver', 'kaminario_flocker_driver/utils'],
+    packages=['kaminario_flocker_driver', 'kaminario_flocker_driver/utils',
+              'kaminario_flocker_driver/benchmark'],
     author='Calsoft',
     author_email='kaminario-flocker@calsoftinc.com',
     url='https://github.com/Kaminario/flocker-driver',
+    entry_points={
+        'console_scripts': [
+            'kaminario-flocker-profile = '
+            'kaminario_flocker_driver.utils.profiling:main',
+        ],
+    },
     zip_safe=False,
     download_url='',
 )